@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks of template parsing, code generation, compilation and rendering:
+
+    python -m benchmarks.run [--size N] [-o results.json] [--compare baseline.json]
+'''
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Runs benchmarks, timing every stage separately:
+
+    python -m benchmarks.run [--shape NAME ...] [--size N] [--repeat N]
+        [--ast] [-o results.json] [--compare baseline.json] [--threshold 0.1]
+
+With --compare, exits with status 1 if median time of any stage got
+slower than in baseline by more than threshold.
+'''
+
+import argparse
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+
+from pyhaa import (
+    __version__ as pyhaa_version,
+    html_render_to_string,
+    PyhaaEnvironment,
+)
+from pyhaa.codegen.astgen import HTMLASTCodeGen
+from pyhaa.codegen.html import HTMLCodeGen
+from pyhaa.runtime.loaders import BaseLoader
+
+from .shapes import SHAPES
+
+STAGES = ('parse', 'optimize', 'codegen', 'compile', 'render')
+
+
+class MemoryLoader(BaseLoader):
+    '''
+    Loads templates from dict of path to source
+    '''
+    def __init__(self, templates, **kwargs):
+        super().__init__(**kwargs)
+        self.templates = templates
+
+    def get_source_code(self, path, environment):
+        source = self.templates.get(path)
+        if source is None:
+            raise Exception('Template not found: "{}"'.format(path))
+        return io.StringIO(source), '<benchmark {}>'.format(path), None
+
+
+def summarize(samples):
+    return dict(
+        min = min(samples),
+        median = statistics.median(samples),
+        mean = statistics.mean(samples),
+        runs = len(samples),
+    )
+
+def time_compilation(environment, templates, repeat):
+    '''
+    Returns samples of every compilation stage, summed for all templates
+    '''
+    samples = {stage: list() for stage in STAGES[:-1]}
+    clock = time.perf_counter
+    for _ in range(repeat):
+        totals = dict.fromkeys(samples, 0.0)
+        for path, source in templates.items():
+            start = clock()
+            structure = environment.parse_string(source)
+            parsed = clock()
+            structure = environment.optimize_structure(structure)
+            optimized = clock()
+            bio = io.BytesIO()
+            codegen = environment.codegen_class(
+                structure,
+                bio,
+                template_path = path,
+                encoding = environment.output_encoding,
+            )
+            codegen.write()
+            code = codegen.get_code()
+            generated = clock()
+            environment.compile_code(code, '<benchmark {}>'.format(path), path)
+            compiled = clock()
+            totals['parse'] += parsed - start
+            totals['optimize'] += optimized - parsed
+            totals['codegen'] += generated - optimized
+            totals['compile'] += compiled - generated
+        for stage, total in totals.items():
+            samples[stage].append(total)
+    return samples
+
+def time_rendering(environment, path, kwargs, repeat):
+    template = environment.get_template(path)
+    samples = list()
+    clock = time.perf_counter
+    for _ in range(repeat):
+        start = clock()
+        output = html_render_to_string(template, kwargs=kwargs)
+        samples.append(clock() - start)
+    return samples, len(output.encode(environment.output_encoding))
+
+def run_shape(name, size, repeat, optimization_level=1, codegen_class=HTMLCodeGen):
+    templates, kwargs = SHAPES[name](size)
+    environment = PyhaaEnvironment(
+        loader = MemoryLoader(templates),
+        codegen_class = codegen_class,
+        optimization_level = optimization_level,
+    )
+    samples = time_compilation(environment, templates, repeat)
+    samples['render'], output_size = time_rendering(environment, next(iter(templates)), kwargs, repeat)
+    result = {
+        stage: summarize(samples[stage])
+        for stage in STAGES
+    }
+    result['templates'] = len(templates)
+    result['source_size'] = sum(len(source) for source in templates.values())
+    result['output_size'] = output_size
+    return result
+
+def run(shapes, size, repeat, optimization_level=1, codegen_class=HTMLCodeGen):
+    return dict(
+        meta = dict(
+            pyhaa = pyhaa_version,
+            python = sys.version,
+            implementation = platform.python_implementation(),
+            platform = platform.platform(),
+            time = time.time(),
+            size = size,
+            repeat = repeat,
+            optimization_level = optimization_level,
+            codegen = codegen_class.__name__,
+        ),
+        results = {
+            name: run_shape(name, size, repeat, optimization_level, codegen_class)
+            for name in shapes
+        },
+    )
+
+def compare(results, baseline, threshold):
+    '''
+    Returns lines of comparison of median times and list of regressions -
+    tuples (shape, stage, ratio)
+    '''
+    lines = ['{:<20} {:<10} {:>12} {:>12} {:>8}'.format('shape', 'stage', 'baseline', 'current', 'ratio')]
+    regressions = list()
+    for name, stages in sorted(results['results'].items()):
+        base_stages = baseline['results'].get(name)
+        if not base_stages:
+            lines.append('{:<20} not in baseline'.format(name))
+            continue
+        for stage in STAGES:
+            if stage not in base_stages:
+                continue
+            old = base_stages[stage]['median']
+            new = stages[stage]['median']
+            ratio = new / old if old else float('inf')
+            marker = ''
+            if ratio > 1 + threshold:
+                regressions.append((name, stage, ratio))
+                marker = ' SLOWER'
+            elif ratio < 1 - threshold:
+                marker = ' faster'
+            lines.append('{:<20} {:<10} {:>10.3f}ms {:>10.3f}ms {:>7.2f}x{}'.format(
+                name, stage, old * 1e3, new * 1e3, ratio, marker,
+            ))
+    if baseline['meta'].get('size') != results['meta']['size']:
+        lines.append('Warning: baseline was run with size {}'.format(baseline['meta'].get('size')))
+    if baseline['meta'].get('codegen') != results['meta']['codegen']:
+        lines.append('Warning: baseline was run with codegen {}'.format(baseline['meta'].get('codegen')))
+    return lines, regressions
+
+def format_results(results):
+    lines = ['{:<20} '.format('shape') + ' '.join('{:>10}'.format(stage) for stage in STAGES)]
+    for name, stages in sorted(results['results'].items()):
+        lines.append('{:<20} '.format(name) + ' '.join(
+            '{:>8.3f}ms'.format(stages[stage]['median'] * 1e3)
+            for stage in STAGES
+        ))
+    return lines
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.run')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES), help='shape to run, may be repeated (default: all)')
+    parser.add_argument('--size', type=int, default=100, help='size of generated templates')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs of every stage')
+    parser.add_argument('-O', '--optimization-level', type=int, default=1)
+    parser.add_argument('--ast', action='store_true', help='compile with codegen building AST')
+    parser.add_argument('-o', '--output', help='write results as JSON to file')
+    parser.add_argument('--compare', metavar='BASELINE', help='compare with results stored in file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative slowdown reported as regression')
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    shapes = args.shape or sorted(SHAPES)
+    codegen_class = HTMLASTCodeGen if args.ast else HTMLCodeGen
+    results = run(shapes, args.size, args.repeat, args.optimization_level, codegen_class)
+    print('\n'.join(format_results(results)))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as fp:
+            baseline = json.load(fp)
+        lines, regressions = compare(results, baseline, args.threshold)
+        print()
+        print('\n'.join(lines))
+        if regressions:
+            print('{} stages slower than baseline'.format(len(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Generators of template sources of given size. Every shape is a function
+taking size and returning dict of template path to source - first one is
+rendered - and keyword arguments passed to rendered template.
+'''
+
+__all__ = (
+    'SHAPES',
+)
+
+def indented(level, line):
+    return '  ' * level + line
+
+def deep_nesting(size):
+    '''
+    Tags nested size levels deep, with static and dynamic content
+    '''
+    lines = list()
+    for level in range(size):
+        lines.append(indented(level, '%div.level#level{}'.format(level)))
+    lines.append(indented(size, 'Deepest text'))
+    lines.append(indented(size, '= "level " + str({})'.format(size)))
+    return {'deep_nesting.pha': '\n'.join(lines)}, {}
+
+def wide_loop(size):
+    '''
+    Single loop of size iterations rendering list items
+    '''
+    lines = [
+        '- items = keywords["items"]',
+        '%ul.items',
+        '  - for item in items:',
+        '    %li.item',
+        '      %span.name =item["name"]',
+        '      %span.price ="{:.2f}".format(item["price"])',
+        '      - if item["available"]:',
+        '        %em available',
+        '      - else:',
+        '        %del sold out',
+    ]
+    items = [
+        dict(name='item {}'.format(idx), price=idx * 1.5, available=idx % 3 != 0)
+        for idx in range(size)
+    ]
+    return {'wide_loop.pha': '\n'.join(lines)}, dict(items=items)
+
+def dynamic_attributes(size):
+    '''
+    Loop over tags with many attributes computed at render time
+    '''
+    attributes = ', '.join(
+        '"data-{0}": str(value + {0})'.format(idx)
+        for idx in range(10)
+    )
+    lines = [
+        '- for value in range(keywords["count"]):',
+        '  %a{{"href": "/item/" + str(value), "title": "Item"}}{{{}}}'.format(attributes),
+        '    link',
+        '  %input(type="checkbox" checked){"id": "box" + str(value)}',
+    ]
+    return {'dynamic_attributes.pha': '\n'.join(lines)}, dict(count=size)
+
+def deep_inheritance(size):
+    '''
+    Chain of size templates, each one inheriting from previous one and
+    overriding its partial
+    '''
+    templates = {
+        'level_0.pha': '\n'.join((
+            '`def title():',
+            '  -return "base"',
+            '',
+            '%html',
+            '  %head',
+            '    %title =self.title()',
+            '  %body',
+            '    base content',
+        )),
+    }
+    for level in range(1, size + 1):
+        templates['level_{}.pha'.format(level)] = '\n'.join((
+            "`inherit 'level_{}.pha'".format(level - 1),
+            '`def title():',
+            '  -return "level {}"'.format(level),
+            '',
+            '%section ="level {}"'.format(level),
+            '=parent()',
+        ))
+    path = 'level_{}.pha'.format(size)
+    # Rendered template goes first
+    return dict([(path, templates.pop(path))] + sorted(templates.items())), {}
+
+def heavy_partials(size):
+    '''
+    Many partials called many times
+    '''
+    lines = list()
+    for idx in range(size):
+        lines.extend((
+            '`def partial_{}(value):'.format(idx),
+            '  %span.partial =value',
+            '  =self.leaf(value)',
+        ))
+    lines.extend((
+        '`def leaf(value):',
+        '  %b leaf',
+        '',
+    ))
+    lines.extend(
+        '=self.partial_{0}({0})'.format(idx)
+        for idx in range(size)
+    )
+    lines.extend((
+        '- for idx in range({}):'.format(size),
+        '  =self.partial_0(idx)',
+    ))
+    return {'heavy_partials.pha': '\n'.join(lines)}, {}
+
+SHAPES = dict(
+    deep_nesting = deep_nesting,
+    wide_loop = wide_loop,
+    dynamic_attributes = dynamic_attributes,
+    deep_inheritance = deep_inheritance,
+    heavy_partials = heavy_partials,
+)
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Command line interface:
+
+    python -m pyhaa compile [options] PATH [PATH ...]
+    python -m pyhaa archive [options] -o ARCHIVE PATH [PATH ...]
+'''
+
+import argparse
+import logging
+import sys
+
+from .compiler import build_archive, compile_templates
+from .runtime.cache import FilesystemBytecodeCache
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m pyhaa')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    compile_parser = subparsers.add_parser(
+        'compile',
+        help = 'compile all templates found in search paths into bytecode cache',
+    )
+    compile_parser.add_argument('-c', '--cache-dir', help='bytecode cache directory')
+    compile_parser.add_argument('-i', '--incremental', action='store_true', help='skip templates already cached with valid token')
+
+    archive_parser = subparsers.add_parser(
+        'archive',
+        help = 'compile all templates found in search paths into single archive file',
+    )
+    archive_parser.add_argument('-o', '--output', required=True, help='archive file')
+
+    for subparser in (compile_parser, archive_parser):
+        subparser.add_argument('paths', nargs='+', metavar='PATH', help='template search path')
+        subparser.add_argument('-j', '--jobs', type=int, help='number of worker processes')
+        subparser.add_argument('-e', '--input-encoding', help='encoding of template files')
+        subparser.add_argument('--output-encoding', default='utf-8', help='encoding of rendered output')
+        subparser.add_argument('-O', '--optimization-level', type=int, default=1)
+        subparser.add_argument('--extension', default='.pha', help='extension of template files')
+        subparser.add_argument('--slowest', type=int, default=10, help='number of slowest templates to report')
+        subparser.add_argument('-v', '--verbose', action='store_true')
+    return parser
+
+def loader_options(args):
+    return dict(
+        paths = args.paths,
+        input_encoding = args.input_encoding,
+    )
+
+def environment_options(args):
+    return dict(
+        output_encoding = args.output_encoding,
+        optimization_level = args.optimization_level,
+    )
+
+def command_compile(args):
+    report = compile_templates(
+        FilesystemBytecodeCache(args.cache_dir),
+        loader_options = loader_options(args),
+        environment_options = environment_options(args),
+        incremental = args.incremental,
+        jobs = args.jobs,
+        extension = args.extension,
+    )
+    print(report.format(args.slowest))
+    return 1 if report.failed else 0
+
+def command_archive(args):
+    report = build_archive(
+        args.output,
+        loader_options = loader_options(args),
+        environment_options = environment_options(args),
+        jobs = args.jobs,
+        extension = args.extension,
+    )
+    print(report.format(args.slowest))
+    if report.failed:
+        print('Archive not written')
+        return 1
+    return 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    if args.command == 'compile':
+        return command_compile(args)
+    if args.command == 'archive':
+        return command_archive(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -31,6 +31,8 @@ DEFAULT_INDENT_STRING = '    '
 DEFAULT_NEWLINE = '\n'
 DEFAULT_ENCODING = 'utf-8'
 
+LOOP_STATEMENTS = ('for', 'async for', 'while')
+
 log = logging.getLogger(__name__)
 
 
@@ -46,6 +48,12 @@ class CodeGen:
     imports = (
         'from pyhaa.runtime import encapsulate_exceptions as _ph_encapsulate_exceptions, TemplateInfo as _ph_TemplateInfo',
     )
+    # How generated partials pass their output - see runtime.TemplateInfo
+    output_mode = 'yield'
+    # Body of partial which has no contents
+    empty_body = 'if False: yield'
+    # Prepended to def keyword of generated partials
+    function_prefix = ''
 
     def __init__(self, structure, io, **kwargs):
         indent_string = or_if_none(kwargs.get('indent_string'), DEFAULT_INDENT_STRING)
@@ -73,8 +81,21 @@ class CodeGen:
         self.autoclosing_now = False
 
         self.written_partials = set()
+        # Whether currently written function is expected to be generator
+        # and whether it passed anything to output already
+        self.output_expected = False
+        self.output_written = False
         self.indent_level = 0
         self.ignore_code_level = 0
+        # Number of nodes written, reported to compile hooks
+        self.node_count = 0
+        # Mapping of generated code lines to template lines - tuples
+        # (first generated line, template line), written to template info
+        self.source_map = list()
+        self.source_lineno = None
+        self.generated_lineno = 0
+        # Node handling functions by name, None if there's no such one
+        self.node_handlers = dict()
 
     def indent(self, times=1):
         if times > 0:
@@ -84,23 +105,39 @@ class CodeGen:
         if self.indent_level and times > 0:
             self.indent_level -= min(times, self.indent_level)
 
-    def write_io(self, *args, indent_level=None):
+    def write_io(self, *args, indent_level=None, source_lineno=None):
         if indent_level is None:
             indent_level = self.indent_level
 
         if self.ignore_code_level:
             if indent_level >= self.ignore_code_level:
-                return
+                return False
             if self.indent_level < self.ignore_code_level:
                 self.ignore_code_level = 0
 
         if len(args) == 1 and hasattr(args[0], '__next__'):
             args, = args
+        if source_lineno is None:
+            source_lineno = self.source_lineno
         for arg in args:
-            if indent_level:
-                self.io.write(indent_level * self.indent_string)
-            self.io.write(arg.encode(self.encoding))
-            self.io.write(self.newline)
+            self.write_line(arg, indent_level, source_lineno)
+        return True
+
+    def write_line(self, line, indent_level, source_lineno):
+        self.map_line(source_lineno)
+        self.generated_lineno += line.count('\n') + 1
+        if indent_level:
+            self.io.write(indent_level * self.indent_string)
+        self.io.write(line.encode(self.encoding))
+        self.io.write(self.newline)
+
+    def map_line(self, source_lineno):
+        source_map = self.source_map
+        if source_map:
+            if source_map[-1][1] != source_lineno:
+                source_map.append((self.generated_lineno + 1, source_lineno))
+        elif source_lineno is not None:
+            source_map.append((self.generated_lineno + 1, source_lineno))
 
     def write_file_header(self):
         self.write_io(
@@ -128,7 +165,8 @@ class CodeGen:
         self.write_io(
             # Register template in template_info...
             '@_ph_template_info.register_partial',
-            'def {}(self, parent{}):'.format(
+            '{}def {}(self, parent{}):'.format(
+                self.function_prefix,
                 name,
                 attributes,
             ),
@@ -141,9 +179,17 @@ class CodeGen:
         self.indent()
 
         self.written_partials.add(name)
+        self.output_written = False
 
     def close_template_function(self, name):
-        self.dedent(2)
+        self.dedent()
+        if self.output_expected and not self.output_written:
+            # Optimizer may have removed all the output or left it only
+            # after return, but function still has to be a generator
+            self.write_io(
+                self.empty_body,
+            )
+        self.dedent()
         # This gets worse by time...
         # Remove so it doesn't get into globals so we can't
         # call it directly
@@ -157,8 +203,9 @@ class CodeGen:
         self.node_open(node)
         if len(node) == 0 and empty_iter:
             self.write_io(
-                'if False: yield',
+                self.empty_body,
             )
+            self.output_written = True
         else:
             self.write_root_node_contents(node, empty_iter)
         self.node_close(node)
@@ -198,11 +245,21 @@ class CodeGen:
         # Body
         self.write_root_node_function(self.structure.tree)
 
+    def template_attributes(self):
+        '''
+        Returns pairs (name, value) of constant template info attributes
+        '''
+        return [
+            ('encoding', self.encoding),
+            ('template_path', self.template_path),
+            ('template_name', self.template_name),
+            ('output_mode', self.output_mode),
+        ]
+
     def write_attributes(self):
         self.write_io(
-            'encoding = {},'.format(repr(self.encoding)),
-            'template_path = {},'.format(repr(self.template_path)),
-            'template_name = {},'.format(repr(self.template_name)),
+            '{} = {},'.format(name, repr(value))
+            for name, value in self.template_attributes()
         )
 
     def write_template_info(self):
@@ -220,18 +277,38 @@ class CodeGen:
             ')',
         )
 
+    def get_code(self):
+        '''
+        Returns generated code, after write was called
+        '''
+        return self.io.getvalue()
+
     def write(self):
         self.write_file_header()
         self.write_base_imports()
         self.write_template_info()
         self.write_partials()
+        self.write_source_map()
+
+    def write_source_map(self):
+        self.source_lineno = None
+        self.write_io(
+            '_ph_template_info.source_map = {}'.format(repr(tuple(self.source_map))),
+        )
 
     def node_open(self, node):
+        self.node_count += 1
+        if node.lineno is not None or isinstance(node, structure.PyhaaTree):
+            # Root nodes start new function - don't attribute it to
+            # previous one
+            self.source_lineno = node.lineno
         self.call_node_handling_function('open', node)
         if isinstance(node, structure.CompoundStatement):
             self.indent()
 
     def node_close(self, node):
+        if node.lineno is not None:
+            self.source_lineno = node.lineno
         self.call_node_handling_function('close', node)
         if isinstance(node, structure.CompoundStatement):
             self.dedent()
@@ -239,22 +316,29 @@ class CodeGen:
     def call_node_handling_function(self, prefix, node):
         if node is None: # pragma: no cover
             return
-        function_name = name_node_handling_function(prefix, node)
-        function = getattr(self, function_name, None)
+        key = (prefix, node.__class__)
+        try:
+            function = self.node_handlers[key]
+        except KeyError:
+            function_name = name_node_handling_function(prefix, node)
+            function = getattr(self, function_name, None)
+            if not function:
+                # Many nodes don't need e.g. closing, so it's not an error
+                log.debug("Couldn't find function %s for node %r.", function_name, node)
+            self.node_handlers[key] = function
         if function:
-            log.debug("Found function %s for node %r.", function_name, node)
             function(node)
-        else:
-            log.warning("Couldn't find function %s for node %r.", function_name, node)
 
     def handle_open_pyhaa_tree(self, node):
         self.open_template_function('__body__', '*arguments, **keywords')
+        self.output_expected = node.has_output()
 
     def handle_close_pyhaa_tree(self, node):
         self.close_template_function('__body__')
 
     def handle_open_pyhaa_partial(self, node):
         self.open_template_function(node.name, node.arguments)
+        self.output_expected = node.has_output()
 
     def handle_close_pyhaa_partial(self, node):
         self.close_template_function(node.name)
@@ -274,11 +358,11 @@ class CodeGen:
         self.write_io(
             node.content,
         )
-        if node.name in ('for', 'while'):
+        if node.name in LOOP_STATEMENTS:
             self.autoclose_open_loop()
 
     def handle_close_compound_statement(self, node):
-        if node.name in ('for', 'while'):
+        if node.name in LOOP_STATEMENTS:
             self.autoclose_pop_loop()
 
     # Autoclosing
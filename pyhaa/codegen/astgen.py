@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Codegen backends building python AST instead of writing source code, so
+compile doesn't tokenize and parse generated module again. Snippets of
+template code come from the cache filled by parser, and nodes get template
+lines right away, so there's no source map to apply. Source of generated
+module may still be seen with PyhaaEnvironment.debug_source.
+'''
+
+import ast
+import logging
+import re
+
+from ..utils.encode import single_encode
+from ..utils.snippets import (
+    locate_node,
+    parse_snippet,
+    place_snippet,
+)
+
+from .html import (
+    HTMLAsyncCodeGen,
+    HTMLCodeGen,
+    HTMLWriterCodeGen,
+)
+
+__all__ = (
+    'ASTCodeGenMixin',
+    'HTMLASTCodeGen',
+    'HTMLAsyncASTCodeGen',
+    'HTMLWriterASTCodeGen',
+)
+
+# Statements written as header line followed by indented block
+BLOCK_KEYWORDS = frozenset(('def', 'for', 'with', 'while', 'if', 'elif', 'else'))
+RE_BLOCK_KEYWORD = re.compile(r'(?:async\s+)?(\w+)\b')
+# Statements which may have else block
+ELSE_STATEMENTS = (ast.If, ast.For, ast.AsyncFor, ast.While)
+
+log = logging.getLogger(__name__)
+
+
+def name(id_):
+    return ast.Name(id=id_, ctx=ast.Load())
+
+def call(function, *args):
+    '''
+    Builds call of function with given name, arguments which are not nodes
+    are constants
+    '''
+    return ast.Call(
+        func = name(function),
+        args = [
+            arg if isinstance(arg, ast.AST) else ast.Constant(value=arg)
+            for arg in args
+        ],
+        keywords = [],
+    )
+
+def self_encoding():
+    return ast.Attribute(value=name('self'), attr='encoding', ctx=ast.Load())
+
+
+class ASTCodeGenMixin:
+    '''
+    Collects statements written by codegen into blocks of ast.Module,
+    following indent levels. Lines which codegen still writes as text
+    (boilerplate, statements and headers of compound statements from
+    template) are parsed as snippets, rest is built directly.
+    '''
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Statement lists of blocks open at every indent level, first one
+        # is module body
+        self.blocks = [[]]
+        # Last compound statement at every indent level, which may be
+        # continued with else or elif
+        self.last_compound = dict()
+        self.decorators = list()
+
+    def get_code(self):
+        return ast.Module(body=self.blocks[0], type_ignores=[])
+
+    def write_file_header(self):
+        # AST has no comments and isn't encoded
+        pass
+
+    def write_source_map(self):
+        # Nodes have template lines already
+        pass
+
+    def write_line(self, line, indent_level, source_lineno):
+        lineno = source_lineno or 1
+        if isinstance(line, ast.AST):
+            locate_node(line, lineno)
+            self.append_statement(line, indent_level)
+            return
+
+        line = line.strip()
+        if line.startswith('@'):
+            self.decorators.append(self.expression(line[1:], lineno))
+            return
+        match = RE_BLOCK_KEYWORD.match(line)
+        if match and match.group(1) in BLOCK_KEYWORDS and line.endswith(':'):
+            self.open_block(match.group(1), line, indent_level, lineno)
+            return
+        for statement in place_snippet(parse_snippet(line).body, lineno):
+            self.append_statement(statement, indent_level)
+
+    def append_statement(self, statement, indent_level):
+        blocks = self.blocks
+        if indent_level >= len(blocks):
+            raise SyntaxError('unexpected indent')
+        del blocks[indent_level+1:]
+        blocks[indent_level].append(statement)
+        self.last_compound[indent_level] = None
+
+    def open_block(self, keyword, line, indent_level, lineno):
+        '''
+        Places compound statement and opens block for its body
+        '''
+        if keyword in ('else', 'elif'):
+            compound = self.last_compound.get(indent_level)
+            continued = (ast.If,) if keyword == 'elif' else ELSE_STATEMENTS
+            if not isinstance(compound, continued) or compound.orelse or indent_level >= len(self.blocks):
+                raise SyntaxError("'{}' doesn't follow compound statement".format(keyword))
+            del self.blocks[indent_level+1:]
+            if keyword == 'else':
+                self.last_compound[indent_level] = None
+                self.blocks.append(compound.orelse)
+                return
+            # elif is if statement in else block
+            line = 'if' + line[len(keyword):]
+
+        # Parse header with block, so it may be cached like other snippets
+        statement, = place_snippet(parse_snippet(line + '\n pass').body, lineno)
+        statement.body = []
+        if keyword == 'elif':
+            compound.orelse.append(statement)
+        else:
+            if keyword == 'def':
+                statement.decorator_list = self.decorators
+                self.decorators = list()
+            self.append_statement(statement, indent_level)
+        self.last_compound[indent_level] = statement
+        self.blocks.append(statement.body)
+
+    def expression(self, code, lineno=None):
+        '''
+        Returns expression node of given code, placed at current line
+        '''
+        if lineno is None:
+            lineno = self.source_lineno or 1
+        code = code.strip()
+        try:
+            body = parse_snippet(code).body
+        except SyntaxError:
+            body = None
+        if not (body and len(body) == 1 and isinstance(body[0], ast.Expr)):
+            # As if text codegen put it in parentheses
+            body = parse_snippet('(' + code + ')').body
+        return place_snippet(body[0].value, lineno)
+
+    def write_template_info(self):
+        keywords = [
+            ast.keyword(arg=key, value=ast.Constant(value=value))
+            for key, value in self.template_attributes()
+        ]
+        keywords.append(ast.keyword(
+            arg = 'inheritance',
+            value = ast.Lambda(
+                args = ast.arguments(
+                    posonlyargs = [],
+                    args = [],
+                    kwonlyargs = [],
+                    kw_defaults = [],
+                    defaults = [],
+                ),
+                body = ast.Tuple(
+                    elts = [
+                        self.expression(inherits)
+                        for inherits in self.structure.inheritance
+                    ],
+                    ctx = ast.Load(),
+                ),
+            ),
+        ))
+        self.write_io(ast.Assign(
+            targets = [ast.Name(id='_ph_template_info', ctx=ast.Store())],
+            value = ast.Call(func=name('_ph_TemplateInfo'), args=[], keywords=keywords),
+        ))
+
+    def output_statement(self, value):
+        '''
+        Returns statement passing value of given expression node to output
+        '''
+        return ast.Expr(value=ast.Yield(value=value))
+
+    def write_output(self, code, **kwargs):
+        if isinstance(code, str):
+            code = self.expression(code)
+        if self.write_io(
+            self.output_statement(code),
+            **kwargs
+        ):
+            self.output_written = True
+
+
+class HTMLASTCodeGen(ASTCodeGenMixin, HTMLCodeGen):
+    def literal(self, value):
+        return ast.Constant(value=value)
+
+    def write_split_tag(self, parts):
+        for part in parts:
+            if isinstance(part, bytes):
+                self.write_simple_bytes(part)
+                continue
+            self.write_output(call(
+                '_ph_tag_attributes',
+                ast.Tuple(
+                    elts = [
+                        ast.Tuple(
+                            elts = [
+                                ast.Constant(value=b' ' + single_encode(key, True, True, self.encoding) + b'="'),
+                                ast.Constant(value=single_encode(key, True, True, self.encoding)),
+                                self.expression(code),
+                            ],
+                            ctx = ast.Load(),
+                        )
+                        for key, code in part
+                    ],
+                    ctx = ast.Load(),
+                ),
+                self.encoding,
+            ))
+
+    def handle_open_expression(self, node):
+        self.write_output(call(
+            '_ph_single_encode',
+            self.expression(node.content),
+            True,
+            node.escape,
+            self_encoding(),
+            True,
+            True,
+        ))
+
+
+class HTMLAsyncASTCodeGen(HTMLASTCodeGen, HTMLAsyncCodeGen):
+    def handle_open_expression(self, node):
+        self.write_output(call(
+            '_ph_async_encode',
+            self.expression(node.content),
+            node.escape,
+            self_encoding(),
+        ))
+
+
+class HTMLWriterASTCodeGen(HTMLASTCodeGen, HTMLWriterCodeGen):
+    def output_statement(self, value):
+        return ast.Expr(value=call('_ph_write', value))
+
+    def handle_open_expression(self, node):
+        self.write_io(ast.Expr(value=call(
+            '_ph_write_value',
+            name('_ph_write'),
+            self.expression(node.content),
+            node.escape,
+            self.encoding,
+        )))
@@ -18,6 +18,7 @@
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import ast
 import logging
 
 from  .. import structure
@@ -25,6 +26,7 @@ from ..utils.cgrt_common import (
     close_tag,
     open_tag,
     prepare_for_tag,
+    tag_attributes,
 )
 from ..utils.encode import single_encode
 
@@ -34,8 +36,9 @@ log = logging.getLogger(__name__)
 
 class HTMLCodeGen(CodeGen):
     imports = CodeGen.imports + (
+        'from pyhaa.runtime import FLUSH as _ph_FLUSH',
         'from pyhaa.utils.encode import single_encode as _ph_single_encode',
-        'from pyhaa.runtime.html import _ph_open_tag, _ph_close_tag',
+        'from pyhaa.runtime.html import _ph_open_tag, _ph_close_tag, _ph_tag_attributes',
     )
     void_tags = set((
         'area',
@@ -55,12 +58,20 @@ class HTMLCodeGen(CodeGen):
         'track',
         'wbr',
     ))
+    # Attributes affecting tag name, id or classes
+    special_attributes = set((
+        'id',
+        'class',
+    ))
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        # Tags with python attributes which name is known at compile time
+        self.fixed_name_tags = set()
         self.tag_name_stack = list()
         self.simple_bytes = list()
         self.simple_bytes_indent_level = self.indent_level
+        self.simple_bytes_lineno = None
         self.last_was_text = False
 
     def call_node_handling_function(self, prefix, node):
@@ -71,20 +82,33 @@ class HTMLCodeGen(CodeGen):
         if self.simple_bytes_indent_level != self.indent_level:
             self.flush_simple_bytes()
             self.simple_bytes_indent_level = self.indent_level
+        if not self.simple_bytes:
+            # Merged bytes are attributed to line they start at
+            self.simple_bytes_lineno = self.source_lineno
         self.simple_bytes.extend(args)
 
     def flush_simple_bytes(self):
         if self.simple_bytes:
-            self.write_io(
-                'yield {}'.format(repr(b''.join(self.simple_bytes))),
+            self.write_output(
+                self.literal(b''.join(self.simple_bytes)),
                 flush_simple_bytes = False,
                 indent_level = self.simple_bytes_indent_level,
+                source_lineno = self.simple_bytes_lineno,
             )
             del self.simple_bytes[::]
 
+    def write_output(self, code, **kwargs):
+        '''
+        Writes code passing bytes returned by given expression to output
+        '''
+        if self.write_io(
+            'yield {}'.format(code),
+            **kwargs
+        ):
+            self.output_written = True
+
     def write_io(self, *args, flush_simple_bytes = True, **kwargs):
         if flush_simple_bytes:
-            log.debug('Flushing simple bytes')
             self.flush_simple_bytes()
         return super().write_io(*args, **kwargs)
 
@@ -104,6 +128,113 @@ class HTMLCodeGen(CodeGen):
     def tag_is_static(self, node):
         return not node.attributes_set or len(node.attributes_set) == 1 and not isinstance(node.attributes_set[0], str)
 
+    def python_attributes_keys(self, attributes):
+        '''
+        Returns list of (key, value code) pairs of python attributes if
+        they're given as dict literal with constant string keys.
+        Otherwise keys are not known at compile time and None is returned.
+        '''
+        attributes = attributes.strip()
+        try:
+            tree = ast.parse(attributes, mode='eval')
+        except SyntaxError: # pragma: no cover
+            return None
+        if not isinstance(tree.body, ast.Dict):
+            return None
+        result = list()
+        for key, value in zip(tree.body.keys, tree.body.values):
+            if not (isinstance(key, ast.Constant) and isinstance(key.value, str)):
+                # Either unpacking (**) or computed key
+                return None
+            result.append((key.value, ast.get_source_segment(attributes, value)))
+        return result
+
+    def split_tag(self, node):
+        '''
+        Splits tag with python attributes into list of static bytes and
+        lists of (key, value code) pairs of dynamic attributes. Possible only
+        if python attributes don't touch tag name, id or classes, and no
+        attribute is set twice. Returns tuple (is name fixed, name, parts),
+        where parts is None if tag can't be split.
+        '''
+        static_sets = list()
+        dynamic_sets = list()
+        name_fixed = True
+        splittable = True
+        keys = set()
+        for attributes in node.attributes_set:
+            if isinstance(attributes, str):
+                dynamic = self.python_attributes_keys(attributes)
+                if dynamic is None:
+                    return False, None, None
+                for key, _ in dynamic:
+                    if key == '_tag_name':
+                        return False, None, None
+                    if key in keys or key.startswith('_') or key in self.special_attributes:
+                        splittable = False
+                    keys.add(key)
+                dynamic_sets.append(dynamic)
+            else:
+                for key in attributes:
+                    if key in keys:
+                        splittable = False
+                    if not (key.startswith('_') or key in self.special_attributes):
+                        keys.add(key)
+                static_sets.append(attributes)
+
+        name, static_attributes = prepare_for_tag(node.name, node.id_, node.classes, static_sets, True, True, self.encoding)
+        if not splittable:
+            return name_fixed, name, None
+
+        self_close = self.tag_is_self_closing(node)
+        special = set(
+            single_encode(key, True, True, self.encoding)
+            for key in self.special_attributes
+        )
+        parts = [b'<' + name]
+        dynamic_sets = iter(dynamic_sets)
+        for attributes in node.attributes_set:
+            if isinstance(attributes, str):
+                parts.append(next(dynamic_sets))
+                continue
+            _, attributes = prepare_for_tag(None, None, None, (attributes,), True, True, self.encoding)
+            parts.append(b''.join(tag_attributes({
+                key: value
+                for key, value in attributes.items()
+                if key not in special
+            })))
+        parts.append(b''.join(tag_attributes({
+            key: value
+            for key, value in static_attributes.items()
+            if key in special
+        })))
+        parts.append(b' />' if self_close else b'>')
+        return name_fixed, name, parts
+
+    def write_split_tag(self, parts):
+        for part in parts:
+            if isinstance(part, bytes):
+                self.write_simple_bytes(part)
+                continue
+            self.write_output(
+                '_ph_tag_attributes(({}), {})'.format(
+                    ''.join((
+                        '({}, {}, ({})), '.format(
+                            repr(b' ' + single_encode(key, True, True, self.encoding) + b'="'),
+                            self.byterepr(key),
+                            code,
+                        )
+                        for key, code in part
+                    )),
+                    repr(self.encoding),
+                ),
+            )
+
+    def close_template_function(self, name):
+        # Bytes left at the end of function are output too
+        self.flush_simple_bytes()
+        super().close_template_function(name)
+
     def open_template_function(self, *args, **kwargs):
         super(HTMLCodeGen, self).open_template_function(*args, **kwargs)
         self.write_io(
@@ -125,7 +256,6 @@ class HTMLCodeGen(CodeGen):
 
     def close_tag(self):
         tag_name = self.tag_name_stack.pop()
-        log.debug('closing tag %s', tag_name)
         self.write_simple_bytes(
             b''.join(close_tag(tag_name)),
         )
@@ -141,9 +271,15 @@ class HTMLCodeGen(CodeGen):
                 node.attributes_set,
                 self_close,
             )
+            return
+
+        name_fixed, name, parts = self.split_tag(node)
+        if parts:
+            self.write_split_tag(parts)
         else:
-            self.write_io(
-                'yield _ph_open_tag(_ph_tag_name_stack, {}, {}, {}, {}, {}, {})'.format(
+            self.write_output(
+                '_ph_open_tag({}, {}, {}, {}, {}, {}, {})'.format(
+                    'None' if name_fixed else '_ph_tag_name_stack',
                     self.byterepr(node.name),
                     self.byterepr(node.id_),
                     self.byterepr(node.classes or None),
@@ -159,16 +295,20 @@ class HTMLCodeGen(CodeGen):
                     repr(self.encoding),
                 ),
             )
+        if name_fixed:
+            self.fixed_name_tags.add(node)
+            if not self_close:
+                self.tag_name_stack.append(name)
 
     def handle_close_tag(self, node):
         self.autoclose_close_node()
         if self.tag_is_self_closing(node):
             return
-        if self.tag_is_static(node):
+        if self.tag_is_static(node) or node in self.fixed_name_tags:
             self.close_tag()
         else:
-            self.write_io(
-                'yield _ph_close_tag(_ph_tag_name_stack)',
+            self.write_output(
+                '_ph_close_tag(_ph_tag_name_stack)',
             )
 
     def handle_open_text(self, node):
@@ -181,13 +321,19 @@ class HTMLCodeGen(CodeGen):
         )
 
     def handle_open_expression(self, node):
-        self.write_io(
-            'yield _ph_single_encode(({}), True, {}, self.encoding, True, True)'.format(
+        self.write_output(
+            '_ph_single_encode(({}), True, {}, self.encoding, True, True)'.format(
                 node.content,
                 repr(node.escape),
             ),
         )
 
+    def literal(self, value):
+        '''
+        Returns code of constant value
+        '''
+        return repr(value)
+
     def byterepr(self, value):
         return repr(single_encode(value, True, True, self.encoding))
 
@@ -204,3 +350,74 @@ class HTMLCodeGen(CodeGen):
         super().autoclose_close_loop()
         self.tag_name_stack = tmp_tags
 
+
+class HTMLAsyncCodeGen(HTMLCodeGen):
+    '''
+    Generates partials being async generators, so template code may use
+    await expressions and async for loops. Render them with
+    pyhaa.shorthands.html_render_async.
+    '''
+    imports = HTMLCodeGen.imports + (
+        'from pyhaa.runtime.html import _ph_async_encode',
+    )
+    output_mode = 'async'
+    function_prefix = 'async '
+
+    def handle_open_expression(self, node):
+        self.write_output(
+            '_ph_async_encode(({}), {}, self.encoding)'.format(
+                node.content,
+                repr(node.escape),
+            ),
+        )
+
+
+class HTMLWriterCodeGen(HTMLCodeGen):
+    '''
+    Generates partials which don't yield their output, but pass it directly
+    to callable bound with pyhaa.runtime.bind_writer. Partials called
+    from expressions write their output immediately and return empty bytes
+    (or value given to return statement).
+    '''
+    imports = HTMLCodeGen.imports + (
+        'from pyhaa.runtime import current_writer as _ph_current_writer',
+        'from pyhaa.runtime.html import _ph_write_value',
+    )
+    output_mode = 'write'
+    empty_body = 'pass'
+
+    def open_template_function(self, *args, **kwargs):
+        super(HTMLWriterCodeGen, self).open_template_function(*args, **kwargs)
+        self.write_io(
+            '_ph_write = _ph_current_writer.get()',
+        )
+
+    def write_output(self, code, **kwargs):
+        self.write_io(
+            '_ph_write({})'.format(code),
+            **kwargs
+        )
+
+    def close_template_function(self, name):
+        # Partial called from expression has already written its output,
+        # so by default it returns nothing to be written again
+        self.dedent()
+        self.write_io("return b''")
+        self.dedent()
+        self.write_io('del {}'.format(name))
+
+    def handle_open_simple_statement(self, node):
+        if node.content.strip() == 'return':
+            replacement = structure.SimpleStatement(content="return b''")
+            replacement.lineno = node.lineno
+            node = replacement
+        super().handle_open_simple_statement(node)
+
+    def handle_open_expression(self, node):
+        self.write_io(
+            '_ph_write_value(_ph_write, ({}), {}, {})'.format(
+                node.content,
+                repr(node.escape),
+                repr(self.encoding),
+            ),
+        )
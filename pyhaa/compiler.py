@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Ahead-of-time compilation of templates into bytecode cache
+'''
+
+from concurrent.futures import as_completed, ProcessPoolExecutor
+import logging
+import marshal
+import os
+import time
+
+from .environment import PyhaaEnvironment
+from .runtime.archive import ArchiveWriter
+from .runtime.loaders import FilesystemLoader
+
+__all__ = (
+    'build_archive',
+    'CompilationReport',
+    'compile_templates',
+    'find_templates',
+)
+
+log = logging.getLogger(__name__)
+
+STAGES = ('load', 'parse', 'codegen', 'compile')
+
+# Environment of worker process
+_environment = None
+
+
+def find_templates(loader, extension='.pha'):
+    '''
+    Returns sorted list of paths of all templates in loader search paths
+    '''
+    paths = set()
+    for curpath in loader.paths:
+        for dirpath, _, filenames in os.walk(curpath):
+            for filename in filenames:
+                if filename.endswith(extension):
+                    path = os.path.relpath(os.path.join(dirpath, filename), curpath)
+                    paths.add(path.replace(os.sep, '/'))
+    return sorted(paths)
+
+def init_worker(environment_options, loader_options):
+    global _environment
+    _environment = PyhaaEnvironment(
+        loader = FilesystemLoader(**loader_options),
+        **environment_options
+    )
+
+def compile_template(path):
+    '''
+    Compiles template in worker process. Returns tuple (path, marshalled
+    bytecode, token, timings of stages, source).
+    '''
+    environment = _environment
+    loader = environment.loader
+    timings = dict()
+
+    start = time.perf_counter()
+    fp, filename, token = loader.get_source_code(path, environment)
+    with fp:
+        source = fp.read()
+    timings['load'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    structure = environment.parse_string(source)
+    timings['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    code = environment.codegen_structure(structure, template_path = path)
+    timings['codegen'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    bytecode = environment.compile_code(code, filename, path)
+    timings['compile'] = time.perf_counter() - start
+
+    return path, marshal.dumps(bytecode), token, timings, source
+
+
+class CompilationReport:
+    def __init__(self):
+        self.compiled = dict()
+        self.skipped = list()
+        self.failed = dict()
+        self.wall_time = 0
+
+    def stage_totals(self):
+        return {
+            stage: sum(timings[stage] for timings in self.compiled.values())
+            for stage in STAGES
+        }
+
+    def format(self, slowest=10):
+        lines = [
+            'Compiled {}, skipped {}, failed {} templates in {:.3f}s'.format(
+                len(self.compiled),
+                len(self.skipped),
+                len(self.failed),
+                self.wall_time,
+            ),
+        ]
+        totals = self.stage_totals()
+        lines.extend(
+            '  {:<8} {:.3f}s'.format(stage, totals[stage])
+            for stage in STAGES
+        )
+        if self.compiled and slowest:
+            lines.append('Slowest templates:')
+            ordered = sorted(
+                self.compiled.items(),
+                key = lambda item: sum(item[1].values()),
+                reverse = True,
+            )
+            lines.extend(
+                '  {:.3f}s {} ({})'.format(
+                    sum(timings.values()),
+                    path,
+                    ', '.join(
+                        '{} {:.3f}s'.format(stage, timings[stage])
+                        for stage in STAGES
+                    ),
+                )
+                for path, timings in ordered[:slowest]
+            )
+        for path, error in sorted(self.failed.items()):
+            lines.append('Failed {}: {}'.format(path, error))
+        return '\n'.join(lines)
+
+
+def compile_templates(
+    bytecode_cache,
+    loader_options,
+    environment_options = None,
+    paths = None,
+    incremental = False,
+    jobs = None,
+    extension = '.pha',
+    store = None,
+):
+    '''
+    Compiles templates found in search paths given in loader_options
+    (arguments of FilesystemLoader) in worker processes and stores them in
+    given bytecode cache. In incremental mode templates already cached
+    with valid token are skipped. Instead of cache, store function
+    may be given, called with path, marshalled bytecode, token and source
+    of every template. Returns CompilationReport.
+    '''
+    environment_options = environment_options or dict()
+    report = CompilationReport()
+    start = time.perf_counter()
+
+    loader = FilesystemLoader(**loader_options)
+    environment = PyhaaEnvironment(loader = loader, **environment_options)
+    key = environment.compilation_key()
+    if paths is None:
+        paths = find_templates(loader, extension)
+
+    if store is None:
+        def store(path, bytecode, token, source):
+            bytecode_cache.store(path, marshal.loads(bytecode), token, key)
+
+    if incremental and bytecode_cache:
+        pending = list()
+        for path in paths:
+            cached = bytecode_cache.get(path, key)
+            if cached and not loader.is_expired(path, environment, cached[1]):
+                report.skipped.append(path)
+            else:
+                pending.append(path)
+        paths = pending
+
+    if paths:
+        with ProcessPoolExecutor(
+            max_workers = jobs,
+            initializer = init_worker,
+            initargs = (environment_options, loader_options),
+        ) as executor:
+            futures = {
+                executor.submit(compile_template, path): path
+                for path in paths
+            }
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    path, bytecode, token, timings, source = future.result()
+                except Exception as exc:
+                    log.debug('Failed to compile %s', path, exc_info=True)
+                    report.failed[path] = exc
+                    continue
+                store(path, bytecode, token, source)
+                report.compiled[path] = timings
+
+    report.wall_time = time.perf_counter() - start
+    return report
+
+def build_archive(archive_path, loader_options, environment_options = None, jobs = None, extension = '.pha'):
+    '''
+    Compiles all templates into archive read by ArchiveLoader. Archive
+    is replaced atomically, and only if all templates were compiled.
+    Returns CompilationReport.
+    '''
+    environment = PyhaaEnvironment(**(environment_options or dict()))
+    writer = ArchiveWriter(archive_path, environment.compilation_key())
+    try:
+        report = compile_templates(
+            None,
+            loader_options,
+            environment_options,
+            jobs = jobs,
+            extension = extension,
+            store = lambda path, bytecode, token, source: writer.add(path, bytecode, source),
+        )
+    except Exception:
+        writer.abort()
+        raise
+    if report.failed:
+        writer.abort()
+    else:
+        writer.commit()
+    return report
@@ -18,14 +18,33 @@
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import ast
+import copy
+from collections import Counter
+from contextlib import contextmanager
 import io
+import os.path
 import posixpath
+from threading import BoundedSemaphore, Lock
+import time
+from weakref import WeakKeyDictionary
 
+from .optimizer import Optimizer
 from .utils import sequence_flatten
+from .utils.sourcemap import (
+    acquire_source,
+    decode_code,
+    discard_source,
+    find_source_map,
+    register_source,
+    remap_lines,
+    source_filename,
+)
 from .runtime.proxy import InstanceProxy
 
 __all__ = (
     'PyhaaEnvironment',
+    'TemplateHandle',
 )
 
 class PyhaaEnvironment:
@@ -37,6 +56,10 @@ class PyhaaEnvironment:
         output_encoding='utf-8',
         auto_reload = True,
         template_globals = None,
+        optimization_level = 1,
+        optimizer_passes = None,
+        max_concurrent_compilations = None,
+        remap_lines = True,
     ):
         if not parser_class:
             from .parsing.parser import PyhaaParser
@@ -52,8 +75,64 @@ class PyhaaEnvironment:
         self.output_encoding = output_encoding
         self.auto_reload = auto_reload
         self.template_globals = template_globals or dict()
+        # Level 0 disables optimizer; passes may be None for default set
+        self.optimizer = Optimizer(optimizer_passes, optimization_level)
+        # Memoized inheritance chains - template info to dict of its parent
+        # paths to rest of chain. Keys are weak, so chains are forgotten
+        # together with templates evicted from loader caches.
+        self.inheritance_chains = WeakKeyDictionary()
+        # Template infos compiled for inheritance chains, see
+        # specialize_chain - first template info of chain to dict of paths
+        # and tokens of rest of chain to compiled template infos
+        self.specializations = WeakKeyDictionary()
+        # Parsed structures of templates along with their file names,
+        # reused by specialize_chain
+        self.parsed_structures = WeakKeyDictionary()
+        # Guards memoized chains and specializations - loader threads
+        # expire templates while others look chains up
+        self.chains_lock = Lock()
+        self.compilation_semaphore = None
+        if max_concurrent_compilations:
+            self.compilation_semaphore = BoundedSemaphore(max_concurrent_compilations)
+        # Callables reporting compile pipeline - see add_compile_hook
+        self.compile_hooks = list()
+        # If set, line numbers of compiled templates are lines of template
+        # source, otherwise of generated code
+        self.remap_lines = remap_lines
+
+    def add_compile_hook(self, hook):
+        '''
+        Registers callable called after every stage of compiling templates
+        as hook(stage, template_path, duration, **details). Stages are:
+        load (loader reading source), bytecode_cache (details: hit),
+        parse, optimize, codegen (details: nodes, code_size - None if
+        codegen builds AST), compile and
+        exec (creating template info from bytecode). Stages aren't timed
+        at all if there are no hooks.
+        '''
+        self.compile_hooks.append(hook)
 
-    def get_template_info(self, path, current_path=None):
+    def remove_compile_hook(self, hook):
+        self.compile_hooks.remove(hook)
+
+    def report_stage(self, stage, template_path, start, **details):
+        duration = time.perf_counter() - start
+        for hook in self.compile_hooks:
+            hook(stage, template_path, duration, **details)
+
+    @contextmanager
+    def compilation_slot(self):
+        '''
+        Limits number of templates compiled at once, if
+        max_concurrent_compilations is set
+        '''
+        if not self.compilation_semaphore:
+            yield
+            return
+        with self.compilation_semaphore:
+            yield
+
+    def normalize_path(self, path, current_path=None):
         if current_path and not path.startswith('/'):
             path = posixpath.join(current_path, path)
 
@@ -64,78 +143,122 @@ class PyhaaEnvironment:
         if path.startswith('..'):
             # TODO Raise proper exception
             raise Exception
+        return path
 
+    def get_template_info(self, path, current_path=None):
+        path = self.normalize_path(path, current_path)
         return self.loader.get_template_info(path, self)
 
     def get_inheritance_chain(self, template_info):
         '''
         Returns "teplate precedence list"
         Inheritance linearization works as in C3 algorithm, used in Python itself.
+        Chains are memoized until any of their members gets reloaded.
+        '''
+        key = tuple(sequence_flatten(template_info.inheritance()))
+        with self.chains_lock:
+            chains = self.inheritance_chains.get(template_info)
+            # Template info itself isn't stored, it would keep weak key alive
+            parents = chains.get(key) if chains else None
+        if parents is not None:
+            chain = [template_info]
+            chain.extend(parents)
+            if self.is_chain_current(chain):
+                return chain
+            with self.chains_lock:
+                if chains.get(key) is parents:
+                    del chains[key]
+
+        # Templates get loaded, so lock isn't held meanwhile
+        chain = self.linearize_inheritance(template_info)
+        if template_info.template_path is not None:
+            # Templates not coming from loader are never invalidated
+            with self.chains_lock:
+                self.inheritance_chains.setdefault(template_info, dict())[key] = tuple(chain[1:])
+        return chain
+
+    def is_chain_current(self, chain):
+        # First template is the one we were asked for
+        for template_info in chain[1:]:
+            if not self.loader.is_current(template_info.template_path, self, template_info):
+                return False
+        return True
+
+    def template_expired(self, template_info):
         '''
+        Called by loader when template gets reloaded or removed from cache.
+        Forgets inheritance chains containing given template and chains
+        specialized for it.
+        '''
+        path = template_info.template_path
+        with self.chains_lock:
+            self.inheritance_chains.pop(template_info, None)
+            for chains in list(self.inheritance_chains.values()):
+                for key, parents in list(chains.items()):
+                    if template_info in parents:
+                        del chains[key]
+            self.parsed_structures.pop(template_info, None)
+            self.specializations.pop(template_info, None)
+            for specializations in list(self.specializations.values()):
+                for key in list(specializations):
+                    if any(member_path == path for member_path, _ in key):
+                        del specializations[key]
+
+    def linearize_inheritance(self, template_info):
         templates = dict()
+        linearized = dict()
         onpath = set()
 
-        def in_tail(what, where, whence):
-            try:
-                return where.index(what) > whence
-            except ValueError:
-                return False
-
         def merge_inheritance(list_):
-            # Do as in cpython's typeobject.c - store positions, don't pop from lists
+            # Do as in cpython's typeobject.c - store positions, don't pop
+            # from lists, and count in how many tails is every template
             positions = [0]*len(list_)
-            empty = 0
-            cont = True
-            while cont:
-                cont = False
+            tails = Counter(
+                template
+                for lst in list_
+                for template in lst[1:]
+            )
+            while True:
                 for idx, lst in enumerate(list_):
                     pos = positions[idx]
-
-                    # Check if list is empty
                     if pos >= len(lst):
-                        # it's empty
-                        empty += 1
                         continue
-
                     head = lst[pos]
-
                     # check if candidate is in tail of any of the lists
-                    found_tail = False
-                    for lst in list_:
-                        if in_tail(head, lst, pos):
-                            found_tail = True
-                            break
-                    if found_tail:
-                        continue
-
-                    # yield it to line
-                    yield head
-
-                    # remove candidate from heads
-                    for idx, lst in enumerate(list_):
-                        pos = positions[idx]
-                        if pos < len(lst) and lst[pos] == head:
-                            positions[idx] = pos + 1
-
-                    cont = True
-                    break
-
-            if empty == len(list_):
-                # OK, we emptied all the lists
-                return
-            raise Exception('Failed to resolve inheritance precedence')
+                    if not tails[head]:
+                        break
+                else:
+                    if all(pos >= len(lst) for pos, lst in zip(positions, list_)):
+                        # OK, we emptied all the lists
+                        return
+                    raise Exception('Failed to resolve inheritance precedence')
+
+                # yield it to line
+                yield head
+
+                # remove candidate from heads
+                for idx, lst in enumerate(list_):
+                    pos = positions[idx]
+                    if pos < len(lst) and lst[pos] is head:
+                        pos += 1
+                        positions[idx] = pos
+                        if pos < len(lst):
+                            tails[lst[pos]] -= 1
 
         def load_inheritance(template_info):
+            inheritance = linearized.get(template_info)
+            if inheritance is not None:
+                return inheritance
             inheritance = [template_info]
             parents = templates[template_info]
-            if not parents:
-                return inheritance
-            loaded = [
-                load_inheritance(pinfo)
-                for pinfo in parents
-            ]
-            loaded.append(parents)
-            inheritance.extend(merge_inheritance(loaded))
+            if parents:
+                loaded = [
+                    load_inheritance(pinfo)
+                    for pinfo in parents
+                ]
+                loaded.append(parents)
+                inheritance.extend(merge_inheritance(loaded))
+            linearized[template_info] = inheritance
             return inheritance
 
         def load_template_infos(template_info):
@@ -157,7 +280,7 @@ class PyhaaEnvironment:
 
         # Load all templates in inheritance tree
         load_template_infos(template_info)
-        return load_inheritance(template_info)
+        return list(load_inheritance(template_info))
 
     def get_template(self, path, current_path=None):
         '''
@@ -165,14 +288,111 @@ class PyhaaEnvironment:
         '''
         template_info = self.get_template_info(path, current_path)
         linearized = self.get_inheritance_chain(template_info)
+        return self.instance_from_chain(linearized)
+
+    def get_template_handle(self, path, current_path=None):
+        '''
+        Returns handle of template which may be kept and rendered many times
+        '''
+        return TemplateHandle(self, self.normalize_path(path, current_path))
+
+    def instance_from_chain(self, linearized):
+        if self.optimizer.needs_partials():
+            linearized = self.specialize_chain(linearized)
         return InstanceProxy(linearized, self)
 
     def get_template_from_string(self, string, **kwargs):
-        structure = self.parse_string(string)
+        structure = self.parse_any(string)
         code = self.codegen_structure(structure, **kwargs)
-        bytecode = compile(code, '<string>', 'exec')
+        bytecode = self.compile_code(code, '<string>', source=string)
         template_info = self.template_info_from_bytecode(bytecode)
-        return InstanceProxy([template_info], self)
+        linearized = [template_info]
+        if self.optimizer.needs_partials():
+            if structure.inheritance:
+                linearized = self.get_inheritance_chain(template_info)
+            linearized = self.specialize_chain(linearized, [string], **kwargs)
+        return InstanceProxy(linearized, self)
+
+    def specialize_chain(self, chain, sources=(), **kwargs):
+        '''
+        Recompiles templates of inheritance chain knowing which partials
+        self attributes resolve to, so optimizer may inline them.
+        Resulting template infos may be used only within given chain.
+        Sources of templates may be given, rest is loaded using loader.
+        Results are kept until any template in chain expires.
+        '''
+        key = self.chain_tokens(chain)
+        if key is not None:
+            with self.chains_lock:
+                specializations = self.specializations.get(chain[0])
+                specialized = specializations.get(key) if specializations else None
+            if specialized:
+                return specialized
+
+        with self.compilation_slot():
+            specialized = self.compile_chain(chain, sources, **kwargs)
+        if key is not None:
+            with self.chains_lock:
+                self.specializations.setdefault(chain[0], dict())[key] = specialized
+        return specialized
+
+    def chain_tokens(self, chain):
+        '''
+        Returns paths and tokens of templates in chain after the first one,
+        or None if any of them isn't cached by loader anymore
+        '''
+        tokens = list()
+        for template_info in chain[1:]:
+            path = template_info.template_path
+            token = self.loader.get_token(path, template_info)
+            if token is None:
+                return None
+            tokens.append((path, token))
+        return tuple(tokens)
+
+    def compile_chain(self, chain, sources=(), **kwargs):
+        structures = list()
+        filenames = list()
+        for idx, template_info in enumerate(chain):
+            parsed = self.parsed_structures.get(template_info)
+            if parsed is None:
+                if idx < len(sources):
+                    source, filename = sources[idx], '<string>'
+                else:
+                    source, filename, _ = self.loader.get_source_code(template_info.template_path, self)
+                structure = self.parse_any(source, template_info.template_path)
+                self.parsed_structures[template_info] = (structure, filename)
+            else:
+                structure, filename = parsed
+            # Optimizer rewrites structures in place
+            structures.append(copy.deepcopy(structure))
+            filenames.append(filename)
+
+        # Same order as in NamespaceLookup: template info attributes, then
+        # partials of templates in chain
+        partials = dict()
+        for structure in reversed(structures):
+            partials.update(structure.partials)
+        for name in list(partials):
+            if hasattr(chain[0], name):
+                del partials[name]
+
+        specialized = list()
+        for idx, (template_info, structure, filename) in enumerate(zip(chain, structures, filenames)):
+            code = self.codegen_structure(
+                structure,
+                partials = partials,
+                **dict(
+                    kwargs,
+                    template_path = template_info.template_path,
+                    template_name = template_info.template_name,
+                    encoding = template_info.encoding,
+                )
+            )
+            source = sources[idx] if idx < len(sources) else None
+            bytecode = self.compile_code(code, filename, template_info.template_path, source)
+            specialized.append(self.template_info_from_bytecode(bytecode))
+        return specialized
 
     def parse_readline(self, readline):
         parser = self.parser_class()
@@ -188,7 +408,15 @@ class PyhaaEnvironment:
     def parse_string(self, string):
         return self.parse_io(io.StringIO(string))
 
-    def parse_any(self, source):
+    def parse_any(self, source, template_path=None):
+        if self.compile_hooks:
+            start = time.perf_counter()
+            structure = self._parse_any(source)
+            self.report_stage('parse', template_path, start)
+            return structure
+        return self._parse_any(source)
+
+    def _parse_any(self, source):
         if isinstance(source, io.IOBase) or hasattr(source, 'readline'):
             return self.parse_io(source)
 
@@ -202,18 +430,167 @@ class PyhaaEnvironment:
         #if hasattr(source, '__next__'): #iter2readline(source)
         #if hasattr(source, '__iter__'): #iter2readline(iter(source))
 
-    def codegen_structure(self, structure, **kwargs):
+    def optimize_structure(self, structure, **context):
+        return self.optimizer.optimize(structure, **context)
+
+    def codegen_structure(self, structure, partials=None, **kwargs):
+        hooks = self.compile_hooks
+        template_path = kwargs.get('template_path')
+        if hooks:
+            start = time.perf_counter()
+        structure = self.optimize_structure(structure, partials=partials)
+        if hooks:
+            self.report_stage('optimize', template_path, start)
+            start = time.perf_counter()
         bio = io.BytesIO()
         kwargs.setdefault('encoding', self.output_encoding)
         cg = self.codegen_class(structure, bio, **kwargs)
         cg.write()
-        return bio.getvalue()
+        code = cg.get_code()
+        if hooks:
+            self.report_stage(
+                'codegen',
+                template_path,
+                start,
+                nodes = cg.node_count,
+                code_size = len(code) if isinstance(code, bytes) else None,
+            )
+        return code
+
+    def debug_source(self, code):
+        '''
+        Returns code generated by codegen_structure as python source. Code
+        built by AST codegen is unparsed, so it's meant only for reading.
+        '''
+        if isinstance(code, ast.AST):
+            return ast.unparse(code)
+        return decode_code(code)
+
+    def compile_code(self, code, filename, template_path=None, source=None):
+        '''
+        Compiles code generated by codegen_structure. With remap_lines,
+        code objects get lines of template given by filename - if it's
+        not a file, template source (if given) is put in linecache, so
+        tracebacks show template lines. Otherwise generated code is
+        put in linecache and used as file name. Code built by AST
+        codegen has template lines already.
+        '''
+        if self.compile_hooks:
+            start = time.perf_counter()
+            bytecode = self._compile_code(code, filename, source)
+            self.report_stage('compile', template_path, start)
+            return bytecode
+        return self._compile_code(code, filename, source)
+
+    def _compile_code(self, code, filename, source):
+        if not self.remap_lines:
+            generated = self.debug_source(code)
+            filename = source_filename(generated, 'pyhaa-generated')
+            bytecode = compile(generated, filename, 'exec')
+            # Registered only once compiled, so failed code isn't kept
+            register_source(generated, filename = filename)
+            return bytecode
+        if isinstance(code, ast.AST):
+            # Built by AST codegen, with template lines already
+            tree = code
+        else:
+            tree = ast.parse(code, filename)
+            source_map = find_source_map(tree)
+            if source_map is None:
+                # Not generated by codegen writing source maps
+                return compile(tree, filename, 'exec')
+            remap_lines(tree, source_map)
+        # Tell TemplateInfo lines need no mapping anymore
+        flag = ast.parse('_ph_template_info.lines_remapped = True').body[0]
+        tree = ast.Module(body=tree.body + [flag], type_ignores=[])
+        if source is not None and isinstance(source, str) and not os.path.isfile(filename):
+            filename = source_filename(source, 'pyhaa-template')
+            bytecode = compile(tree, filename, 'exec')
+            register_source(source, filename = filename)
+            return bytecode
+        return compile(tree, filename, 'exec')
+
+    def compilation_key(self):
+        '''
+        Identifies settings which change compiled code - codegen class and
+        optimization level. Stored in bytecode caches and archives, so
+        code compiled with other settings isn't used.
+        '''
+        return '{}.{}:{}'.format(
+            self.codegen_class.__module__,
+            self.codegen_class.__qualname__,
+            self.optimizer.level,
+        ).encode('utf-8')
 
     def template_info_from_bytecode(self, bytecode):
+        if self.compile_hooks:
+            start = time.perf_counter()
         globals_ = dict(
             self.template_globals,
             environment = self,
         )
-        exec(bytecode, globals_)
-        return globals_['_ph_template_info']
-
+        try:
+            exec(bytecode, globals_)
+        except BaseException:
+            discard_source(bytecode.co_filename)
+            raise
+        template_info = globals_['_ph_template_info']
+        acquire_source(bytecode.co_filename, template_info)
+        if self.compile_hooks:
+            self.report_stage('exec', template_info.template_path, start)
+        return template_info
+
+
+class TemplateHandle:
+    '''
+    Keeps template instance along with its inheritance chain, so it may be
+    rendered many times without looking up templates again. Instance gets
+    rebuilt by get_template if any template in chain was changed.
+    '''
+    def __init__(self, environment, path):
+        self.environment = environment
+        self.path = path
+        self.refresh()
+
+    def refresh(self):
+        environment = self.environment
+        loader = environment.loader
+        generation = loader.generation
+        template_info = environment.get_template_info(self.path)
+        self.chain = environment.get_inheritance_chain(template_info)
+        self.tokens = [
+            loader.get_token(template_info.template_path, template_info)
+            for template_info in self.chain
+        ]
+        self.generation = generation
+        self.template = environment.instance_from_chain(self.chain)
+
+    def is_stale(self):
+        '''
+        Tokens of templates in chain are compared with cached ones only if
+        loader dropped any templates since, and sources are checked only
+        as often as loader would check them.
+        '''
+        environment = self.environment
+        loader = environment.loader
+        generation = loader.generation
+        if generation != self.generation:
+            for template_info, token in zip(self.chain, self.tokens):
+                if token is None or loader.get_token(template_info.template_path, template_info) != token:
+                    return True
+            self.generation = generation
+        for template_info, token in zip(self.chain, self.tokens):
+            if token is None or not loader.is_token_current(template_info.template_path, environment, token):
+                return True
+        return False
+
+    def get_template(self):
+        if self.environment.auto_reload and self.is_stale():
+            self.refresh()
+        return self.template
+
+    def __repr__(self):
+        return '<{} {}>'.format(
+            self.__class__.__name__,
+            repr(self.path),
+        )
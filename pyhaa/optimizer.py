@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Structure optimizer - rewrites parsed PyhaaStructure before it gets to codegen
+'''
+
+import ast
+import logging
+import operator
+
+from . import structure
+from .utils.encode import entity_encode
+
+__all__ = (
+    'ConstantFoldingPass',
+    'DeadBranchPass',
+    'MergeTextPass',
+    'Optimizer',
+    'OptimizerPass',
+    'PartialInliningPass',
+)
+
+log = logging.getLogger(__name__)
+
+# Folded strings and numbers must not grow bigger than that
+MAX_FOLDED_SIZE = 4096
+# How deep partials called by inlined partials get inlined
+MAX_INLINING_DEPTH = 8
+
+UNARY_OPERATORS = {
+    ast.Invert: operator.invert,
+    ast.Not: operator.not_,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+# No Pow and LShift - these can blow up
+BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.BitAnd: operator.and_,
+    ast.BitOr: operator.or_,
+    ast.BitXor: operator.xor,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Mult: operator.mul,
+    ast.RShift: operator.rshift,
+    ast.Sub: operator.sub,
+}
+
+COMPARE_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.NotEq: operator.ne,
+}
+
+CONSTANT_TYPES = (bool, float, int, str, type(None))
+
+
+class NotConstant(Exception):
+    pass
+
+
+def check_size(value):
+    if isinstance(value, str) and len(value) > MAX_FOLDED_SIZE:
+        raise NotConstant
+    if isinstance(value, int) and value.bit_length() > MAX_FOLDED_SIZE:
+        raise NotConstant
+    return value
+
+def evaluate_node(node):
+    '''
+    Evaluates expression AST consisting only of literals and operators
+    '''
+    if isinstance(node, ast.Constant):
+        if not isinstance(node.value, CONSTANT_TYPES):
+            raise NotConstant
+        return node.value
+
+    if isinstance(node, ast.UnaryOp):
+        function = UNARY_OPERATORS.get(type(node.op))
+        if not function:
+            raise NotConstant
+        return check_size(function(evaluate_node(node.operand)))
+
+    if isinstance(node, ast.BinOp):
+        function = BINARY_OPERATORS.get(type(node.op))
+        if not function:
+            raise NotConstant
+        left = evaluate_node(node.left)
+        right = evaluate_node(node.right)
+        if isinstance(left, str) and function is operator.mod:
+            # String formatting may produce anything
+            raise NotConstant
+        if function is operator.mul:
+            for sequence, times in ((left, right), (right, left)):
+                if isinstance(sequence, str) and isinstance(times, int) and len(sequence) * times > MAX_FOLDED_SIZE:
+                    raise NotConstant
+        return check_size(function(left, right))
+
+    if isinstance(node, ast.BoolOp):
+        is_and = isinstance(node.op, ast.And)
+        for subnode in node.values:
+            value = evaluate_node(subnode)
+            if bool(value) != is_and:
+                break
+        return value
+
+    if isinstance(node, ast.Compare):
+        left = evaluate_node(node.left)
+        for op, subnode in zip(node.ops, node.comparators):
+            function = COMPARE_OPERATORS.get(type(op))
+            if not function:
+                raise NotConstant
+            right = evaluate_node(subnode)
+            if not function(left, right):
+                return False
+            left = right
+        return True
+
+    if isinstance(node, ast.IfExp):
+        if evaluate_node(node.test):
+            return evaluate_node(node.body)
+        return evaluate_node(node.orelse)
+
+    raise NotConstant
+
+def parse_expression(code):
+    try:
+        return ast.parse('(' + code.strip() + '\n)', mode='eval').body
+    except SyntaxError:
+        return None
+
+def evaluate_constant(code):
+    '''
+    Returns tuple (is constant, value) of given python expression code
+    '''
+    tree = parse_expression(code)
+    if tree is None:
+        return False, None
+    try:
+        return True, evaluate_node(tree)
+    except (NotConstant, ArithmeticError, TypeError, ValueError):
+        return False, None
+
+def references_only_self(code):
+    '''
+    Checks if python expression may be moved to any other partial - it
+    uses no other names than self and introduces no scopes.
+    '''
+    tree = parse_expression(code)
+    if tree is None:
+        return False
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id != 'self':
+            return False
+        if isinstance(node, (
+            ast.Await,
+            ast.DictComp,
+            ast.GeneratorExp,
+            ast.Lambda,
+            ast.ListComp,
+            ast.NamedExpr,
+            ast.SetComp,
+            ast.Yield,
+            ast.YieldFrom,
+        )):
+            return False
+    return True
+
+def clone_nodes(nodes, lineno=None):
+    '''
+    Returns copies of given sibling nodes, keeping their adjacency. Copies
+    get given source line, as they're put in place of other node.
+    '''
+    result = list()
+    for node in nodes:
+        if isinstance(node, structure.Tag):
+            clone = structure.Tag(
+                name = node.name,
+                id_ = node.id_,
+                classes = node.classes,
+                attributes_set = [
+                    attributes if isinstance(attributes, str) else dict(attributes)
+                    for attributes in node.attributes_set
+                ],
+            )
+            for child in clone_nodes(node, lineno):
+                clone.append(child)
+        else:
+            clone = node.__class__(
+                content = node.content,
+                escape = node.escape,
+            )
+        clone.lineno = lineno
+        if result:
+            result[-1].next_sibling = clone
+            clone.prev_sibling = result[-1]
+        result.append(clone)
+    return result
+
+def text_content(node):
+    '''
+    Returns content of text node as it would be rendered - unescaped
+    '''
+    if node.escape:
+        return entity_encode(node.content)
+    return node.content
+
+def join_texts(first, second):
+    # Codegen separates texts which were adjacent in template with space,
+    # texts which got adjacent by optimization are joined directly
+    separator = ' ' if first.next_sibling is second else ''
+    if first.escape == second.escape:
+        text = structure.Text(
+            content = first.content + separator + second.content,
+            escape = first.escape,
+        )
+    else:
+        text = structure.Text(
+            content = text_content(first) + separator + text_content(second),
+            escape = False,
+        )
+    text.next_sibling = second.next_sibling
+    text.lineno = first.lineno
+    return text
+
+def set_children(parent, children):
+    '''
+    Replaces children of given parent, merging adjacent texts
+    '''
+    merged = list()
+    for child in children:
+        if merged and isinstance(child, structure.Text) and isinstance(merged[-1], structure.Text):
+            merged[-1] = join_texts(merged[-1], child)
+        else:
+            merged.append(child)
+
+    if not merged:
+        if isinstance(parent, structure.CompoundStatement):
+            merged.append(structure.SimpleStatement(content='pass'))
+        elif isinstance(parent, structure.PyhaaTree) and not isinstance(parent, structure.PyhaaPartial):
+            # Codegen omits body function if tree is empty
+            merged.append(structure.Text(content=''))
+
+    parent.children = list()
+    for child in merged:
+        child.prev_sibling = None
+        child.next_sibling = None
+        parent.append(child)
+
+
+class OptimizerPass:
+    '''
+    Base class of structure optimization passes. Pass is run only if
+    optimization level is at least equal to its level.
+    '''
+    level = 1
+
+    def run(self, structure_, **context):
+        self.context = context
+        roots = [structure_.tree]
+        roots.extend(structure_.partials.values())
+        for root in roots:
+            self.optimize_tree(root)
+
+    def optimize_tree(self, parent):
+        # Children first, so optimized child contents can get merged
+        for child in parent:
+            if isinstance(child, structure.PyhaaParent):
+                self.optimize_tree(child)
+        children = self.optimize_children(parent, list(parent))
+        if children is not None:
+            set_children(parent, children)
+
+    def optimize_children(self, parent, children):
+        '''
+        Returns new list of children of given parent or None if nothing
+        has changed
+        '''
+        raise NotImplementedError # pragma: no cover
+
+
+class MergeTextPass(OptimizerPass):
+    '''
+    Merges adjacent text nodes into single ones
+    '''
+    def optimize_children(self, parent, children):
+        for first, second in zip(children, children[1:]):
+            if isinstance(first, structure.Text) and isinstance(second, structure.Text):
+                return children
+        return None
+
+
+class ConstantFoldingPass(OptimizerPass):
+    '''
+    Replaces expressions consisting only of literals with texts
+    '''
+    def optimize_children(self, parent, children):
+        changed = False
+        for idx, child in enumerate(children):
+            if not isinstance(child, structure.Expression):
+                continue
+            is_constant, value = evaluate_constant(child.content)
+            # None and bytes are not rendered as texts
+            if not is_constant or value is None:
+                continue
+            text = structure.Text(
+                content = str(value),
+                escape = child.escape,
+            )
+            text.lineno = child.lineno
+            children[idx] = text
+            changed = True
+        return children if changed else None
+
+
+class DeadBranchPass(OptimizerPass):
+    '''
+    Removes conditional branches which can't be run, and unwraps ones
+    which always run
+    '''
+    def condition(self, node):
+        code = node.content.rstrip()[len(node.name):-1]
+        is_constant, value = evaluate_constant(code)
+        if not is_constant:
+            return None
+        return bool(value)
+
+    def optimize_children(self, parent, children):
+        result = list()
+        changed = False
+        idx = 0
+        while idx < len(children):
+            child = children[idx]
+            idx += 1
+            if not isinstance(child, structure.CompoundStatement):
+                result.append(child)
+                continue
+
+            if child.name == 'while':
+                has_else = idx < len(children) and getattr(children[idx], 'name', None) == 'else'
+                if not has_else and self.condition(child) is False:
+                    changed = True
+                    continue
+                result.append(child)
+                continue
+
+            if child.name != 'if':
+                result.append(child)
+                continue
+
+            chain = [child]
+            while idx < len(children) and getattr(children[idx], 'name', None) in ('elif', 'else'):
+                chain.append(children[idx])
+                idx += 1
+                if chain[-1].name == 'else':
+                    break
+
+            kept, unwrapped = self.optimize_chain(chain)
+            if kept != chain:
+                changed = True
+            result.extend(kept)
+            result.extend(unwrapped)
+        return result if changed else None
+
+    def optimize_chain(self, chain):
+        '''
+        Returns tuple (kept statements, unwrapped nodes) for if-elif-else chain
+        '''
+        kept = list()
+        for statement in chain:
+            if statement.name == 'else':
+                if not kept:
+                    return kept, list(statement)
+                kept.append(statement)
+                break
+            condition = self.condition(statement)
+            if condition is None:
+                kept.append(statement)
+            elif condition:
+                if not kept:
+                    return kept, list(statement)
+                statement.name = 'else'
+                statement.content = 'else:'
+                kept.append(statement)
+                break
+
+        if kept and kept[0].name == 'elif':
+            kept[0].name = 'if'
+            kept[0].content = kept[0].content[2:]
+        return kept, list()
+
+
+class PartialInliningPass(OptimizerPass):
+    '''
+    Substitutes calls to parameterless partials (=self.name()) with their
+    bodies. Requires "partials" context - dict of partials to which self
+    attributes resolve, which is known only when complete inheritance
+    chain is known (see PyhaaEnvironment.specialize_chain). Only partials
+    containing tags, texts and expressions using nothing but self are
+    inlined, so purely static ones become constant bytes.
+    '''
+    level = 2
+
+    def run(self, structure_, partials=None, **context):
+        if not partials:
+            return
+        self.inlineable = dict()
+        super().run(structure_, partials=partials, **context)
+
+    def called_partial(self, node):
+        '''
+        Returns name of partial called by expression node, if it's a call
+        without arguments
+        '''
+        tree = parse_expression(node.content)
+        if not (
+            isinstance(tree, ast.Call) and
+            not tree.args and
+            not tree.keywords and
+            isinstance(tree.func, ast.Attribute) and
+            isinstance(tree.func.value, ast.Name) and
+            tree.func.value.id == 'self'
+        ):
+            return None
+        return tree.func.attr
+
+    def is_inlineable(self, name):
+        result = self.inlineable.get(name)
+        if result is None:
+            partial = self.context['partials'].get(name)
+            result = bool(
+                partial is not None and
+                not (partial.arguments or '').strip() and
+                self.is_safe(partial)
+            )
+            self.inlineable[name] = result
+        return result
+
+    def is_safe(self, parent):
+        for node in parent:
+            if isinstance(node, structure.Tag):
+                for attributes in node.attributes_set:
+                    if isinstance(attributes, str) and not references_only_self(attributes):
+                        return False
+                if not self.is_safe(node):
+                    return False
+            elif isinstance(node, structure.Expression):
+                if not references_only_self(node.content):
+                    return False
+            elif not isinstance(node, structure.Text):
+                return False
+        return True
+
+    def inline(self, nodes, depth):
+        result = list()
+        changed = False
+        for node in nodes:
+            name = None
+            if isinstance(node, structure.Expression) and depth < MAX_INLINING_DEPTH:
+                name = self.called_partial(node)
+            if name and self.is_inlineable(name):
+                log.debug('Inlining partial %s', name)
+                inlined = clone_nodes(self.context['partials'][name], node.lineno)
+                for clone in inlined:
+                    if isinstance(clone, structure.Tag):
+                        self.inline_tag(clone, depth + 1)
+                result.extend(self.inline(inlined, depth + 1)[0])
+                changed = True
+            else:
+                result.append(node)
+        return result, changed
+
+    def inline_tag(self, tag, depth):
+        for child in tag:
+            if isinstance(child, structure.Tag):
+                self.inline_tag(child, depth)
+        children, changed = self.inline(list(tag), depth)
+        if changed:
+            set_children(tag, children)
+
+    def optimize_children(self, parent, children):
+        children, changed = self.inline(children, 0)
+        return children if changed else None
+
+
+class Optimizer:
+    '''
+    Runs optimization passes over parsed template structure
+    '''
+    default_passes = (
+        PartialInliningPass,
+        MergeTextPass,
+        ConstantFoldingPass,
+        DeadBranchPass,
+    )
+
+    def __init__(self, passes=None, level=1):
+        if passes is None:
+            passes = [pass_class() for pass_class in self.default_passes]
+        self.passes = passes
+        self.level = level
+
+    def needs_partials(self):
+        '''
+        Checks if any of enabled passes needs to know partials of complete
+        inheritance chain
+        '''
+        return any(
+            optimizer_pass.level <= self.level and isinstance(optimizer_pass, PartialInliningPass)
+            for optimizer_pass in self.passes
+        )
+
+    def optimize(self, structure_, **context):
+        roots = [structure_.tree]
+        roots.extend(structure_.partials.values())
+        with_output = [root for root in roots if root.has_output()]
+        for optimizer_pass in self.passes:
+            if optimizer_pass.level <= self.level:
+                log.debug('Running optimizer pass %r', optimizer_pass)
+                optimizer_pass.run(structure_, **context)
+        for root in with_output:
+            if not root.has_output():
+                # All the output got removed, empty text keeps function
+                # rendering instead of returning value
+                root.append(structure.Text(content=''))
+        return structure_
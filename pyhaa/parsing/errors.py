@@ -62,6 +62,7 @@ SYNTAX_INFO = DescEnum(
     )),
     ('INVALID_PYTHON_EXPRESSION', "Invalid python expression."),
     ('ID_ALREADY_SET', "Tag's id is already set."),
+    ('INVALID_PYTHON_TARGET', "Invalid python assignment target."),
 )
 
 log = logging.getLogger(__name__)
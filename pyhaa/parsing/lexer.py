@@ -278,9 +278,12 @@ pyhaa_lexer = dict(
         after = 'code_colon',
     ),
 
-    # for..in statement
+    # for..in statement, also async one
     code_statement_for = dict(
-        match = matchers.PK('for'),
+        match = MM(
+            matchers.PK('for'),
+            matchers.PK(r'async\s+for'),
+        ),
         after = 'code_statement_for_target',
     ),
     code_statement_for_target = dict(
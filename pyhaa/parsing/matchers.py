@@ -19,6 +19,8 @@
 # <http://www.gnu.org/licenses/>.
 
 import ast
+import functools
+import keyword
 import re
 import tokenize
 
@@ -33,9 +35,9 @@ from .errors import (
 )
 
 from ..utils import (
-    clear_exception_context,
     FakeByteReadline,
 )
+from ..utils.snippets import parse_snippet
 
 L_BRACKETS = ('{', '(', '[')
 R_BRACKETS = ('}', ')', ']')
@@ -46,6 +48,63 @@ RE_EMPTY_BRACKETS = {
     for left, right in PAIRED_BRACKETS.items()
 }
 
+# Snippets which are valid python whatever matcher parses them: dotted names
+# and calls of dotted names with simple positional arguments. Those don't need
+# to be tokenized and parsed to find where they end and check their syntax.
+_DOTTED_NAME = r'[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*'
+_STRING = r'(?:\'[^\'\\\n]*\'|"[^"\\\n]*")'
+_SIMPLE_ARGUMENT = r'(?:{}|0|[1-9][0-9]*|{})'.format(_DOTTED_NAME, _STRING)
+RE_DOTTED_NAME = re.compile(_DOTTED_NAME)
+RE_SIMPLE_CALL = re.compile(r'{0}(?:\([ \t]*(?:{1}(?:[ \t]*,[ \t]*{1})*[ \t]*)?\))?'.format(
+    _DOTTED_NAME,
+    _SIMPLE_ARGUMENT,
+))
+RE_STRING = re.compile(_STRING)
+RE_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+RE_SNIPPET_END = re.compile(r'[ \t]*(?:\r?\n)?$')
+RE_SNIPPET_COLON = re.compile(r'[ \t]*:(?!=)')
+
+SNIPPET_CACHE_SIZE = 1024
+
+
+@functools.lru_cache(maxsize=SNIPPET_CACHE_SIZE)
+def validate_snippet(matcher_class, snippet):
+    '''
+    Checks syntax of python snippet found by matcher. Returns None if it's
+    valid, or tuple (syntax info id, position in snippet or None, python
+    error message or None). Templates repeat the same snippets a lot, so
+    results are cached by matcher class and snippet text.
+    '''
+    code = (snippet+'\n').encode('utf8')
+    context = matcher_class.get_context()
+    subtract = 0
+    if context:
+        code = context[0] + code + context[1]
+        subtract = len(context[0])
+    try:
+        if context:
+            ast_tree = ast.parse(code)
+        else:
+            # Shared with AST codegen
+            ast_tree = parse_snippet(snippet)
+    except SyntaxError as e:
+        if context:
+            # Offset is for bytes, not string characters
+            fragment = code[:e.offset].decode('utf8')
+        else:
+            # Snippet was parsed as string, offset counts characters
+            fragment = snippet[:e.offset]
+        # subtract 1 because python parser counts from one, and we
+        # count from zero
+        # We also subtract length of context code prepended to line
+        # Use max for case if context code is messed up
+        offset = max(len(fragment) - 1 - subtract, 0)
+        return SYNTAX_INFO.PYTHON_SYNTAX_ERROR, offset, e.msg
+    eid = matcher_class.check_ast(ast_tree)
+    if eid is not None:
+        return eid, None, None
+    return None
+
 
 class ConstantLength(Matcher):
     def __init__(self, orig, length):
@@ -67,6 +126,7 @@ class PythonStatementMatcher(Matcher):
     break_at_colon = False
     break_at_keyword = []
     break_at_unknown_bracket = False
+    simple_snippet = RE_SIMPLE_CALL
 
     def __init__(self, break_at_colon = None, break_at_keyword = None):
         if not break_at_keyword is None:
@@ -75,11 +135,44 @@ class PythonStatementMatcher(Matcher):
         if not break_at_colon is None:
             self.break_at_colon = break_at_colon
 
-    def match(self, parser, line, pos):
-        parser.cache_push()
+        self.re_break_at_keyword = re.compile(r'[ \t]*(?:{})\b'.format(
+            '|'.join(map(re.escape, self.break_at_keyword))
+        ))
 
+    def match_simple(self, line):
+        '''
+        Fast path for snippets which are simple enough to be matched with
+        regular expression. Returns snippet, or None if it should be
+        tokenized.
+        '''
+        if self.simple_snippet is None or self.match_bracket:
+            return None
+        match = self.simple_snippet.match(line)
+        if not match:
+            return None
+        snippet = match.group(0)
+        rest = line[match.end():]
+        if not (
+            RE_SNIPPET_END.match(rest) or
+            (self.break_at_colon and RE_SNIPPET_COLON.match(rest)) or
+            (self.break_at_keyword and self.re_break_at_keyword.match(rest))
+        ):
+            return None
+        identifiers = RE_IDENTIFIER.findall(RE_STRING.sub('', snippet))
+        if any(keyword.iskeyword(identifier) for identifier in identifiers):
+            return None
+        return snippet
+
+    def match(self, parser, line, pos):
         # We're not interested in what was before
         line = line[pos:]
+
+        snippet = self.match_simple(line)
+        if snippet is not None:
+            return pos + len(snippet), snippet
+
+        parser.cache_push()
+
         if self.match_bracket:
             assert self.match_bracket in L_BRACKETS and line[0] == self.match_bracket
         lines = []
@@ -153,33 +246,17 @@ class PythonStatementMatcher(Matcher):
         jlines = ''.join(lines)
 
         if self.should_check_ast:
-            jlines2 = (jlines+'\n').encode('utf8')
-            context = self.get_context(line)
-            subtract = 0
-            if context:
-                jlines2 = context[0] + jlines2 + context[1]
-                subtract = len(context[0])
-            with clear_exception_context(PyhaaSyntaxError):
-                try:
-                    ast_tree = ast.parse(jlines2)
-                except SyntaxError as e:
-                    # Offset is for bytes, not string characters
-                    # Even if I give normal string to parse, I'll get invalid
-                    # offset if line has unicode characters before it
-                    fragment = jlines2[:e.offset].decode('utf8')
-                    # subtract 1 because python parser counts from one, and we
-                    # count from zero
-                    # We also subtract length of context code prepended to line
-                    # Use max for case if context code is messed up
-                    offset = max(len(fragment) - 1 - subtract, 0)
-                    raise PyhaaSyntaxError(
-                        SYNTAX_INFO.PYTHON_SYNTAX_ERROR,
-                        parser,
-                        dict(current_pos = pos + offset),
-                        desc = e.msg,
-                    )
-
-            self.check_ast(parser, line, pos, ast_tree)
+            error = validate_snippet(self.__class__, jlines)
+            if error is not None:
+                eid, offset, desc = error
+                if offset is None:
+                    raise PyhaaSyntaxError(eid, parser)
+                raise PyhaaSyntaxError(
+                    eid,
+                    parser,
+                    dict(current_pos = pos + offset),
+                    desc = desc,
+                )
 
         if self.match_bracket:
             if RE_EMPTY_BRACKETS[self.match_bracket].match(jlines):
@@ -190,10 +267,16 @@ class PythonStatementMatcher(Matcher):
 
         return pos + len(lines[-1]), jlines
 
-    def check_ast(self, parser, line, pos, ast_tree):
-        pass
+    @classmethod
+    def check_ast(cls, ast_tree):
+        '''
+        Returns syntax info id if parsed snippet is not what matcher
+        expects, None otherwise.
+        '''
+        return None
 
-    def get_context(self, line):
+    @classmethod
+    def get_context(cls):
         '''
         This returns context code before and after matched fragment of code.
         It is needed for ast parser so we can check syntax for small parts
@@ -206,50 +289,53 @@ class PythonStatementMatcher(Matcher):
 
 class PythonDictMatcher(PythonStatementMatcher):
     match_bracket = '{'
+    simple_snippet = None
 
-    def check_ast(self, parser, line, pos, ast_tree):
+    @classmethod
+    def check_ast(cls, ast_tree):
         if not isinstance(ast_tree.body[0].value, (ast.Dict, ast.DictComp)):
-            raise PyhaaSyntaxError(
-                SYNTAX_INFO.INVALID_PYTHON_ATTRIBUTES,
-                parser,
-            )
+            return SYNTAX_INFO.INVALID_PYTHON_ATTRIBUTES
+        return None
 
 
 class PythonExpressionMatcher(PythonStatementMatcher):
-    def check_ast(self, parser, line, pos, ast_tree):
+    @classmethod
+    def check_ast(cls, ast_tree):
         if not (len(ast_tree.body) == 1 and isinstance(ast_tree.body[0], ast.Expr)):
-            raise PyhaaSyntaxError(
-                SYNTAX_INFO.INVALID_PYTHON_EXPRESSION,
-                parser,
-            )
+            return SYNTAX_INFO.INVALID_PYTHON_EXPRESSION
+        return None
 
 
 class PythonExpressionListMatcher(PythonStatementMatcher):
-    def check_ast(self, parser, line, pos, ast_tree):
+    @classmethod
+    def check_ast(cls, ast_tree):
         if not (ast_tree.body and all(isinstance(item, ast.Expr) for item in ast_tree.body)):
-            raise PyhaaSyntaxError(
-                SYNTAX_INFO.INVALID_PYTHON_EXPRESSION,
-                parser,
-            )
+            return SYNTAX_INFO.INVALID_PYTHON_EXPRESSION
+        return None
 
 
 class PythonTargetMatcher(PythonExpressionMatcher):
     break_at_keyword = ['in']
-
-    def check_ast(self, parser, line, pos, ast_tree):
-        super().check_ast(parser, line, pos, ast_tree)
+    # Calls can't be assigned to
+    simple_snippet = RE_DOTTED_NAME
+
+    @classmethod
+    def check_ast(cls, ast_tree):
+        eid = super().check_ast(ast_tree)
+        if eid is not None:
+            return eid
         value = ast_tree.body[0].value
         if not isinstance(value, (ast.Attribute, ast.Tuple, ast.List, ast.Name, ast.Starred, ast.Subscript)):
-            raise PyhaaSyntaxError(
-                SYNTAX_INFO.INVALID_PYTHON_TARGET,
-                parser,
-            )
+            return SYNTAX_INFO.INVALID_PYTHON_TARGET
+        return None
 
 
 class PythonParameterListMatcher(PythonStatementMatcher):
     break_at_unknown_bracket = True
+    simple_snippet = None
 
-    def get_context(self, line):
+    @classmethod
+    def get_context(cls):
         return (b'def noname(', b'): pass')
 
 
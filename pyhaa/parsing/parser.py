@@ -76,6 +76,7 @@ class PyhaaParser(Parser):
         return self.structure.current
 
     def append(self, node):
+        node.lineno = self.current_lineno
         self.structure.append(node)
         # Even if node is not openable, but we must "close" it explicitly when
         # reindenting
@@ -253,6 +254,7 @@ class PyhaaParser(Parser):
     def handle_head_partial_parameters(self, match):
         name = self.get_info('partial_name', None)
         self.structure.open_partial(name, match)
+        self.structure.current.lineno = self.current_lineno
         self.current_opened += 1
 
     def handle_head_partial_right_paren(self, match):
@@ -341,7 +343,8 @@ class PyhaaParser(Parser):
 
     # PYTHON CODE stuff
     def begin_statement(self, match):
-        self.set_info('statement', match.group(1))
+        # Normalize whitespace in statements like "async  for"
+        self.set_info('statement', ' '.join(match.group(1).split()))
 
     def handle_code_statement_expression(self, match):
         self.begin_statement(match)
@@ -375,7 +378,7 @@ class PyhaaParser(Parser):
                 statement,
                 expression,
             )
-        elif statement == 'for':
+        elif statement in ('for', 'async for'):
             target = self.get_info('statement_target', None)
             expression = self.get_info('statement_expression', None)
             assert target
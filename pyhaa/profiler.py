@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Profiling of template rendering. Wall time and output size are attributed
+to templates, partials and lines of template source (using source maps
+written by codegen), and may be exported as Chrome trace events
+(chrome://tracing, Perfetto) or folded stacks (flamegraph.pl, speedscope).
+'''
+
+from collections import Counter
+import json
+import os
+import sys
+import threading
+import time
+
+__all__ = (
+    'LineStats',
+    'RenderProfiler',
+)
+
+
+class LineStats:
+    __slots__ = ('time', 'output_bytes', 'hits')
+
+    def __init__(self):
+        self.time = 0.0
+        self.output_bytes = 0
+        self.hits = 0
+
+    def __repr__(self):
+        return '<{} {:.6f}s {} bytes {} hits>'.format(
+            self.__class__.__name__,
+            self.time,
+            self.output_bytes,
+            self.hits,
+        )
+
+
+class _Activation:
+    '''
+    Template function running (or resumed generator) on profiler stack
+    '''
+    __slots__ = ('frame', 'template_info', 'partial', 'name', 'stack', 'lineno', 'start', 'output_bytes')
+
+    def __init__(self, frame, template_info, partial, parent_stack, start):
+        self.frame = frame
+        self.template_info = template_info
+        self.partial = partial
+        self.name = '{}:{}'.format(template_info.template_name, partial)
+        self.stack = parent_stack + ';' + self.name if parent_stack else self.name
+        self.lineno = template_info.template_lineno(frame.f_lineno)
+        self.start = start
+        self.output_bytes = 0
+
+
+class RenderProfiler:
+    '''
+    Traces template functions with sys.settrace in thread which started
+    profiling. Time is measured per line, excluding time spent in other
+    templates called from it. Bytes yielded by templates are counted, for
+    templates compiled in writer mode pass writer through wrap_writer.
+
+    Usage:
+
+        with RenderProfiler() as profiler:
+            html_render_to_string(template)
+        print(profiler.report())
+    '''
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        # Keys are tuples (template name, partial name, template line)
+        self.lines = dict()
+        # Folded stack to time spent in it
+        self.stacks = Counter()
+        self.events = list()
+        self.stack = list()
+        # Frames of template functions to stack of their caller. Renderer
+        # runs generators returned by partials after template which
+        # yielded them gets suspended, so that one is taken as caller.
+        self.callers = dict()
+        self.last_left = None
+        self.last_time = None
+        self.origin = None
+        self.previous_trace = None
+        self.thread_id = None
+
+    def start(self):
+        self.previous_trace = sys.gettrace()
+        self.thread_id = threading.get_ident()
+        self.origin = self.last_time = self.clock()
+        sys.settrace(self.trace_call)
+
+    def stop(self):
+        sys.settrace(self.previous_trace)
+        self.previous_trace = None
+        # Generators left suspended are not resumed anymore
+        now = self.clock()
+        while self.stack:
+            self.leave(now)
+        self.callers.clear()
+        self.last_left = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+        return False
+
+    def profile(self, function, *args, **kwargs):
+        '''
+        Calls function with profiling enabled and returns its result
+        '''
+        with self:
+            return function(*args, **kwargs)
+
+    def line_stats(self, activation):
+        key = (
+            activation.template_info.template_name,
+            activation.partial,
+            activation.lineno,
+        )
+        stats = self.lines.get(key)
+        if stats is None:
+            stats = self.lines[key] = LineStats()
+        return stats
+
+    def charge(self, now):
+        '''
+        Attributes time since last event to line running on top of stack
+        '''
+        elapsed = now - self.last_time
+        self.last_time = now
+        if not self.stack:
+            return
+        top = self.stack[-1]
+        self.line_stats(top).time += elapsed
+        self.stacks['{};{}:{}'.format(
+            top.stack,
+            top.template_info.template_name,
+            '?' if top.lineno is None else top.lineno,
+        )] += elapsed
+
+    def trace_call(self, frame, event, arg):
+        if event != 'call':
+            return None
+        template_info = frame.f_globals.get('_ph_template_info')
+        if template_info is None:
+            return None
+        partial = template_info.partial_names.get(frame.f_code)
+        if partial is None:
+            return None
+        now = self.clock()
+        self.charge(now)
+        if frame in self.callers:
+            parent_stack = self.callers[frame]
+        else:
+            parent_stack = self.stack[-1].stack if self.stack else self.last_left
+            self.callers[frame] = parent_stack
+        activation = _Activation(frame, template_info, partial, parent_stack, now)
+        self.stack.append(activation)
+        return self.trace_template
+
+    def trace_template(self, frame, event, arg):
+        if event == 'line':
+            self.charge(self.clock())
+            top = self.stack[-1]
+            top.lineno = top.template_info.template_lineno(frame.f_lineno)
+            self.line_stats(top).hits += 1
+        elif event == 'return':
+            now = self.clock()
+            self.charge(now)
+            # Generator yields are reported as returns as well
+            if isinstance(arg, (bytes, bytearray, memoryview)):
+                self.add_output(len(arg))
+            self.leave(now)
+        return self.trace_template
+
+    def add_output(self, size):
+        if self.stack:
+            top = self.stack[-1]
+            top.output_bytes += size
+            self.line_stats(top).output_bytes += size
+
+    def leave(self, now):
+        activation = self.stack.pop()
+        self.last_left = activation.stack
+        self.last_time = now
+        self.events.append(dict(
+            name = activation.name,
+            cat = 'template',
+            ph = 'X',
+            ts = (activation.start - self.origin) * 1e6,
+            dur = (now - activation.start) * 1e6,
+            pid = os.getpid(),
+            tid = self.thread_id,
+            args = dict(
+                output_bytes = activation.output_bytes,
+                line = activation.lineno,
+            ),
+        ))
+
+    def wrap_writer(self, write):
+        '''
+        Returns writer counting output of templates compiled in writer mode
+        '''
+        def profiled_write(data):
+            self.add_output(len(data))
+            return write(data)
+        return profiled_write
+
+    def chrome_trace(self):
+        '''
+        Returns trace in Chrome trace event format
+        '''
+        return dict(
+            traceEvents = self.events,
+            displayTimeUnit = 'ms',
+        )
+
+    def write_chrome_trace(self, fp):
+        json.dump(self.chrome_trace(), fp)
+
+    def folded_stacks(self):
+        '''
+        Returns lines of folded stacks with time in microseconds, as
+        expected by flamegraph.pl
+        '''
+        return [
+            '{} {}'.format(stack, int(round(elapsed * 1e6)))
+            for stack, elapsed in sorted(self.stacks.items())
+        ]
+
+    def write_folded_stacks(self, fp):
+        for line in self.folded_stacks():
+            fp.write(line)
+            fp.write('\n')
+
+    def report(self, limit=20):
+        '''
+        Returns text table of lines which took most time
+        '''
+        ordered = sorted(self.lines.items(), key=lambda item: item[1].time, reverse=True)
+        lines = ['{:>10} {:>10} {:>8}  {}'.format('time', 'bytes', 'hits', 'line')]
+        lines.extend(
+            '{:>9.3f}ms {:>10} {:>8}  {}:{} ({})'.format(
+                stats.time * 1e3,
+                stats.output_bytes,
+                stats.hits,
+                template_name,
+                '?' if lineno is None else lineno,
+                partial,
+            )
+            for (template_name, partial, lineno), stats in ordered[:limit]
+        )
+        return '\n'.join(lines)
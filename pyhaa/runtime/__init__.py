@@ -18,9 +18,28 @@
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+from bisect import bisect_right
 from contextlib import contextmanager
+from contextvars import ContextVar
 #from copy import copy
 from sys import exc_info
+from types import CodeType
+
+# Callable receiving output of templates compiled in writer mode
+current_writer = ContextVar('pyhaa_current_writer')
+
+class _FlushMarker(bytes):
+    '''
+    Empty bytes rendered by template to mark place where buffered output
+    should be flushed. Renderers not buffering output ignore it. Templates
+    see it as _ph_FLUSH.
+    '''
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'FLUSH'
+
+FLUSH = _FlushMarker()
 
 class EncapsulatedException(Exception):
     '''
@@ -74,20 +93,85 @@ class decapsulate_exceptions:
             raise exc_val.original
         return False
 
+@contextmanager
+def bind_writer(write):
+    '''
+    Makes templates compiled in writer mode pass their output to given
+    callable (e.g. list.append or bytearray.extend) instead of yielding it.
+    '''
+    token = current_writer.set(write)
+    try:
+        yield write
+    finally:
+        current_writer.reset(token)
+
+def qualify_code(code, name, qualname):
+    '''
+    Returns code object of function named name renamed to qualname, along
+    with code objects nested in it (lambdas, comprehensions)
+    '''
+    changes = dict()
+    if code.co_name == name:
+        changes['co_name'] = qualname
+    if hasattr(code, 'co_qualname'):
+        if code.co_qualname == name:
+            changes['co_qualname'] = qualname
+        elif code.co_qualname.startswith(name + '.'):
+            changes['co_qualname'] = qualname + code.co_qualname[len(name):]
+    if any(isinstance(const, CodeType) for const in code.co_consts):
+        changes['co_consts'] = tuple(
+            qualify_code(const, name, qualname) if isinstance(const, CodeType) else const
+            for const in code.co_consts
+        )
+    return code.replace(**changes) if changes else code
+
 class TemplateInfo:
-    def __init__(self, encoding, template_name, template_path=None, inheritance=None):
+    def __init__(self, encoding, template_name, template_path=None, inheritance=None, output_mode='yield'):
         self.encoding = encoding
         self.template_name = template_name
-        self.template_path = inheritance
+        self.template_path = template_path
         self.inheritance = inheritance
+        self.output_mode = output_mode
         self.partials = dict()
+        # Code objects of partials to their names
+        self.partial_names = dict()
+        # Tuples (first line of generated code, template line), sorted
+        self.source_map = ()
+        self._source_map_lines = None
+        # Set if line numbers of code are template lines already
+        self.lines_remapped = False
 
     def register_partial(self, f):
-        self.partials[f.__name__] = f
+        '''
+        Registers partial, renaming its code to "template name:partial name",
+        so profilers (py-spy, perf trampoline) tell apart partials of
+        different templates
+        '''
+        name = f.__name__
+        qualname = '{}:{}'.format(self.template_name, name)
+        f.__code__ = qualify_code(f.__code__, name, qualname)
+        f.__qualname__ = qualname
+        self.partials[name] = f
+        self.partial_names[f.__code__] = name
 
     def get_partial(self, name):
         return self.partials.get(name)
 
+    def template_lineno(self, lineno):
+        '''
+        Returns line of template source which generated given line of
+        code, or None if it's unknown
+        '''
+        if self.lines_remapped:
+            return lineno
+        lines = self._source_map_lines
+        if lines is None:
+            lines = self._source_map_lines = [line for line, _ in self.source_map]
+        idx = bisect_right(lines, lineno)
+        if not idx:
+            return None
+        return self.source_map[idx-1][1]
+
     def __hash__(self):
         return hash(self.template_name)
 
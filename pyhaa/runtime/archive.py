@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Template archives - single files containing precompiled templates.
+
+Layout: magic, length of version string, version string (marshal format
+depends on Python version), length of compilation key, compilation key
+(see PyhaaEnvironment.compilation_key), offset and size of index, then marshalled
+code objects and sources of templates, then marshalled index - dict of
+template path to tuple (code offset, code size, source offset, source size).
+'''
+
+import marshal
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from .cache import CACHE_HEADER
+
+__all__ = (
+    'ArchiveReader',
+    'ArchiveWriter',
+)
+
+ARCHIVE_MAGIC = b'PYHAARC2'
+LENGTH = struct.Struct('<I')
+INDEX_POSITION = struct.Struct('<QQ')
+
+
+class ArchiveWriter:
+    '''
+    Writes archive into temporary file, which replaces target file on
+    commit, so readers never see partially written archive.
+    '''
+    def __init__(self, path, key=b''):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, self.temporary_path = tempfile.mkstemp(dir=directory, prefix='.pyhaa-archive-')
+        self.fp = os.fdopen(fd, 'wb')
+        self.index = dict()
+        self.fp.write(ARCHIVE_MAGIC)
+        self.fp.write(LENGTH.pack(len(CACHE_HEADER)))
+        self.fp.write(CACHE_HEADER)
+        self.fp.write(LENGTH.pack(len(key)))
+        self.fp.write(key)
+        # Placeholder for index position
+        self.index_position_offset = self.fp.tell()
+        self.fp.write(INDEX_POSITION.pack(0, 0))
+
+    def write_blob(self, data):
+        offset = self.fp.tell()
+        self.fp.write(data)
+        return offset, len(data)
+
+    def add(self, path, bytecode, source):
+        '''
+        Adds template given as code object or marshalled code, and source
+        '''
+        if not isinstance(bytecode, bytes):
+            bytecode = marshal.dumps(bytecode)
+        self.index[path] = self.write_blob(bytecode) + self.write_blob(source.encode('utf-8'))
+
+    def commit(self):
+        # Index contains also build time, used as token of templates
+        index = marshal.dumps((time.time(), self.index))
+        index_offset, index_size = self.write_blob(index)
+        self.fp.seek(self.index_position_offset)
+        self.fp.write(INDEX_POSITION.pack(index_offset, index_size))
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.chmod(self.temporary_path, 0o644)
+        os.replace(self.temporary_path, self.path)
+
+    def abort(self):
+        self.fp.close()
+        os.remove(self.temporary_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self.abort()
+        else:
+            self.commit()
+        return False
+
+
+class ArchiveReader:
+    '''
+    Reads archive mapped into memory. Code objects are unmarshalled
+    directly from the mapping when requested.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as fp:
+            self.mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        try:
+            self.key, self.build_time, self.index = self.read_index()
+        except Exception:
+            self.close()
+            raise
+
+    def read_index(self):
+        view = self.view
+        offset = len(ARCHIVE_MAGIC)
+        if bytes(view[:offset]) != ARCHIVE_MAGIC:
+            # TODO raise proper exception
+            raise Exception('Not a template archive: "{}"'.format(self.path))
+        length, = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        if bytes(view[offset:offset+length]) != CACHE_HEADER:
+            raise Exception('Template archive built with different Pyhaa or Python version: "{}"'.format(self.path))
+        offset += length
+        length, = LENGTH.unpack_from(view, offset)
+        offset += LENGTH.size
+        key = bytes(view[offset:offset+length])
+        offset += length
+        index_offset, index_size = INDEX_POSITION.unpack_from(view, offset)
+        build_time, index = marshal.loads(view[index_offset:index_offset+index_size])
+        return key, build_time, index
+
+    def __contains__(self, path):
+        return path in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def get_bytecode(self, path):
+        offset, size, _, _ = self.index[path]
+        return marshal.loads(self.view[offset:offset+size])
+
+    def get_source(self, path):
+        _, _, offset, size = self.index[path]
+        return str(self.view[offset:offset+size], 'utf-8')
+
+    def close(self):
+        self.view.release()
+        self.mmap.close()
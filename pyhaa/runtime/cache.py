@@ -18,45 +18,194 @@
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+from collections import OrderedDict
 import errno
 import hashlib
 import heapq
+from itertools import count
+import io
 import marshal
 import os
 import pickle
 import sys
 import tempfile
 from threading import RLock
+from types import CodeType
 
 from .. import __version__ as pyhaa_version
 
 CACHE_HEADER = ('pyhaa-{}-{:08x}'.format(pyhaa_version, sys.hexversion)).encode('ascii')
 
+class BaseCache:
+    '''
+    Base of template caches. Counts hits, misses, evictions (entries removed
+    to make room for other ones) and admissions (stored entries).
+    '''
+    # Set if cache uses size and cost of entries
+    weighted = False
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.lock = RLock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.admissions = 0
+        self.rejections = 0
+
+    def stats(self):
+        '''
+        Returns dict of counters, size and hit ratio of cache
+        '''
+        requests = self.hits + self.misses
+        return dict(
+            hits = self.hits,
+            misses = self.misses,
+            evictions = self.evictions,
+            admissions = self.admissions,
+            rejections = self.rejections,
+            size = len(self),
+            max_size = self.max_size,
+            hit_ratio = self.hits / requests if requests else 0.0,
+        )
+
+    def get(self, key):
+        with self.lock:
+            element = self.lookup(key)
+            if element is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return element.value
+
+    def lookup(self, key):
+        '''
+        Returns element of given key, marking it as used, or None
+        '''
+        raise NotImplementedError
+
+    def peek(self, key):
+        '''
+        Returns cached value without affecting its priority
+        '''
+        raise NotImplementedError
+
+    def store(self, key, value, size=None, cost=None):
+        '''
+        Stores value. Size in bytes and cost of rebuilding it (e.g. compile
+        time) may be given - they're used only by caches weighting entries.
+        '''
+        raise NotImplementedError
+
+    def remove(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def __len__(self):
+        raise NotImplementedError
+
+    def __contains__(self, key):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<{} {}/{}>'.format(
+            self.__class__.__name__,
+            len(self),
+            self.max_size,
+        )
+
+
+class _FrequencyBucket:
+    '''
+    Elements of LFUCache having the same priority, in order they got it.
+    Buckets form doubly linked list sorted by priority.
+    '''
+    __slots__ = ('priority', 'elements', 'prev', 'next')
+
+    def __init__(self, priority):
+        self.priority = priority
+        self.elements = OrderedDict()
+        self.prev = None
+        self.next = None
+
 class _CachedElement:
-    __slots__ = ('value', 'priority')
+    __slots__ = ('value', 'bucket')
 
-    def __init__(self, value, priority):
+    def __init__(self, value, bucket):
         self.value = value
-        self.priority = 0
+        self.bucket = bucket
+
+    @property
+    def priority(self):
+        return self.bucket.priority
 
-class LFUCache:
+class LFUCache(BaseCache):
     '''
-    Dumb LFU "aging" cache
+    LFU "aging" cache - new entries start with priority of the least used
+    one, so entries used often long ago don't stay forever. Entries are
+    kept in buckets of equal priority, so all operations are O(1); least
+    used entries are evicted in batches, when there's grace more than
+    max_size.
     '''
     def __init__(self, max_size, grace=20):
-        self.max_size = max_size
+        super().__init__(max_size)
         self.grace = grace
 
         self.offset = 0
         self.cachedict = {}
-
-        # TODO
-        self.lock = RLock()
-
-    def store(self, key, value):
+        # Bucket of the lowest priority
+        self.head = None
+
+    def link_bucket(self, priority, prev):
+        '''
+        Creates bucket of given priority, following prev one or as head
+        '''
+        bucket = _FrequencyBucket(priority)
+        bucket.prev = prev
+        if prev is None:
+            bucket.next = self.head
+            self.head = bucket
+        else:
+            bucket.next = prev.next
+            prev.next = bucket
+        if bucket.next is not None:
+            bucket.next.prev = bucket
+        return bucket
+
+    def unlink_bucket(self, bucket):
+        if bucket.prev is None:
+            self.head = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is not None:
+            bucket.next.prev = bucket.prev
+
+    def detach(self, key, bucket):
+        '''
+        Removes key from bucket, dropping bucket if it gets empty
+        '''
+        del bucket.elements[key]
+        if not bucket.elements:
+            self.unlink_bucket(bucket)
+
+    def store(self, key, value, size=None, cost=None):
         with self.lock:
+            element = self.cachedict.pop(key, None)
+            if element is not None:
+                self.detach(key, element.bucket)
             self.try_cleanup()
-            self.cachedict[key] = _CachedElement(value, self.offset)
+            # Priorities never get lower than offset, so it's the head
+            head = self.head
+            if head is None or head.priority != self.offset:
+                head = self.link_bucket(self.offset, None)
+            element = head.elements[key] = _CachedElement(value, head)
+            self.cachedict[key] = element
+            self.admissions += 1
 
     def try_cleanup(self):
         with self.lock:
@@ -64,86 +213,546 @@ class LFUCache:
             if over - self.grace < 0:
                 return
 
-            smallest = heapq.nsmallest(over, self.cachedict.items(), lambda x: x[1].priority)
-            # This is the lowest priority so use it as offset
-            for key, _ in smallest:
+            for _ in range(over):
+                bucket = self.head
+                key, _ = bucket.elements.popitem(last=False)
                 del self.cachedict[key]
+                if not bucket.elements:
+                    self.unlink_bucket(bucket)
+            self.evictions += over
 
-            self.offset = min(x.priority for x in self.cachedict.values())
-            # Reduce offset if too high?
+            # This is the lowest priority so use it as offset
+            if self.head is not None:
+                self.offset = self.head.priority
 
     def reduce_offset(self):
         with self.lock:
             offset = self.offset
-            for value in self.cachedict.values():
-                value.priority -= offset
+            bucket = self.head
+            while bucket is not None:
+                bucket.priority -= offset
+                bucket = bucket.next
             self.offset = 0
 
-    def get(self, key):
+    def lookup(self, key):
+        element = self.cachedict.get(key)
+        if element is not None:
+            bucket = element.bucket
+            following = bucket.next
+            if following is None or following.priority != bucket.priority + 1:
+                following = self.link_bucket(bucket.priority + 1, bucket)
+            following.elements[key] = element
+            element.bucket = following
+            self.detach(key, bucket)
+        return element
+
+    def peek(self, key):
+        element = self.cachedict.get(key)
+        if element is None:
+            return None
+        return element.value
+
+    def remove(self, key):
         with self.lock:
-            element = self.cachedict.get(key)
-            if element is None:
-                return None
-            element.priority += 1
-            return element.value
-        
+            self.detach(key, self.cachedict.pop(key).bucket)
+
+    def clear(self):
+        with self.lock:
+            self.offset = 0
+            self.cachedict.clear()
+            self.head = None
+
+    def __len__(self):
+        return len(self.cachedict)
+
+    def __contains__(self, key):
+        return key in self.cachedict
+
+
+class _Entry:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+class LRUCache(BaseCache):
+    '''
+    Least recently used entry is evicted first. All operations are O(1).
+    '''
+    def __init__(self, max_size):
+        super().__init__(max_size)
+        self.cachedict = OrderedDict()
+
+    def lookup(self, key):
+        element = self.cachedict.get(key)
+        if element is not None:
+            self.cachedict.move_to_end(key)
+        return element
+
+    def peek(self, key):
+        element = self.cachedict.get(key)
+        if element is None:
+            return None
+        return element.value
+
+    def store(self, key, value, size=None, cost=None):
+        with self.lock:
+            cachedict = self.cachedict
+            if key in cachedict:
+                cachedict.move_to_end(key)
+            elif len(cachedict) >= self.max_size:
+                cachedict.popitem(last=False)
+                self.evictions += 1
+            cachedict[key] = _Entry(value)
+            self.admissions += 1
+
     def remove(self, key):
         with self.lock:
             del self.cachedict[key]
 
     def clear(self):
         with self.lock:
-            self.offset = 0
             self.cachedict.clear()
 
+    def __len__(self):
+        return len(self.cachedict)
+
+    def __contains__(self, key):
+        return key in self.cachedict
+
+
+class SLRUCache(BaseCache):
+    '''
+    Segmented LRU: new entries land in probation segment and get promoted
+    to protected one when used again, so templates used once don't push
+    out frequently used ones. Entries demoted from protected segment go
+    back to probation.
+    '''
+    def __init__(self, max_size, protected_ratio=0.8):
+        super().__init__(max_size)
+        self.protected_size = max(1, int(max_size * protected_ratio))
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def lookup(self, key):
+        element = self.protected.get(key)
+        if element is not None:
+            self.protected.move_to_end(key)
+            return element
+        element = self.probation.pop(key, None)
+        if element is not None:
+            self.promote(key, element)
+        return element
+
+    def promote(self, key, element):
+        protected = self.protected
+        protected[key] = element
+        if len(protected) > self.protected_size:
+            demoted_key, demoted = protected.popitem(last=False)
+            self.probation[demoted_key] = demoted
+
+    def peek(self, key):
+        element = self.protected.get(key) or self.probation.get(key)
+        if element is None:
+            return None
+        return element.value
+
+    def victim(self):
+        '''
+        Returns key which would be evicted first, or None
+        '''
+        for segment in (self.probation, self.protected):
+            if segment:
+                return next(iter(segment))
+        return None
+
+    def evict(self):
+        if self.probation:
+            self.probation.popitem(last=False)
+        else:
+            self.protected.popitem(last=False)
+        self.evictions += 1
+
+    def store(self, key, value, size=None, cost=None):
+        with self.lock:
+            element = self.protected.get(key)
+            if element is not None:
+                element.value = value
+                self.protected.move_to_end(key)
+            else:
+                self.probation.pop(key, None)
+                if len(self) >= self.max_size:
+                    self.evict()
+                self.probation[key] = _Entry(value)
+            self.admissions += 1
+
+    def remove(self, key):
+        with self.lock:
+            if self.protected.pop(key, None) is None:
+                del self.probation[key]
+
+    def clear(self):
+        with self.lock:
+            self.probation.clear()
+            self.protected.clear()
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def __contains__(self, key):
+        return key in self.protected or key in self.probation
+
+
+class FrequencySketch:
+    '''
+    Count-min sketch estimating how often keys were seen. Counters are
+    halved every sample_size increments, so old popularity fades.
+    '''
+    depth = 4
+    max_count = 15
+
+    def __init__(self, size):
+        width = 64
+        while width < 8 * size:
+            width <<= 1
+        self.mask = width - 1
+        self.table = [0] * (width * self.depth)
+        self.sample_size = 10 * max(size, 1)
+        self.additions = 0
+
+    def indexes(self, key):
+        hashed = hash(key) & 0xFFFFFFFFFFFFFFFF
+        width = self.mask + 1
+        for row in range(self.depth):
+            # Differently mixed hash for every row
+            hashed = ((hashed ^ (hashed >> 29)) * 0xBF58476D1CE4E5B9 + row) & 0xFFFFFFFFFFFFFFFF
+            yield row * width + ((hashed >> 32) & self.mask)
+
+    def frequency(self, key):
+        table = self.table
+        return min(table[index] for index in self.indexes(key))
+
+    def increment(self, key):
+        table = self.table
+        added = False
+        for index in self.indexes(key):
+            if table[index] < self.max_count:
+                table[index] += 1
+                added = True
+        if added:
+            self.additions += 1
+            if self.additions >= self.sample_size:
+                self.age()
+
+    def age(self):
+        self.table = [count >> 1 for count in self.table]
+        self.additions //= 2
+
+
+class TinyLFUCache(BaseCache):
+    '''
+    W-TinyLFU: new entries go to small LRU window. Entry leaving window
+    is admitted to main segmented LRU only if it was seen more often than
+    entry main cache would evict for it - so scans of rarely used templates
+    don't flush popular ones. Admissions count only new entries entering
+    the window; rejected candidates are counted in rejections, not evictions.
+    '''
+    def __init__(self, max_size, window_ratio=0.01):
+        super().__init__(max_size)
+        window_size = max(1, int(max_size * window_ratio))
+        self.window = LRUCache(window_size)
+        self.main = SLRUCache(max(1, max_size - window_size))
+        self.sketch = FrequencySketch(max_size)
+
+    def lookup(self, key):
+        self.sketch.increment(key)
+        element = self.window.lookup(key)
+        if element is None:
+            element = self.main.lookup(key)
+        return element
+
+    def peek(self, key):
+        value = self.window.peek(key)
+        if value is None:
+            value = self.main.peek(key)
+        return value
+
+    def store(self, key, value, size=None, cost=None):
+        with self.lock:
+            if key in self.main:
+                self.main.store(key, value)
+                return
+            window = self.window.cachedict
+            if key in window:
+                window.move_to_end(key)
+                window[key].value = value
+                return
+            window[key] = _Entry(value)
+            self.admissions += 1
+            if len(window) <= self.window.max_size:
+                return
+            candidate_key, candidate = window.popitem(last=False)
+            self.admit(candidate_key, candidate.value)
+
+    def admit(self, key, value):
+        main = self.main
+        if len(main) >= main.max_size:
+            victim = main.victim()
+            if self.sketch.frequency(key) <= self.sketch.frequency(victim):
+                self.rejections += 1
+                return
+            self.evictions += 1
+        main.store(key, value)
+
+    def remove(self, key):
+        with self.lock:
+            try:
+                self.window.remove(key)
+            except KeyError:
+                self.main.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.window.clear()
+            self.main.clear()
+
+    def __len__(self):
+        return len(self.window) + len(self.main)
+
+    def __contains__(self, key):
+        return key in self.window or key in self.main
+
+
+def estimate_code_size(code, seen=None):
+    '''
+    Estimates memory retained by code object: the object itself, its
+    bytecode, tables and constants, including nested code objects.
+    '''
+    if seen is None:
+        seen = set()
+    if id(code) in seen:
+        return 0
+    seen.add(id(code))
+    size = sys.getsizeof(code)
+    # co_lnotab is deprecated since co_linetable replaced it
+    linetable = 'co_linetable' if hasattr(code, 'co_linetable') else 'co_lnotab'
+    for attr in ('co_code', linetable, 'co_exceptiontable'):
+        value = getattr(code, attr, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    for names in (code.co_names, code.co_varnames, code.co_freevars, code.co_cellvars):
+        size += sys.getsizeof(names)
+    size += _estimate_constants_size(code.co_consts, seen)
+    return size
+
+def _estimate_constants_size(constants, seen):
+    size = sys.getsizeof(constants)
+    for const in constants:
+        if isinstance(const, CodeType):
+            size += estimate_code_size(const, seen)
+        elif isinstance(const, (tuple, frozenset)):
+            size += _estimate_constants_size(const, seen)
+        elif id(const) not in seen:
+            seen.add(id(const))
+            size += sys.getsizeof(const)
+    return size
+
+
+class GreedyDualSizeCache(BaseCache):
+    '''
+    Bounds total estimated size of entries to max_bytes (and optionally
+    their number to max_size). Uses GreedyDual-Size-Frequency: priority of
+    entry is clock + uses * cost / size, so large entries cheap to rebuild
+    are evicted before small expensive ones. Clock rises to priority of
+    every evicted entry, so entries not used for long age out.
+    '''
+    weighted = True
+
+    def __init__(self, max_bytes, max_size=None, default_cost=1.0):
+        super().__init__(max_size)
+        self.max_bytes = max_bytes
+        self.default_cost = default_cost
+        self.total_bytes = 0
+        self.clock = 0.0
+        self.cachedict = {}
+        # Heap of (priority, sequence, key); entries whose priority changed
+        # are left in heap and skipped when popped
+        self.heap = []
+        self.sequence = count()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update(
+            total_bytes = self.total_bytes,
+            max_bytes = self.max_bytes,
+        )
+        return stats
+
+    def prioritize(self, element):
+        element.priority = self.clock + element.uses * element.cost / max(element.size, 1)
+        heapq.heappush(self.heap, (element.priority, next(self.sequence), element.key))
+        self.maybe_compact()
+
+    def lookup(self, key):
+        element = self.cachedict.get(key)
+        if element is not None:
+            element.uses += 1
+            self.prioritize(element)
+        return element
+
+    def peek(self, key):
+        element = self.cachedict.get(key)
+        if element is None:
+            return None
+        return element.value
+
+    def evict(self):
+        heap = self.heap
+        while heap:
+            priority, _, key = heapq.heappop(heap)
+            element = self.cachedict.get(key)
+            if element is None or element.priority != priority:
+                # Stale heap entry
+                continue
+            self.clock = priority
+            self.discard(key)
+            self.evictions += 1
+            return
+
+    def discard(self, key):
+        element = self.cachedict.pop(key)
+        self.total_bytes -= element.size
+        self.maybe_compact()
+
+    def maybe_compact(self):
+        '''
+        Rebuilds heap once stale entries outnumber live ones
+        '''
+        if len(self.heap) > 2 * len(self.cachedict) + 64:
+            self.compact()
+
+    def compact(self):
+        self.heap = [
+            (element.priority, next(self.sequence), key)
+            for key, element in self.cachedict.items()
+        ]
+        heapq.heapify(self.heap)
+
+    def over_limits(self, extra_bytes=0, extra_entries=0):
+        if self.total_bytes + extra_bytes > self.max_bytes:
+            return True
+        return self.max_size is not None and len(self.cachedict) + extra_entries > self.max_size
+
+    def store(self, key, value, size=None, cost=None):
+        if size is None:
+            size = sys.getsizeof(value)
+        if cost is None:
+            cost = self.default_cost
+        with self.lock:
+            if key in self.cachedict:
+                self.discard(key)
+            if size > self.max_bytes:
+                # Would push out everything else
+                self.rejections += 1
+                return
+            while self.cachedict and self.over_limits(size, 1):
+                self.evict()
+            element = _WeightedElement(key, value, size, cost)
+            self.cachedict[key] = element
+            self.total_bytes += size
+            self.prioritize(element)
+            self.admissions += 1
+
+    def remove(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def clear(self):
+        with self.lock:
+            self.cachedict.clear()
+            self.heap = []
+            self.total_bytes = 0
+            self.clock = 0.0
+
+    def __len__(self):
+        return len(self.cachedict)
+
+    def __contains__(self, key):
+        return key in self.cachedict
+
+    def __repr__(self):
+        return '<{} {}/{} bytes>'.format(
+            self.__class__.__name__,
+            self.total_bytes,
+            self.max_bytes,
+        )
+
+class _WeightedElement:
+    __slots__ = ('key', 'value', 'size', 'cost', 'uses', 'priority')
+
+    def __init__(self, key, value, size, cost):
+        self.key = key
+        self.value = value
+        self.size = size
+        self.cost = cost
+        self.uses = 1
+        self.priority = 0.0
+
 
 class BytecodeCache:
-    def get(self, path):
+    '''
+    Stores compiled templates along with tokens of their sources. Key is
+    PyhaaEnvironment.compilation_key of environment which compiled them,
+    bytecode stored with other key is not returned.
+    '''
+    def get(self, path, key=b''):
         raise NotImplementedError
 
-    def store(self, path, bytecode, token):
+    def store(self, path, bytecode, token, key=b''):
         raise NotImplementedError
 
     def remove(self, path):
         raise NotImplementedError
 
-    def load_io(self, fp):
+    def load_io(self, fp, key=b''):
         header = fp.read(len(CACHE_HEADER))
         if header != CACHE_HEADER:
             return None
         meta = pickle.load(fp)
+        if meta.get('key', b'') != key:
+            return None
         token = meta.get('token')
         bytecode = marshal.load(fp)
         return bytecode, token
 
-    def load_file(self, path):
+    def load_file(self, path, key=b''):
         try:
             with open(path, 'rb') as fp:
-                return self.load_io(fp)
+                return self.load_io(fp, key)
         except IOError as exc:
             if exc.errno != errno.ENOENT:
                 raise
 
-    def load_bytes(self, bts):
-        return self.load_io(io.BytesIO(bts))
+    def load_bytes(self, bts, key=b''):
+        return self.load_io(io.BytesIO(bts), key)
 
-    def dump_io(self, fp, bytecode, token):
+    def dump_io(self, fp, bytecode, token, key=b''):
         fp.write(CACHE_HEADER)
-        # Maybe there'll be more metadata
         meta = dict(
             token=token,
+            key=key,
         )
         pickle.dump(meta, fp)
         marshal.dump(bytecode, fp)
 
-    def dump_file(self, path, bytecode, token):
+    def dump_file(self, path, bytecode, token, key=b''):
         with open(path, 'wb') as fp:
-            return self.dump_io(fp, bytecode, token)
+            return self.dump_io(fp, bytecode, token, key)
 
-    def dump_bytes(self, bts, bytecode, token):
+    def dump_bytes(self, bts, bytecode, token, key=b''):
         bts = io.BytesIO()
-        self.dump_io(bts, bytecode, token)
-        return bts.get_value()
+        self.dump_io(bts, bytecode, token, key)
+        return bts.getvalue()
 
 
 class FilesystemBytecodeCache(BytecodeCache):
@@ -162,11 +771,11 @@ class FilesystemBytecodeCache(BytecodeCache):
         hashed = hashlib.sha1(path.encode('utf8')).hexdigest()
         return os.path.join(self.storage_directory, self.pattern.format(hashed))
 
-    def get(self, path):
-        return self.load_file(self.build_filename(path))
+    def get(self, path, key=b''):
+        return self.load_file(self.build_filename(path), key)
 
-    def store(self, path, bytecode, token):
-        self.dump_file(self.build_filename(path), bytecode, token)
+    def store(self, path, bytecode, token, key=b''):
+        self.dump_file(self.build_filename(path), bytecode, token, key)
 
     def remove(self, path):
         try:
@@ -23,13 +23,41 @@ from ..utils.cgrt_common import (
     open_tag,
     prepare_for_tag,
 )
+from ..utils.encode import async_generator_encode, single_encode
 
 def _ph_open_tag(tag_name_stack, name, id_, classes, attributes, self_close, encoding):
     name, attributes = prepare_for_tag(name, id_, classes, attributes, True, True, encoding)
-    if not self_close:
+    # No stack is given if tag name is known at compile time
+    if not self_close and tag_name_stack is not None:
         tag_name_stack.append(name)
-    return open_tag(name, attributes, self_close)
+    return b''.join(open_tag(name, attributes, self_close))
+
+def _ph_tag_attributes(attributes, encoding):
+    '''
+    Renders attributes of partially static tag. Takes sequence of
+    (b' key="', key, value) tuples, where key is already encoded.
+    '''
+    result = list()
+    for prefix, key, value in attributes:
+        if value in (False, None):
+            continue
+        result.append(prefix)
+        result.append(key if value is True else single_encode(value, True, True, encoding))
+        result.append(b'"')
+    return b''.join(result)
 
 def _ph_close_tag(tag_name_stack):
-    return close_tag(tag_name_stack.pop())
+    return b''.join(close_tag(tag_name_stack.pop()))
+
+def _ph_write_value(write, value, escape, encoding):
+    value = single_encode(value, True, escape, encoding, True, True)
+    if isinstance(value, bytes):
+        write(value)
+    else:
+        for chunk in value:
+            write(chunk)
 
+def _ph_async_encode(value, escape, encoding):
+    if hasattr(value, '__anext__'):
+        return async_generator_encode(value, True, escape, encoding, True)
+    return single_encode(value, True, escape, encoding, True, True)
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Minimal ctypes binding of Linux inotify, used by FilesystemLoader to evict
+changed templates from caches.
+'''
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+__all__ = (
+    'InotifyWatcher',
+    'inotify_available',
+)
+
+log = logging.getLogger(__name__)
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+)
+
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 64 * 1024
+
+_libc = None
+
+def _get_libc():
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is available only on Linux')
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        for name in ('inotify_init1', 'inotify_add_watch', 'inotify_rm_watch'):
+            if not hasattr(libc, name):
+                raise OSError(errno.ENOSYS, 'libc has no {}'.format(name))
+        libc.inotify_init1.argtypes = (ctypes.c_int,)
+        libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        libc.inotify_rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        _libc = libc
+    return _libc
+
+def _check(result):
+    if result < 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+    return result
+
+def inotify_available():
+    try:
+        _get_libc()
+    except OSError:
+        return False
+    return True
+
+
+class InotifyWatcher:
+    '''
+    Watches directory trees in a daemon thread. Calls callback with path of
+    every changed file, or with None if changes could have been lost (queue
+    overflow, directory created or removed) - then everything should be
+    considered changed.
+    '''
+    def __init__(self, callback):
+        libc = _get_libc()
+        self.callback = callback
+        self.fd = _check(libc.inotify_init1(IN_CLOEXEC))
+        self.watches = dict()
+        self.lock = threading.Lock()
+        # Pipe waking up the thread on close
+        self.wake_read, self.wake_write = os.pipe()
+        self.thread = threading.Thread(target=self.run, name='pyhaa-inotify', daemon=True)
+        self.thread.start()
+
+    def add_tree(self, root):
+        for dirpath, dirnames, _ in os.walk(root):
+            self.add_watch(dirpath)
+
+    def add_watch(self, path):
+        try:
+            wd = _check(_libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK))
+        except OSError as exc:
+            # Directory may be gone already
+            log.debug('Failed to watch %s: %s', path, exc)
+            return
+        with self.lock:
+            self.watches[wd] = path
+
+    def read_events(self):
+        data = os.read(self.fd, READ_SIZE)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset+length].rstrip(b'\0')
+            offset += length
+            yield wd, mask, os.fsdecode(name)
+
+    def handle_event(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.callback(None)
+            return
+        with self.lock:
+            directory = self.watches.get(wd)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+        if directory is None:
+            return
+        path = os.path.join(directory, name) if name else directory
+        if mask & IN_ISDIR or mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self.add_tree(path)
+            self.callback(None)
+            return
+        self.callback(path)
+
+    def run(self):
+        poll = select.poll()
+        poll.register(self.fd, select.POLLIN)
+        poll.register(self.wake_read, select.POLLIN)
+        while True:
+            ready = [fd for fd, _ in poll.poll()]
+            if self.wake_read in ready:
+                break
+            try:
+                for event in self.read_events():
+                    self.handle_event(*event)
+            except Exception:
+                log.exception('Failed to handle inotify events')
+
+    def close(self):
+        if self.fd is None:
+            return
+        os.write(self.wake_write, b'\0')
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+        self.fd = None
@@ -19,55 +19,172 @@
 # <http://www.gnu.org/licenses/>.
 
 import codecs
+from concurrent.futures import Future
+import io
+import logging
+import os
 import os.path
+from threading import Lock
+import time
 
-from .cache import LFUCache
+from .archive import ArchiveReader
+from .cache import (
+    estimate_code_size,
+    LFUCache,
+)
+from .inotify import InotifyWatcher
 from ..utils import try_detect_encoding
 
+log = logging.getLogger(__name__)
+
 class BaseLoader:
-    def __init__(self, template_cache_size = 100, bytecode_cache = None):
-        self.template_cache = LFUCache(template_cache_size)
+    def __init__(self, template_cache_size = 100, bytecode_cache = None, check_interval = 0, template_cache = None):
+        # Any BaseCache may be given, e.g. LRUCache or TinyLFUCache
+        if template_cache is None:
+            template_cache = LFUCache(template_cache_size)
+        self.template_cache = template_cache
         self.bytecode_cache = bytecode_cache
+        # With auto_reload, cached templates are checked at most once per
+        # check_interval seconds
+        self.check_interval = check_interval
+        self.last_checks = dict()
+        # Set if changed templates are evicted from caches as soon as they
+        # change, so cached ones don't need to be checked
+        self.watching = False
+        # Incremented when cached templates get dropped because they
+        # changed or were evicted, so holders of template infos may tell
+        # if they need to look at them again
+        self.generation = 0
+        # Futures of templates being loaded right now, so every template
+        # is loaded by one thread at a time
+        self.loading = dict()
+        self.loading_lock = Lock()
 
     def get_template_info(self, path, environment):
-        template = self.template_cache.get(path)
+        cached = self.template_cache.get(path)
         expired = None
-        if template:
-            template, token = template
-            expired = self._is_expired(path, environment, token)
+        if cached:
+            template, token = cached
+            expired = self._is_template_expired(path, environment, token)
             if expired:
-                self.template_cache.remove(path)
+                try:
+                    self.template_cache.remove(path)
+                except KeyError:
+                    # Removed by other thread
+                    pass
+                self.generation += 1
+                environment.template_expired(template)
             else:
                 return template
 
+        with self.loading_lock:
+            future = self.loading.get(path)
+            loading = future is None
+            if loading:
+                # Other thread may have loaded it after cache was checked
+                current = self.template_cache.peek(path)
+                if current and (not cached or current[1] != cached[1]):
+                    return current[0]
+                future = self.loading[path] = Future()
+        if not loading:
+            # Other thread loads it already, wait for its result
+            return future.result()
+
+        try:
+            template = self.load_template_info(path, environment, expired)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        else:
+            future.set_result(template)
+        finally:
+            with self.loading_lock:
+                del self.loading[path]
+        return template
+
+    def load_template_info(self, path, environment, expired):
+        start = time.perf_counter()
         bytecode = None
         if not expired and self.bytecode_cache:
-            bytecode = self.bytecode_cache.get(path)
+            bytecode = self.bytecode_cache.get(path, environment.compilation_key())
             if bytecode:
                 bytecode, token = bytecode
                 expired = self._is_expired(path, environment, token)
                 if expired:
                     self.bytecode_cache.remove(path)
                     bytecode = None
+            if environment.compile_hooks:
+                environment.report_stage('bytecode_cache', path, start, hit = bool(bytecode))
 
         if not bytecode:
-            bytecode, token = self.get_bytecode(path, environment)
+            with environment.compilation_slot():
+                bytecode, token = self.get_bytecode(path, environment)
             if self.bytecode_cache:
-                self.bytecode_cache.store(path, bytecode, token) 
+                self.bytecode_cache.store(path, bytecode, token, environment.compilation_key())
 
         template = environment.template_info_from_bytecode(bytecode)
-        self.template_cache.store(path, (template, token))
+        if self.template_cache.weighted:
+            # Memory kept by template and cost of rebuilding it
+            self.template_cache.store(
+                path,
+                (template, token),
+                size = estimate_code_size(bytecode),
+                cost = time.perf_counter() - start,
+            )
+        else:
+            self.template_cache.store(path, (template, token))
+        if self.check_interval:
+            self.last_checks[path] = time.monotonic()
 
         return template
 
+    def is_current(self, path, environment, template_info):
+        '''
+        Checks if given template info is what get_template_info would return
+        '''
+        template = self.template_cache.peek(path)
+        if not template or template[0] is not template_info:
+            return False
+        return not self._is_template_expired(path, environment, template[1])
+
+    def is_token_current(self, path, environment, token):
+        '''
+        Checks if template loaded with given token didn't change. Source is
+        checked only as often as check_interval allows, and not at all if
+        paths are watched.
+        '''
+        return not self._is_template_expired(path, environment, token)
+
+    def get_token(self, path, template_info):
+        '''
+        Returns token of given template info, or None if it isn't cached
+        '''
+        template = self.template_cache.peek(path)
+        if not template or template[0] is not template_info:
+            return None
+        return template[1]
+
     def get_bytecode(self, path, environment):
         result, filename, token = self.get_python_code(path, environment)
-        bytecode = compile(result, filename, 'exec')
+        bytecode = environment.compile_code(result, filename, path)
         return bytecode, token
 
     def get_python_code(self, path, environment):
-        result, filename, token = self.get_source_code(path, environment)
-        structure = environment.parse_any(result)
+        if environment.compile_hooks:
+            start = time.perf_counter()
+            result, filename, token = self.get_source_code(path, environment)
+            if hasattr(result, 'read'):
+                # Readers are lazy - read source here, so reading file
+                # counts as load, not parse
+                reader = result
+                try:
+                    result = reader.read()
+                finally:
+                    reader.close()
+            environment.report_stage('load', path, start)
+        else:
+            result, filename, token = self.get_source_code(path, environment)
+        structure = environment.parse_any(result, path)
         code = environment.codegen_structure(structure, template_path = path)
         return code, filename, token
     
@@ -79,12 +196,41 @@ class BaseLoader:
             return False
         return self.is_expired(path, environment, token)
 
+    def _is_template_expired(self, path, environment, token):
+        if self.watching:
+            return False
+        if not (self.check_interval and environment.auto_reload):
+            return self._is_expired(path, environment, token)
+        now = time.monotonic()
+        last_check = self.last_checks.get(path)
+        if last_check is not None and now - last_check < self.check_interval:
+            return False
+        expired = self._is_expired(path, environment, token)
+        if expired:
+            self.last_checks.pop(path, None)
+        else:
+            self.last_checks[path] = now
+        return expired
+
     def is_expired(self, path, environment, token):
         return False
 
+    def evict(self, path):
+        '''
+        Removes template from caches
+        '''
+        try:
+            self.template_cache.remove(path)
+        except KeyError:
+            pass
+        self.generation += 1
+        if self.bytecode_cache:
+            self.bytecode_cache.remove(path)
+        self.last_checks.pop(path, None)
+
 
 class FilesystemLoader(BaseLoader):
-    def __init__(self, paths = None, input_encoding = None, **kwargs):
+    def __init__(self, paths = None, input_encoding = None, watch = False, lookup_ttl = 0, build_index = False, **kwargs):
         super().__init__(**kwargs)
 
         paths = [paths] if isinstance(paths, str) else paths
@@ -92,11 +238,128 @@ class FilesystemLoader(BaseLoader):
             os.path.realpath(os.path.expanduser(curpath))
             for curpath in paths
         ]
-        # TODO check if paths are overlapping
         self.paths = paths
         self.input_encoding = input_encoding
+        # Used if check_interval is set: dict of directory path to tuple
+        # (time of scan, dict of file name to DirEntry)
+        self.directory_snapshots = dict()
+        # Results of lookups - dict of template path to tuple (file path
+        # or None, expiration time). Used if lookup_ttl is set or paths
+        # are watched - then results don't expire.
+        self.lookup_ttl = lookup_ttl
+        self.lookup_cache = dict()
+        self.watcher = None
+        if watch:
+            self.start_watching()
+        if build_index:
+            self.build_index()
+
+    @property
+    def uses_lookup_cache(self):
+        return bool(self.lookup_ttl or self.watching)
+
+    def lookup_expiration(self, now):
+        if self.watching:
+            return float('inf')
+        return now + self.lookup_ttl
+
+    def check_overlapping_paths(self):
+        '''
+        Warns about search paths contained in other ones - templates from
+        such paths are available under more than one name.
+        '''
+        overlapping = list()
+        for idx, curpath in enumerate(self.paths):
+            for other in self.paths[idx+1:]:
+                if os.path.commonpath((curpath, other)) in (curpath, other):
+                    log.warning('Overlapping template paths: %s and %s', curpath, other)
+                    overlapping.append((curpath, other))
+        return overlapping
+
+    def build_index(self):
+        '''
+        Fills lookup cache walking all search paths, so looking up any
+        existing template is a single dict access
+        '''
+        if not self.uses_lookup_cache:
+            log.warning('Index of templates not built - lookup_ttl is not set and paths are not watched')
+            return
+        self.check_overlapping_paths()
+        expiration = self.lookup_expiration(time.monotonic())
+        index = dict()
+        # First path takes precedence
+        for curpath in reversed(self.paths):
+            for dirpath, _, filenames in os.walk(curpath):
+                for filename in filenames:
+                    our_path = os.path.join(dirpath, filename)
+                    path = os.path.relpath(our_path, curpath).replace(os.sep, '/')
+                    index[path] = (our_path, expiration)
+        self.lookup_cache.update(index)
+
+    def start_watching(self):
+        '''
+        Starts watching paths with inotify. Returns False if it's not
+        available - then templates are checked using mtimes.
+        '''
+        try:
+            watcher = InotifyWatcher(self.path_changed)
+        except OSError as exc:
+            log.warning('Can\'t watch templates, falling back to mtime checks: %s', exc)
+            return False
+        for curpath in self.paths:
+            watcher.add_tree(curpath)
+        self.watcher = watcher
+        self.watching = True
+        return True
+
+    def stop_watching(self):
+        if self.watcher:
+            self.watching = False
+            self.watcher.close()
+            self.watcher = None
+            # Cached lookups were valid only while paths were watched
+            self.lookup_cache.clear()
+
+    def path_changed(self, changed_path):
+        '''
+        Evicts templates affected by change of given file. None means
+        anything could have changed.
+        '''
+        if changed_path is None:
+            self.template_cache.clear()
+            self.generation += 1
+            self.last_checks.clear()
+            self.directory_snapshots.clear()
+            self.lookup_cache.clear()
+            return
+        self.directory_snapshots.pop(os.path.dirname(changed_path), None)
+        for curpath in self.paths:
+            path = os.path.relpath(changed_path, curpath)
+            if path == os.pardir or path.startswith(os.pardir + os.sep):
+                continue
+            log.debug('Template %s changed', path)
+            path = path.replace(os.sep, '/')
+            self.lookup_cache.pop(path, None)
+            self.evict(path)
 
     def lookup_filename(self, path):
+        '''
+        Returns path of file containing template or None if there's none
+        '''
+        if not self.uses_lookup_cache:
+            return self.find_filename(path)
+        now = time.monotonic()
+        cached = self.lookup_cache.get(path)
+        if cached is not None and now < cached[1]:
+            return cached[0]
+        our_path = self.find_filename(path)
+        self.lookup_cache[path] = (our_path, self.lookup_expiration(now))
+        return our_path
+
+    def find_filename(self, path):
+        if self.check_interval:
+            entry = self.lookup_entry(path)
+            return entry.path if entry else None
         path = os.path.normpath(path)
         for curpath in self.paths:
             curpath = os.path.join(curpath, path)
@@ -104,14 +367,62 @@ class FilesystemLoader(BaseLoader):
                 return curpath
         return None
 
+    def scan_directory(self, directory):
+        '''
+        Returns entries of directory, scanned at most once per check_interval
+        '''
+        directory = os.path.normpath(directory)
+        now = time.monotonic()
+        snapshot = self.directory_snapshots.get(directory)
+        if snapshot and now - snapshot[0] < self.check_interval:
+            return snapshot[1]
+        try:
+            with os.scandir(directory) as iterator:
+                entries = {
+                    entry.name: entry
+                    for entry in iterator
+                }
+        except (FileNotFoundError, NotADirectoryError):
+            entries = dict()
+        self.directory_snapshots[directory] = (now, entries)
+        return entries
+
+    def lookup_entry(self, path):
+        dirname, basename = os.path.split(os.path.normpath(path))
+        for curpath in self.paths:
+            entry = self.scan_directory(os.path.join(curpath, dirname)).get(basename)
+            if entry is not None and entry.is_file():
+                return entry
+        return None
+
+    def stat_template(self, path):
+        '''
+        Returns tuple (file path, mtime) of template or (None, None) if it's
+        not found. DirEntry caches result of stat, so with check_interval
+        set, files get stat'ed once per directory scan.
+        '''
+        our_path = self.lookup_filename(path)
+        if not our_path:
+            return None, None
+        try:
+            if self.check_interval:
+                dirname, basename = os.path.split(our_path)
+                entry = self.scan_directory(dirname).get(basename)
+                if entry is None:
+                    raise FileNotFoundError(our_path)
+                return our_path, entry.stat().st_mtime
+            return our_path, os.path.getmtime(our_path)
+        except OSError:
+            # File is gone, forget cached lookup
+            self.lookup_cache.pop(path, None)
+            return None, None
+
     def get_source_code(self, path, environment):
         encoding = self.input_encoding
-        our_path = self.lookup_filename(path)
+        our_path, mtime = self.stat_template(path)
         if not our_path:
             # TODO raise proper exception
             raise Exception('Template not found: "{}"'.format(path))
-        
-        mtime = os.path.getmtime(our_path)
 
         fp = open(our_path, 'br')
         if not encoding:
@@ -122,9 +433,37 @@ class FilesystemLoader(BaseLoader):
 
     def is_expired(self, path, environment, token):
         old_our_path, old_mtime = token
-        our_path = self.lookup_filename(path)
+        our_path, mtime = self.stat_template(path)
         if not our_path or old_our_path != our_path:
             return True
-        mtime = os.path.getmtime(our_path)
         return mtime > old_mtime
 
+
+class ArchiveLoader(BaseLoader):
+    '''
+    Loads precompiled templates from archive built with
+    python -m pyhaa archive. Archive is immutable - templates never expire.
+    '''
+    def __init__(self, archive_path, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = ArchiveReader(archive_path)
+
+    def token(self, path):
+        if path not in self.archive:
+            # TODO raise proper exception
+            raise Exception('Template not found: "{}"'.format(path))
+        return (self.archive.path, self.archive.build_time)
+
+    def get_bytecode(self, path, environment):
+        token = self.token(path)
+        if self.archive.key != environment.compilation_key():
+            # TODO raise proper exception
+            raise Exception('Template archive built with different codegen or optimization level: "{}"'.format(self.archive.path))
+        return self.archive.get_bytecode(path), token
+
+    def get_source_code(self, path, environment):
+        token = self.token(path)
+        return io.StringIO(self.archive.get_source(path)), '{}:{}'.format(self.archive.path, path), token
+
+    def close(self):
+        self.archive.close()
@@ -36,10 +36,35 @@ class BoundPartial:
         )
 
 
+def resolve_namespace(instance, template, parent):
+    '''
+    Returns dict of names resolved by NamespaceLookup for given template,
+    containing its partials bound to instance, template info attributes
+    and names resolved by parent. Class attributes of template info
+    (methods) are left out, so they're looked up the old way.
+    '''
+    resolved = dict(parent._ph_resolved) if parent else dict()
+    resolved.update((
+        (name, BoundPartial(instance, parent, name, partial))
+        for name, partial in template.partials.items()
+    ))
+    resolved.update(vars(template))
+    template_class = type(template)
+    for name in list(resolved):
+        if hasattr(template_class, name):
+            del resolved[name]
+    return resolved
+
+
 class NamespaceLookup:
     def __getattr__(self, name):
         #if name.startswith('_ph_'):
         #    getattr(super(NamespaceLookup, self), name)
+        try:
+            return self._ph_resolved[name]
+        except KeyError:
+            pass
+
         try:
             result = getattr(self._ph_template, name)
         except AttributeError:
@@ -63,12 +88,13 @@ class NamespaceLookup:
 
 
 class ParentProxy(NamespaceLookup):
-    __slots__ = ('_ph_instance', '_ph_template', '_ph_parent')
+    __slots__ = ('_ph_instance', '_ph_template', '_ph_parent', '_ph_resolved')
 
     def __init__(self, instance, template):
         self._ph_instance = instance
         self._ph_template = template
         self._ph_parent = None
+        self._ph_resolved = dict()
 
 
 class InstanceProxy(NamespaceLookup):
@@ -80,11 +106,17 @@ class InstanceProxy(NamespaceLookup):
         self._ph_template = template
         self._ph_parent = None
         self._ph_environment = environment
+        self._ph_resolved = dict()
 
-        last_one = self
+        proxies = [self]
         for parent_template in iiter:
-            last_one._ph_parent = parent = ParentProxy(self, parent_template)
-            last_one = parent 
+            proxies[-1]._ph_parent = parent = ParentProxy(self, parent_template)
+            proxies.append(parent)
+
+        # Resolve names once, starting with the topmost parent, like
+        # Python's MRO cache
+        for proxy in reversed(proxies):
+            proxy._ph_resolved = resolve_namespace(self, proxy._ph_template, proxy._ph_parent)
 
 
     def __repr__(self):
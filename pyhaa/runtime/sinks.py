@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+from functools import partial
+import os
+import socket
+
+from . import FLUSH
+
+DEFAULT_MAX_BYTES = 64 * 1024
+
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError): # pragma: no cover
+    IOV_MAX = 1024
+if IOV_MAX <= 0: # pragma: no cover
+    IOV_MAX = 1024
+
+def send_all(send, buffers):
+    '''
+    Calls vectored send function (like os.writev or socket.sendmsg) until
+    all the buffers are sent, dealing with partial writes.
+    '''
+    while True:
+        written = send(buffers)
+        for index, buffer in enumerate(buffers):
+            length = len(buffer)
+            if written < length:
+                break
+            written -= length
+        else:
+            return
+        buffers = [memoryview(buffers[index])[written:]] + buffers[index+1:]
+
+
+class VectoredSink:
+    '''
+    Gathers chunks of output and passes them to a file or socket
+    in a single vectored write, once count of gathered bytes or chunks
+    reaches given limit. Target may be a socket, file descriptor,
+    object with fileno method or - as a fallback - object with write method.
+    Sockets are expected to be blocking.
+    '''
+    def __init__(self, target, max_bytes=DEFAULT_MAX_BYTES, max_chunks=None):
+        self.buffers = list()
+        self.size = 0
+        self.written = 0
+        self.max_bytes = max_bytes
+        self.max_chunks = min(max_chunks or IOV_MAX, IOV_MAX)
+        self.send = self.get_send(target)
+
+    def get_send(self, target):
+        if isinstance(target, socket.socket):
+            return partial(send_all, target.sendmsg)
+
+        if hasattr(os, 'writev'):
+            fd = target
+            if not isinstance(target, int):
+                try:
+                    fd = target.fileno()
+                except (AttributeError, OSError):
+                    fd = None
+                else:
+                    # We're going to write past its buffer
+                    flush = getattr(target, 'flush', None)
+                    if flush:
+                        flush()
+            if fd is not None:
+                return partial(send_all, partial(os.writev, fd))
+
+        write = target.write
+        return lambda buffers: write(b''.join(buffers))
+
+    def write(self, chunk):
+        if not chunk:
+            if chunk is FLUSH:
+                self.flush()
+            return
+        self.buffers.append(chunk)
+        self.size += len(chunk)
+        if self.size >= self.max_bytes or len(self.buffers) >= self.max_chunks:
+            self.flush()
+
+    def flush(self):
+        if self.buffers:
+            self.send(self.buffers)
+            self.written += self.size
+            self.buffers = list()
+            self.size = 0
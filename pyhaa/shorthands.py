@@ -23,25 +23,162 @@ import io
 from .codegen.html import HTMLCodeGen
 from .parsing.lexer import pyhaa_lexer
 from .parsing.parser import PyhaaParser
-from .runtime import decapsulate_exceptions, EncapsulatedException
-from .utils import iter_flatten
+from .runtime import bind_writer, decapsulate_exceptions, EncapsulatedException, FLUSH
+from .runtime.sinks import DEFAULT_MAX_BYTES, VectoredSink
+from .utils import aiter_flatten, iter_flatten
 
 __all__ = (
+    'html_render_async',
     'html_render_to_iterator',
     'html_render_to_string',
+    'html_render_to_wsgi',
+    'render_to_bytes',
+    'render_to_writer',
+    'WSGIResponseIterator',
 )
 
+DEFAULT_WSGI_CHUNK_SIZE = 16 * 1024
+
+class WSGIResponseIterator:
+    '''
+    Iterator usable as WSGI response body. Gathers rendered output into
+    chunks of at least chunk_size bytes, flushing early when FLUSH marker
+    was rendered. Closing it closes template generators.
+    '''
+    def __init__(self, iterator, chunk_size=DEFAULT_WSGI_CHUNK_SIZE):
+        self.iterator = iterator
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunks = list()
+        size = 0
+        chunk_size = self.chunk_size
+        with decapsulate_exceptions():
+            for chunk in self.iterator:
+                if chunk is FLUSH:
+                    if chunks:
+                        break
+                    continue
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= chunk_size:
+                    break
+        if not chunks:
+            raise StopIteration
+        return b''.join(chunks)
+
+    def close(self):
+        close = getattr(self.iterator, 'close', None)
+        if close:
+            close()
+        self.iterator = iter(())
+
+async def aiter_decapsulated(iterator):
+    '''
+    Passes output of asynchronous iterator through, raising original
+    exceptions instead of encapsulated ones. Note that StopIteration can't
+    leave coroutine and is turned into RuntimeError by Python.
+    '''
+    with decapsulate_exceptions():
+        async for chunk in iterator:
+            yield chunk
+
 def html_render_to_iterator(template, function_name=None, args=None, kwargs=None):
     args = args or list()
     kwargs = kwargs or dict()
     function = template
     if function_name:
         function = getattr(template, function_name)
+    if template.output_mode == 'write':
+        # Writer mode partials run to the end at once, output is gathered
+        # before iterating
+        chunks = list()
+        with bind_writer(chunks.append):
+            function(*args, **kwargs)
+        return iter(chunks)
     return iter_flatten(function(*args, **kwargs))
 
+def html_render_async(template, function_name=None, args=None, kwargs=None):
+    '''
+    Returns asynchronous iterator over rendered output. Required for
+    templates compiled with HTMLAsyncCodeGen, works with others too.
+    '''
+    args = args or list()
+    kwargs = kwargs or dict()
+    if template.output_mode != 'async':
+        with decapsulate_exceptions():
+            iterator = html_render_to_iterator(template, function_name, args, kwargs)
+        return aiter_decapsulated(aiter_flatten(iterator))
+    function = template
+    if function_name:
+        function = getattr(template, function_name)
+    return aiter_decapsulated(aiter_flatten(function(*args, **kwargs)))
+
 def html_render_to_string(template, *args, **kwargs):
     with decapsulate_exceptions():
         iterator = html_render_to_iterator(template, *args, **kwargs)
         rendered = b''.join(iterator).decode(template.encoding)
         return rendered
 
+def html_render_to_wsgi(template, function_name=None, args=None, kwargs=None, chunk_size=DEFAULT_WSGI_CHUNK_SIZE):
+    '''
+    Returns WSGIResponseIterator over rendered output. Templates compiled
+    in writer mode can't be suspended, so they are rendered whole before
+    the first chunk is returned and don't stream.
+    '''
+    with decapsulate_exceptions():
+        iterator = html_render_to_iterator(template, function_name, args, kwargs)
+    return WSGIResponseIterator(iterator, chunk_size)
+
+def render_to_bytes(template, function_name=None, args=None, kwargs=None):
+    '''
+    Renders template into bytes object. Output is written directly into
+    buffer, without joining chunks. Buffer isn't presized from size of
+    previous output: BytesIO can't reserve memory without filling it,
+    and growing it is already amortized.
+    '''
+    args = args or list()
+    kwargs = kwargs or dict()
+    function = template
+    if function_name:
+        function = getattr(template, function_name)
+
+    buffer = io.BytesIO()
+    write = buffer.write
+
+    with decapsulate_exceptions():
+        if template.output_mode == 'write':
+            with bind_writer(write):
+                function(*args, **kwargs)
+        else:
+            for chunk in iter_flatten(function(*args, **kwargs)):
+                write(chunk)
+
+    return buffer.getvalue()
+
+def render_to_writer(template, target, function_name=None, args=None, kwargs=None, max_bytes=DEFAULT_MAX_BYTES, max_chunks=None):
+    '''
+    Renders template directly into file or socket, using vectored writes
+    of at most max_bytes or max_chunks gathered chunks. Returns count of
+    written bytes.
+    '''
+    args = args or list()
+    kwargs = kwargs or dict()
+    function = template
+    if function_name:
+        function = getattr(template, function_name)
+
+    sink = VectoredSink(target, max_bytes, max_chunks)
+    with decapsulate_exceptions():
+        if template.output_mode == 'write':
+            with bind_writer(sink.write):
+                function(*args, **kwargs)
+        else:
+            write = sink.write
+            for chunk in iter_flatten(function(*args, **kwargs)):
+                write(chunk)
+    sink.flush()
+    return sink.written
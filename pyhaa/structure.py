@@ -28,6 +28,8 @@ class PyhaaParent:
     def __init__(self, **kwargs):
         self.children = list()
         self.root = self
+        # Line of template source, set by parser
+        self.lineno = None
         super().__init__(**kwargs)
 
     def append(self, other):
@@ -46,6 +48,17 @@ class PyhaaParent:
     def __len__(self):
         return len(self.children)
 
+    def has_output(self):
+        '''
+        Checks if any of descendants is rendered to output
+        '''
+        for child in self.children:
+            if isinstance(child, (Tag, Text, Expression)):
+                return True
+            if isinstance(child, PyhaaParent) and child.has_output():
+                return True
+        return False
+
     def __repr__(self):
         return '<{} {} children>'.format(
             self.__class__.__name__,
@@ -70,6 +83,7 @@ class PyhaaNode:
         self.root = None
         self.prev_sibling = None
         self.next_sibling = None
+        self.lineno = None
         super().__init__(**kwargs)
 
     def append(self, other):
@@ -138,21 +138,73 @@ def one_iter(value):
 def iter_flatten(generator):
     iter_stack = list()
     current_iter = generator
-    while True:
-        try:
-            result = next(current_iter)
-        except StopIteration:
-            if not iter_stack:
-                break
-            current_iter = iter_stack.pop()
-            continue
-
-        if hasattr(result, '__next__'):
-            iter_stack.append(current_iter)
-            current_iter = result
-            continue
-
-        yield result
+    try:
+        while True:
+            try:
+                result = next(current_iter)
+            except StopIteration:
+                if not iter_stack:
+                    break
+                current_iter = iter_stack.pop()
+                continue
+
+            if hasattr(result, '__next__'):
+                iter_stack.append(current_iter)
+                current_iter = result
+                continue
+
+            yield result
+    finally:
+        # If we were closed (or failed) before exhausting iterators,
+        # close them too, innermost first
+        iter_stack.append(current_iter)
+        for iterator in reversed(iter_stack):
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+async def aiter_flatten(generator):
+    '''
+    Asynchronous counterpart of iter_flatten - flattens both asynchronous
+    and normal iterators
+    '''
+    iter_stack = list()
+    current_iter = generator
+    try:
+        while True:
+            if hasattr(current_iter, '__anext__'):
+                try:
+                    result = await current_iter.__anext__()
+                except StopAsyncIteration:
+                    if not iter_stack:
+                        break
+                    current_iter = iter_stack.pop()
+                    continue
+            else:
+                try:
+                    result = next(current_iter)
+                except StopIteration:
+                    if not iter_stack:
+                        break
+                    current_iter = iter_stack.pop()
+                    continue
+
+            if hasattr(result, '__anext__') or hasattr(result, '__next__'):
+                iter_stack.append(current_iter)
+                current_iter = result
+                continue
+
+            yield result
+    finally:
+        iter_stack.append(current_iter)
+        for iterator in reversed(iter_stack):
+            aclose = getattr(iterator, 'aclose', None)
+            if aclose:
+                await aclose()
+                continue
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
 
 def sequence_flatten(seq):
     if isinstance(seq, (bytes, str)) or not hasattr(seq, '__iter__'):
@@ -105,9 +105,7 @@ def prepare_for_tag(name, id_, classes, attributes_set, do_byte_encode = False,
     name = name or x_div
     return name, result
 
-def open_tag(name, attributes, self_close):
-    yield b'<'
-    yield name
+def tag_attributes(attributes):
     for key, value in attributes.items():
         if value is True:
             value = key
@@ -117,6 +115,11 @@ def open_tag(name, attributes, self_close):
         yield b'="'
         yield value
         yield b'"'
+
+def open_tag(name, attributes, self_close):
+    yield b'<'
+    yield name
+    yield from tag_attributes(attributes)
     if self_close:
         yield b' />'
     else:
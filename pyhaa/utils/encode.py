@@ -21,6 +21,7 @@
 import re
 
 from . import (
+    aiter_flatten,
     dict_sub,
     iter_flatten,
 )
@@ -330,6 +331,10 @@ def generator_encode(value, do_byte_encode = True, do_entity_encode = False, enc
     for sub_value in iter_flatten(value):
         yield single_encode(sub_value, do_byte_encode, do_entity_encode, encoding, False, stringify)
 
+async def async_generator_encode(value, do_byte_encode = True, do_entity_encode = False, encoding = 'utf-8', stringify = False):
+    async for sub_value in aiter_flatten(value):
+        yield single_encode(sub_value, do_byte_encode, do_entity_encode, encoding, False, stringify)
+
 def single_encode(value, do_byte_encode = True, do_entity_encode = False, encoding = 'utf-8', allow_generators = False, stringify = False):
     if isinstance(value, bytes):
         return value
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+'''
+Parsing python snippets of templates. Trees are cached and shared between
+parser (checking syntax) and AST codegen, so they must never be modified -
+codegen puts positioned copies into generated module.
+'''
+
+import ast
+import functools
+
+from .sourcemap import WHOLE_LINE
+
+__all__ = (
+    'locate_node',
+    'parse_snippet',
+    'place_snippet',
+)
+
+SNIPPET_CACHE_SIZE = 4096
+
+@functools.lru_cache(maxsize=SNIPPET_CACHE_SIZE)
+def parse_snippet(code):
+    '''
+    Returns module parsed from given code, raises SyntaxError
+    '''
+    return ast.parse(code)
+
+def place_snippet(node, lineno):
+    '''
+    Returns copy of parsed node (or list of nodes) spanning whole given line
+    '''
+    if isinstance(node, list):
+        return [place_snippet(item, lineno) for item in node]
+    copy = node.__class__()
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if isinstance(value, list):
+            value = [
+                place_snippet(item, lineno) if isinstance(item, ast.AST) else item
+                for item in value
+            ]
+        elif isinstance(value, ast.AST) and (value._fields or value._attributes):
+            # Contexts and operators have no state, may be shared
+            value = place_snippet(value, lineno)
+        setattr(copy, name, value)
+    if node._attributes:
+        copy.lineno = copy.end_lineno = lineno
+        copy.col_offset = 0
+        copy.end_col_offset = WHOLE_LINE
+    return copy
+
+def locate_node(node, lineno):
+    '''
+    Sets positions of nodes built by codegen, placed snippets are left as
+    they are
+    '''
+    if node._attributes:
+        if getattr(node, 'lineno', None) is not None:
+            return
+        node.lineno = node.end_lineno = lineno
+        node.col_offset = 0
+        node.end_col_offset = WHOLE_LINE
+    for name in node._fields:
+        value = getattr(node, name, None)
+        if isinstance(value, list):
+            for item in value:
+                if isinstance(item, ast.AST):
+                    locate_node(item, lineno)
+        elif isinstance(value, ast.AST):
+            locate_node(value, lineno)
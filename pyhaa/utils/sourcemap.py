@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+'''
+Making tracebacks and profilers point at template lines: rewriting line
+numbers of generated code using source map written by codegen, and
+registering sources in linecache.
+'''
+
+import ast
+from bisect import bisect_right
+import hashlib
+import io
+import linecache
+from threading import Lock
+import tokenize
+import weakref
+
+__all__ = (
+    'acquire_source',
+    'decode_code',
+    'discard_source',
+    'find_source_map',
+    'register_source',
+    'remap_lines',
+    'source_filename',
+)
+
+# End column of nodes, past end of any template line
+WHOLE_LINE = 0xFFFF
+
+# Number of owners of sources registered in linecache, by file name
+_source_owners = dict()
+_source_owners_lock = Lock()
+
+def decode_code(code):
+    '''
+    Decodes generated code using encoding from its coding comment
+    '''
+    encoding, _ = tokenize.detect_encoding(io.BytesIO(code).readline)
+    return code.decode(encoding)
+
+def find_source_map(tree):
+    '''
+    Returns source map assigned to template info in parsed generated code,
+    or None
+    '''
+    for statement in reversed(tree.body):
+        if not isinstance(statement, ast.Assign) or len(statement.targets) != 1:
+            continue
+        target = statement.targets[0]
+        if (
+            isinstance(target, ast.Attribute) and target.attr == 'source_map' and
+            isinstance(target.value, ast.Name) and target.value.id == '_ph_template_info'
+        ):
+            return ast.literal_eval(statement.value)
+    return None
+
+def remap_lines(tree, source_map):
+    '''
+    Replaces positions of nodes in parsed generated code with template
+    lines. Lines not generated by any template node (imports, function
+    definitions of template body) get line 1. Columns mean nothing in
+    template, so nodes span whole lines - then tracebacks don't mark them.
+    '''
+    lines = [line for line, _ in source_map]
+
+    def template_lineno(lineno):
+        idx = bisect_right(lines, lineno)
+        if not idx:
+            return 1
+        return source_map[idx-1][1] or 1
+
+    for node in ast.walk(tree):
+        lineno = getattr(node, 'lineno', None)
+        if lineno is None:
+            continue
+        node.lineno = template_lineno(lineno)
+        end_lineno = getattr(node, 'end_lineno', None) or lineno
+        node.end_lineno = max(node.lineno, template_lineno(end_lineno))
+        node.col_offset = 0
+        node.end_col_offset = WHOLE_LINE
+    return tree
+
+def source_filename(source, kind='pyhaa'):
+    '''
+    Returns name unique for contents of source, under which it's put in
+    linecache by register_source
+    '''
+    digest = hashlib.sha1(source.encode('utf-8')).hexdigest()[:16]
+    return '<{}-{}>'.format(kind, digest)
+
+def register_source(source, kind='pyhaa', filename=None):
+    '''
+    Puts source in linecache under name unique for its contents and
+    returns that name, to be used as file name of compiled code
+    '''
+    if filename is None:
+        filename = source_filename(source, kind)
+    with _source_owners_lock:
+        if filename not in linecache.cache:
+            # Entries without modification time are never invalidated by
+            # linecache, they're removed when their last owner is gone
+            linecache.cache[filename] = (
+                len(source),
+                None,
+                source.splitlines(True),
+                filename,
+            )
+        _source_owners.setdefault(filename, 0)
+    return filename
+
+def discard_source(filename):
+    '''
+    Removes source from linecache if nothing acquired it - used when code
+    compiled from it failed to run
+    '''
+    with _source_owners_lock:
+        if _source_owners.get(filename, 1):
+            return
+        del _source_owners[filename]
+        linecache.cache.pop(filename, None)
+
+def acquire_source(filename, owner):
+    '''
+    Keeps source registered under given file name in linecache as long as
+    owner (template info of code compiled from it) exists
+    '''
+    with _source_owners_lock:
+        if filename not in _source_owners:
+            return
+        _source_owners[filename] += 1
+    weakref.finalize(owner, _release_source, filename)
+
+def _release_source(filename):
+    with _source_owners_lock:
+        owners = _source_owners[filename] - 1
+        if owners:
+            _source_owners[filename] = owners
+            return
+        del _source_owners[filename]
+        linecache.cache.pop(filename, None)
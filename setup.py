@@ -8,7 +8,7 @@ if sys.version_info < (3,):
 setup(
     name = 'pyhaa',
     version = '0.0',
-    packages = find_packages(exclude=['tests']),
+    packages = find_packages(exclude=['tests', 'benchmarks']),
     author = 'Tomasz Kowalczyk',
     author_email = 'code@fluxid.pl',
     description = 'Standalone templating system inspired by HAML',
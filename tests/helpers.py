@@ -19,6 +19,7 @@
 # <http://www.gnu.org/licenses/>.
 
 import logging
+import os
 from unittest import TestCase
 
 from pyhaa import (
@@ -44,6 +45,16 @@ class PyhaaTestCase(TestCase):
     def setUp(self):
         self.senv = PyhaaEnvironment()
 
+    def touch_future(self, path, seconds=10):
+        '''
+        Moves modification time of file into future, it's restored after
+        the test
+        '''
+        stat = os.stat(path)
+        self.addCleanup(os.utime, path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        newtime = stat.st_mtime + seconds
+        os.utime(path, (newtime, newtime))
+
     def assertPSE(self, _eid, _func, *args, **kwargs):
         '''
         PSE is short of PyhaaSyntaxError... It is too long so I abbreviated it
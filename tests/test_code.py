@@ -24,6 +24,7 @@
 from pyhaa import (
     structure,
 )
+from pyhaa.parsing import matchers
 
 from .helpers import jl, PyhaaTestCase
 
@@ -122,6 +123,17 @@ class TestCode(PyhaaTestCase):
         self.assertEqual(s1.name, 'for')
         self.assertEqual(s2.name, 'for')
 
+    def test_async_for_statement(self):
+        tree = self.senv.parse_string(jl(
+            '-async  for a in b(): %tag',
+        )).tree
+        s1, = tree
+        t1, = s1
+        self.assert_(isinstance(s1, structure.CompoundStatement))
+        self.assert_(isinstance(t1, structure.Tag))
+        self.assertEqual(s1.content, 'async for a in b():')
+        self.assertEqual(s1.name, 'async for')
+
     def test_simple_statement_name(self):
         tree = self.senv.parse_string(jl(
             '-return(1)',
@@ -136,3 +148,29 @@ class TestCode(PyhaaTestCase):
         self.assertEqual(s2.name, 'break')
         self.assertEqual(s3.name, 'assert')
 
+    def test_simple_snippets(self):
+        matcher = matchers.PythonExpressionMatcher(break_at_colon=True)
+        self.assertEqual(matcher.match_simple('user.name\n'), 'user.name')
+        self.assertEqual(matcher.match_simple('f(a.b, 1, "c") :\n'), 'f(a.b, 1, "c")')
+        self.assertEqual(matcher.match_simple('a + b\n'), None)
+        self.assertEqual(matcher.match_simple('a := b\n'), None)
+        self.assertEqual(matcher.match_simple('not a\n'), None)
+        target = matchers.PythonTargetMatcher()
+        self.assertEqual(target.match_simple('item.value in items:\n'), 'item.value')
+        self.assertEqual(target.match_simple('f() in items:\n'), None)
+
+    def test_snippet_validation_cache(self):
+        matchers.validate_snippet.cache_clear()
+        template = jl(
+            '=a + b',
+            '%p =a + b',
+            '=user.name',
+        )
+        self.senv.parse_string(template)
+        info = matchers.validate_snippet.cache_info()
+        # Second a + b is cached, user.name doesn't need validation
+        self.assertEqual((info.hits, info.misses), (1, 1))
+        tree = self.senv.parse_string(template).tree
+        self.assertEqual(matchers.validate_snippet.cache_info().hits, 3)
+        code1, tag, code2 = tree
+        self.assertEqual(code2.content, 'user.name')
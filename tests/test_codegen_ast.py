@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+'''
+Test HTML code generation
+'''
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import ast
+import traceback
+
+from pyhaa import (
+    html_render_to_string,
+    PyhaaEnvironment,
+)
+from pyhaa.codegen.astgen import (
+    HTMLASTCodeGen,
+    HTMLAsyncASTCodeGen,
+    HTMLWriterASTCodeGen,
+)
+from pyhaa.parsing.matchers import validate_snippet
+from pyhaa.utils.snippets import parse_snippet
+
+from . import test_codegen_html
+from .helpers import jl
+
+
+class TestCodegenHtmlAST(test_codegen_html.TestCodegenHtml):
+    '''
+    Runs all the HTML codegen tests against templates built as AST
+    '''
+    def setUp(self):
+        self.senv = PyhaaEnvironment(codegen_class=HTMLASTCodeGen)
+
+    def test_compound_statements(self):
+        template = self.senv.get_template_from_string(jl(
+            '-for i in arguments:',
+            '  -if i == 1:',
+            '    %a =i',
+            '  -elif i == 2:',
+            '    -continue',
+            '  -else:',
+            '    %b =i',
+            '-else:',
+            '  %i end',
+        ))
+        self.assertEqual(
+            html_render_to_string(template, args=(1, 2, 3)),
+            '<a>1</a><b>3</b><i>end</i>',
+        )
+
+    def test_debug_source(self):
+        code = self.senv.codegen_structure(self.senv.parse_string(jl(
+            '`def title(name):',
+            '  %b =name',
+            '=self.title("a")',
+        )))
+        self.assertIsInstance(code, ast.Module)
+        source = self.senv.debug_source(code)
+        self.assertIn('def title(self, parent, name):', source)
+        self.assertNotIn('source_map', source)
+        compile(source, '<string>', 'exec')
+
+    def test_snippets_shared_with_parser(self):
+        validate_snippet.cache_clear()
+        parse_snippet.cache_clear()
+        structure = self.senv.parse_string('=arguments[0] + arguments[1]')
+        self.assertEqual(parse_snippet.cache_info().hits, 0)
+        self.senv.codegen_structure(structure)
+        self.assertGreater(parse_snippet.cache_info().hits, 0)
+
+    def test_traceback_lines(self):
+        source = jl(
+            '%ul',
+            '  - for i in range(3):',
+            '    %li =10 // (2 - i)',
+        )
+        for remap_lines, line, prefix in (
+            (True, '%li =10 // (2 - i)', '<pyhaa-template-'),
+            (False, 'yield _ph_single_encode(10 // (2 - i), True, True, self.encoding, True, True)', '<pyhaa-generated-'),
+        ):
+            environment = PyhaaEnvironment(codegen_class=HTMLASTCodeGen, remap_lines=remap_lines)
+            template = environment.get_template_from_string(source)
+            try:
+                html_render_to_string(template)
+            except ZeroDivisionError as exc:
+                frame = traceback.extract_tb(exc.__traceback__)[-1]
+            else:
+                self.fail('No exception raised')
+            self.assertEqual(frame.line, line)
+            self.assertTrue(frame.filename.startswith(prefix))
+
+
+class TestCodegenHtmlWriterAST(test_codegen_html.TestCodegenHtmlWriter):
+    def setUp(self):
+        self.senv = PyhaaEnvironment(codegen_class=HTMLWriterASTCodeGen)
+
+
+class TestCodegenHtmlAsyncAST(test_codegen_html.TestCodegenHtmlAsync):
+    def setUp(self):
+        self.senv = PyhaaEnvironment(codegen_class=HTMLAsyncASTCodeGen)
@@ -22,11 +22,21 @@ Test HTML code generation
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import asyncio
 import io
+import socket
+import tempfile
+import threading
 
 from pyhaa import (
+    html_render_async,
     html_render_to_string,
+    html_render_to_wsgi,
+    PyhaaEnvironment,
+    render_to_bytes,
+    render_to_writer,
 )
+from pyhaa.codegen.html import HTMLAsyncCodeGen, HTMLWriterCodeGen
 
 from .helpers import jl, PyhaaTestCase
 
@@ -62,6 +72,26 @@ class TestCodegenHtml(PyhaaTestCase):
             '<div class="c"></div>',
         )
 
+    def test_partially_static_tags(self):
+        template = self.senv.get_template_from_string(jl(
+            '%a#x.c(title="t"){"href": arguments[0], "data": None, "checked": True}',
+            '  %b{"id": arguments[1]} Text',
+            '%br{"x": arguments[1]}',
+        ))
+        code = self.senv.debug_source(self.senv.codegen_structure(self.senv.parse_string(jl(
+            '%a#x.c(title="t"){"href": arguments[0]}',
+        ))))
+        # Runtime helpers are always imported, look at the body only
+        body = code[code.index('def __body__'):]
+        self.assertNotIn('_ph_open_tag', body)
+        self.assertNotIn('_ph_close_tag', body)
+        rendered = html_render_to_string(template, args=('&', 'y'))
+        self.assertEqual(
+            rendered,
+            '<a title="t" href="&amp;" checked="checked" class="c" id="x">'
+            '<b id="y">Text</b></a><br x="y" />',
+        )
+
     def test_html_encode_toggle_and_text(self):
         template = self.senv.get_template_from_string(jl(
             '&',
@@ -96,6 +126,18 @@ class TestCodegenHtml(PyhaaTestCase):
             '&amp;&amp;',
         )
 
+    def test_none_expression(self):
+        template = self.senv.get_template_from_string(jl(
+            '`def empty()',
+            '=arguments[0]',
+            '=self.empty()',
+        ))
+        rendered = html_render_to_string(template, args=(None,))
+        self.assertEqual(
+            rendered,
+            'None',
+        )
+
     def test_while_if(self):
         template = self.senv.get_template_from_string(jl(
             '-my_iter = iter(arguments)',
@@ -213,3 +255,204 @@ class TestCodegenHtml(PyhaaTestCase):
         else:
             self.fail('No proper exception raised')
 
+    def test_wsgi_chunks(self):
+        template = self.senv.get_template_from_string(jl(
+            '%ul',
+            '  -for value in arguments:',
+            '    %li =value',
+            '    -if value == "2": =_ph_FLUSH',
+        ))
+        args = ('1', '2', '3', '4')
+        response = html_render_to_wsgi(template, args=args, chunk_size=10)
+        self.assertSequenceEqual(
+            list(response),
+            [b'<ul><li>1</li>', b'<li>2</li>', b'<li>3</li>', b'<li>4</li>', b'</ul>'],
+        )
+        response = html_render_to_wsgi(template, args=args, chunk_size=100)
+        self.assertSequenceEqual(
+            list(response),
+            [b'<ul><li>1</li><li>2</li>', b'<li>3</li><li>4</li></ul>'],
+        )
+        response = html_render_to_wsgi(template, args=args, chunk_size=10)
+        self.assertEqual(next(response), b'<ul><li>1</li>')
+        response.close()
+        self.assertSequenceEqual(list(response), [])
+
+    def test_flush_prefixed(self):
+        # Marker doesn't take plain name in template namespace
+        template = self.senv.get_template_from_string(jl(
+            '=FLUSH',
+        ))
+        self.assertRaises(NameError, html_render_to_string, template)
+
+    def test_render_to_writer(self):
+        template = self.senv.get_template_from_string(jl(
+            '%ul',
+            '  -for value in range(arguments[0]):',
+            '    %li =str(value)',
+        ))
+        expected = html_render_to_string(template, args=(500,)).encode('utf-8')
+
+        with tempfile.TemporaryFile() as fp:
+            fp.write(b'>')
+            written = render_to_writer(template, fp, args=(500,), max_bytes=100)
+            self.assertEqual(written, len(expected))
+            fp.seek(0)
+            self.assertEqual(fp.read(), b'>' + expected)
+
+        received = []
+        sock_a, sock_b = socket.socketpair()
+        def receive():
+            received.extend(iter(lambda: sock_b.recv(4096), b''))
+        thread = threading.Thread(target=receive)
+        thread.start()
+        try:
+            written = render_to_writer(template, sock_a, args=(500,), max_chunks=7)
+        finally:
+            sock_a.close()
+            thread.join()
+            sock_b.close()
+        self.assertEqual(written, len(expected))
+        self.assertEqual(b''.join(received), expected)
+
+        bio = io.BytesIO()
+        render_to_writer(template, bio, args=(500,))
+        self.assertEqual(bio.getvalue(), expected)
+
+
+class TestCodegenHtmlWriter(TestCodegenHtml):
+    '''
+    Runs all the tests above against templates compiled in writer mode
+    '''
+    def setUp(self):
+        self.senv = PyhaaEnvironment(codegen_class=HTMLWriterCodeGen)
+
+    def test_partial_return_value(self):
+        template = self.senv.get_template_from_string(jl(
+            '`def title():',
+            '  %b title',
+            '  -return "!"',
+            '-value = self.title()',
+            '=value',
+        ))
+        rendered = html_render_to_string(template)
+        self.assertEqual(
+            rendered,
+            '<b>title</b>!',
+        )
+
+    def test_partial_bare_return(self):
+        template = self.senv.get_template_from_string(jl(
+            '`def title():',
+            '  %b title',
+            '  -return',
+            '=self.title()',
+        ))
+        rendered = html_render_to_string(template)
+        self.assertEqual(
+            rendered,
+            '<b>title</b>',
+        )
+
+    def test_render_to_bytes(self):
+        template = self.senv.get_template_from_string(jl(
+            '%ul',
+            '  -for value in arguments:',
+            '    %li =value',
+        ))
+        rendered = render_to_bytes(template, args=('1', '2', '3'))
+        self.assertEqual(
+            rendered,
+            b'<ul><li>1</li><li>2</li><li>3</li></ul>',
+        )
+        rendered = render_to_bytes(template, args=('1',))
+        self.assertEqual(
+            rendered,
+            b'<ul><li>1</li></ul>',
+        )
+
+
+class TestCodegenHtmlAsync(PyhaaTestCase):
+    def setUp(self):
+        self.senv = PyhaaEnvironment(codegen_class=HTMLAsyncCodeGen)
+
+    def render(self, template, **kwargs):
+        async def render():
+            return b''.join([
+                chunk
+                async for chunk in html_render_async(template, **kwargs)
+            ]).decode(template.encoding)
+        return asyncio.run(render())
+
+    def test_await_and_async_for(self):
+        async def rows(count):
+            for i in range(count):
+                await asyncio.sleep(0)
+                yield str(i)
+
+        async def fetch(value):
+            await asyncio.sleep(0)
+            return value + '!'
+
+        template = self.senv.get_template_from_string(jl(
+            '-rows, fetch = arguments',
+            '%ul',
+            '  -async for value in rows(3):',
+            '    %li =await fetch(value)',
+        ))
+        self.assertEqual(
+            self.render(template, args=(rows, fetch)),
+            '<ul><li>0!</li><li>1!</li><li>2!</li></ul>',
+        )
+
+    def test_partials(self):
+        template = self.senv.get_template_from_string(jl(
+            '`def hello(name):',
+            '  %b =name',
+            '`def empty()',
+            '=self.hello("a")',
+            '=self.empty()',
+            '=(x for x in "bc")',
+        ))
+        self.assertEqual(
+            self.render(template),
+            '<b>a</b>bc',
+        )
+
+    def test_exception_decapsulation(self):
+        for senv in (self.senv, PyhaaEnvironment(), PyhaaEnvironment(codegen_class=HTMLWriterCodeGen)):
+            template = senv.get_template_from_string(jl(
+                '%p text',
+                '-raise ValueError("hello")',
+            ))
+            with self.assertRaises(ValueError) as cm:
+                self.render(template)
+            self.assertSequenceEqual(cm.exception.args, ('hello',))
+
+            template = senv.get_template_from_string(jl(
+                '-a = iter(range(3))',
+                '-while True:',
+                '  =str(next(a))',
+            ))
+            # Python doesn't let StopIteration out of coroutines
+            with self.assertRaises(RuntimeError) as cm:
+                self.render(template)
+            self.assertIsInstance(cm.exception.__cause__, StopIteration)
+
+    def test_none_expression(self):
+        template = self.senv.get_template_from_string(jl(
+            '=arguments[0]',
+        ))
+        self.assertEqual(
+            self.render(template, args=(None,)),
+            'None',
+        )
+
+    def test_sync_template(self):
+        template = PyhaaEnvironment().get_template_from_string(jl(
+            '%p =arguments[0]',
+        ))
+        self.assertEqual(
+            self.render(template, args=('a',)),
+            '<p>a</p>',
+        )
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+'''
+'''
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+
+from pyhaa import (
+    html_render_to_string,
+    PyhaaEnvironment,
+)
+from pyhaa.__main__ import main
+from pyhaa.codegen.html import HTMLWriterCodeGen
+from pyhaa.compiler import build_archive, compile_templates, find_templates
+from pyhaa.runtime.cache import FilesystemBytecodeCache
+from pyhaa.runtime.loaders import ArchiveLoader, FilesystemLoader
+
+from .helpers import PyhaaTestCase
+
+class TestCompiler(PyhaaTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.loader_options = dict(
+            paths = './tests/files/partials',
+            input_encoding = 'utf-8',
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_find_templates(self):
+        loader = FilesystemLoader(paths='./tests/files/lookup_tests/main')
+        self.assertEqual(
+            find_templates(loader),
+            ['common/parts/first.pha', 'common/parts/second.pha', 'pages/page.pha'],
+        )
+
+    def test_compile(self):
+        bytecode_cache = FilesystemBytecodeCache(self.cache_dir)
+        report = compile_templates(bytecode_cache, self.loader_options, jobs=1)
+        self.assertEqual(sorted(report.compiled), ['base.pha', 'page.pha'])
+        self.assertFalse(report.failed)
+        self.assertEqual(set(report.compiled['page.pha']), set(('load', 'parse', 'codegen', 'compile')))
+
+        report = compile_templates(bytecode_cache, self.loader_options, incremental=True, jobs=1)
+        self.assertEqual(sorted(report.skipped), ['base.pha', 'page.pha'])
+        self.assertFalse(report.compiled)
+
+        # Templates are loaded from cache, not compiled
+        class MyLoader(FilesystemLoader):
+            def get_bytecode(self, *args, **kwargs):
+                raise AssertionError('Template compiled')
+
+        environment = PyhaaEnvironment(loader=MyLoader(bytecode_cache=bytecode_cache, **self.loader_options))
+        self.assertEqual(
+            html_render_to_string(environment.get_template('page.pha')),
+            '<html><head><title>Subpage - Web page</title></head><body><h1>Hello</h1></body></html>',
+        )
+
+        # Templates compiled with other settings aren't used
+        key = environment.compilation_key()
+        self.assertIsNotNone(bytecode_cache.get('page.pha', key))
+        for options in (dict(optimization_level=0), dict(codegen_class=HTMLWriterCodeGen)):
+            other_key = PyhaaEnvironment(**options).compilation_key()
+            self.assertNotEqual(other_key, key)
+            self.assertIsNone(bytecode_cache.get('page.pha', other_key))
+            report = compile_templates(
+                bytecode_cache,
+                self.loader_options,
+                environment_options = options,
+                incremental = True,
+                jobs = 1,
+            )
+            self.assertEqual(sorted(report.compiled), ['base.pha', 'page.pha'])
+
+    def test_main(self):
+        self.assertEqual(main([
+            'compile',
+            '--cache-dir', self.cache_dir,
+            '--jobs', '1',
+            '--input-encoding', 'utf-8',
+            './tests/files/partials',
+        ]), 0)
+
+    def test_archive(self):
+        archive_path = os.path.join(self.cache_dir, 'templates.pharc')
+        for optimization_level in (1, 2):
+            report = build_archive(
+                archive_path,
+                self.loader_options,
+                dict(optimization_level=optimization_level),
+                jobs = 1,
+            )
+            self.assertEqual(sorted(report.compiled), ['base.pha', 'page.pha'])
+
+            loader = ArchiveLoader(archive_path)
+            try:
+                self.assertEqual(sorted(loader.archive), ['base.pha', 'page.pha'])
+                # Level 2 recompiles templates from sources kept in archive
+                environment = PyhaaEnvironment(loader=loader, optimization_level=optimization_level)
+                self.assertEqual(
+                    html_render_to_string(environment.get_template('page.pha')),
+                    '<html><head><title>Subpage - Web page</title></head><body><h1>Hello</h1></body></html>',
+                )
+                self.assertRaises(Exception, environment.get_template, 'missing.pha')
+            finally:
+                loader.close()
+
+            # Archive built with other settings is rejected
+            for options in (
+                dict(optimization_level=0),
+                dict(optimization_level=optimization_level, codegen_class=HTMLWriterCodeGen),
+            ):
+                loader = ArchiveLoader(archive_path)
+                try:
+                    environment = PyhaaEnvironment(loader=loader, **options)
+                    self.assertRaises(Exception, environment.get_template, 'page.pha')
+                finally:
+                    loader.close()
+
+        # Failed build leaves old archive in place
+        broken_path = os.path.join(self.cache_dir, 'broken')
+        os.mkdir(broken_path)
+        with open(os.path.join(broken_path, 'broken.pha'), 'w') as fp:
+            fp.write('`def incomplete():\n\n%')
+        self.assertEqual(main([
+            'archive',
+            '--output', archive_path,
+            '--jobs', '1',
+            broken_path,
+        ]), 1)
+        loader = ArchiveLoader(archive_path)
+        self.assertIn('page.pha', loader.archive)
+        loader.close()
@@ -159,6 +159,16 @@ class TestErrors(PyhaaTestCase):
             '%{;}',
         )
 
+    def test_syntax_error_position(self):
+        # Position counts characters, not bytes of non-ASCII identifiers
+        for template in ('=ab cd', '=ąę ęą'):
+            exc = self.assertPSE(
+                'PYTHON_SYNTAX_ERROR',
+                self.senv.parse_string,
+                template,
+            )
+            self.assertEqual(exc.get_value('current_pos'), 4)
+
     def test_invalid_python_attributes(self):
         self.assertPSE(
             'INVALID_PYTHON_ATTRIBUTES',
@@ -166,6 +176,13 @@ class TestErrors(PyhaaTestCase):
             '%{1}',
         )
 
+    def test_invalid_python_target(self):
+        self.assertPSE(
+            'INVALID_PYTHON_TARGET',
+            self.senv.parse_string,
+            '-for f() in a: %p',
+        )
+
     def test_id_already_set(self):
         self.assertPSE(
             'ID_ALREADY_SET',
@@ -22,14 +22,17 @@ Test template inheritance
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import gc
 import os
 import os.path
 import tempfile
+import threading
 
 from pyhaa import (
     html_render_to_string,
     PyhaaEnvironment,
 )
+from pyhaa.runtime.cache import LRUCache
 from pyhaa.runtime.loaders import FilesystemLoader
 
 from .helpers import PyhaaTestCase
@@ -83,3 +86,64 @@ class TestLoaders(PyhaaTestCase):
             'loop2_A.pha',
         )
 
+    def test_resolution_table(self):
+        template = self.environment.get_template('comp_E.pha')
+        proxies = []
+        proxy = template
+        while proxy:
+            proxies.append(proxy)
+            proxy = proxy._ph_parent
+        self.assertEqual(
+            [proxy.template_name for proxy in proxies],
+            ['comp_E.pha', 'comp_D.pha', 'comp_C.pha', 'comp_B.pha', 'comp_A.pha'],
+        )
+        for proxy in proxies:
+            # Partials are bound once, when instance is created
+            self.assertIs(proxy.__body__, proxy.__body__)
+            self.assertIs(proxy.__body__.parent, proxy._ph_parent)
+            self.assertIs(proxy.__body__.instance, template)
+        self.assertEqual(template.get_partial('__body__'), template._ph_template.partials['__body__'])
+        self.assertRaises(AttributeError, getattr, template, 'nonexistent')
+
+    def test_chain_memoization(self):
+        template_info = self.environment.get_template_info('comp_E.pha')
+        chain = self.environment.get_inheritance_chain(template_info)
+        self.assertEqual(self.environment.get_inheritance_chain(template_info), chain)
+        self.assertIn(tuple(chain[1:]), self.environment.inheritance_chains[template_info].values())
+
+        # Reloading any member of chain invalidates it
+        self.touch_future('./tests/files/inheritance/comp_A.pha')
+        new_chain = self.environment.get_inheritance_chain(template_info)
+        self.assertIsNot(new_chain[-1], chain[-1])
+        self.assertEqual(new_chain[:-1], chain[:-1])
+        self.assertIs(new_chain[-1], self.environment.get_template_info('comp_A.pha'))
+        self.assertNotIn(tuple(chain[1:]), self.environment.inheritance_chains[template_info].values())
+
+    def test_chain_forgotten_on_eviction(self):
+        # Cache keeps only last loaded template
+        loader = FilesystemLoader(
+            paths = './tests/files/inheritance',
+            input_encoding = 'utf-8',
+            template_cache = LRUCache(1),
+        )
+        environment = PyhaaEnvironment(loader = loader)
+        template_info = environment.get_template_info('comp_E.pha')
+        chain = environment.get_inheritance_chain(template_info)
+        self.assertEqual(len(environment.inheritance_chains), 1)
+        self.assertNotIn('comp_E.pha', loader.template_cache)
+        del template_info, chain
+        gc.collect()
+        self.assertEqual(len(environment.inheritance_chains), 0)
+
+    def test_chain_lock(self):
+        template_info = self.environment.get_template_info('comp_E.pha')
+        self.environment.get_inheritance_chain(template_info)
+        thread = threading.Thread(target=self.environment.template_expired, args=(template_info,))
+        with self.environment.chains_lock:
+            thread.start()
+            thread.join(0.05)
+            # Invalidation waits until memoized chains aren't used
+            self.assertTrue(thread.is_alive())
+            self.assertIn(template_info, self.environment.inheritance_chains)
+        thread.join()
+        self.assertNotIn(template_info, self.environment.inheritance_chains)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+'''
+'''
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+
+from pyhaa import (
+    html_render_to_string,
+    PyhaaEnvironment,
+    structure,
+)
+from pyhaa.optimizer import evaluate_constant
+
+from .helpers import jl, PyhaaTestCase
+
+class TestOptimizer(PyhaaTestCase):
+    def assertSameOutput(self, source, *args):
+        unoptimized = PyhaaEnvironment(optimization_level=0)
+        expected = html_render_to_string(unoptimized.get_template_from_string(source), args=args)
+        rendered = html_render_to_string(self.senv.get_template_from_string(source), args=args)
+        self.assertEqual(rendered, expected)
+        return rendered
+
+    def test_evaluate_constant(self):
+        self.assertEqual(evaluate_constant('1+1'), (True, 2))
+        self.assertEqual(evaluate_constant(' "a" * 2 '), (True, 'aa'))
+        self.assertEqual(evaluate_constant('not 0 and 2 < 3'), (True, True))
+        self.assertEqual(evaluate_constant('1/0'), (False, None))
+        self.assertEqual(evaluate_constant('"a" * 10**9'), (False, None))
+        self.assertEqual(evaluate_constant('a + 1'), (False, None))
+
+    def test_constant_folding(self):
+        structure_ = self.senv.optimize_structure(self.senv.parse_string(jl(
+            'a',
+            '=1+1',
+            '?="<"',
+            'b',
+        )))
+        text, = structure_.tree
+        self.assert_(isinstance(text, structure.Text))
+        self.assertEqual(text.content, 'a2<b')
+        self.assertEqual(text.escape, False)
+        rendered = self.assertSameOutput(jl(
+            'a',
+            '=1+1',
+            '?="<"',
+            'b',
+        ))
+        self.assertEqual(rendered, 'a2<b')
+
+    def test_dead_branches(self):
+        structure_ = self.senv.optimize_structure(self.senv.parse_string(jl(
+            'a',
+            '-if False:',
+            '  x',
+            'b',
+            '-while 0:',
+            '  y',
+            '-if True:',
+            '  c',
+        )))
+        text, = structure_.tree
+        self.assertEqual(text.content, 'abc')
+        self.assertSameOutput(jl(
+            '-if arguments[0]:',
+            '  a',
+            '-elif 0:',
+            '  b',
+            '-elif 1:',
+            '  c',
+            '-else:',
+            '  d',
+            '-if 0:',
+            '  e',
+            '-elif arguments[0]:',
+            '  f',
+            '-else:',
+            '  g',
+            '-for i in range(2):',
+            '  -if False:',
+            '    h',
+        ), False)
+
+    def test_dead_branches_with_all_output(self):
+        # Removing or unwrapping branches leaves no output in template
+        # body, it still has to be generator
+        rendered = self.assertSameOutput(jl(
+            '-for i in range(3):',
+            '  -if True:',
+            '    -continue',
+            '  x',
+        ))
+        self.assertEqual(rendered, '')
+        rendered = self.assertSameOutput(jl(
+            '-if True:',
+            '  -x = 1',
+            '-else:',
+            '  a',
+        ))
+        self.assertEqual(rendered, '')
+
+    def test_optimization_level(self):
+        env = PyhaaEnvironment(optimization_level=0)
+        structure_ = env.optimize_structure(env.parse_string(jl(
+            'a',
+            '=1',
+        )))
+        self.assertEqual(len(structure_.tree), 2)
+
+    def test_partial_inlining(self):
+        source = jl(
+            '`def static():',
+            '  %b static',
+            '`def dynamic(a):',
+            '  =a',
+            '=self.static()',
+            '=self.dynamic(1)',
+        )
+        env = PyhaaEnvironment(optimization_level=2)
+        structure_ = env.parse_string(source)
+        env.optimize_structure(structure_, partials=structure_.partials)
+        tag, expression = structure_.tree
+        self.assert_(isinstance(tag, structure.Tag))
+        self.assert_(isinstance(expression, structure.Expression))
+        self.assertEqual(
+            html_render_to_string(env.get_template_from_string(source)),
+            '<b>static</b>1',
+        )
+        # Without known inheritance chain nothing is inlined
+        structure_ = self.senv.optimize_structure(self.senv.parse_string(source))
+        self.assertEqual(len(structure_.tree), 2)
+        self.assert_(isinstance(structure_.tree.children[0], structure.Expression))
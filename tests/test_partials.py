@@ -22,6 +22,8 @@ Testing partial stuff...
 # along with this library in the file COPYING.LESSER. If not, see
 # <http://www.gnu.org/licenses/>.
 
+from types import CodeType
+
 from pyhaa import (
     html_render_to_string,
     PyhaaEnvironment,
@@ -68,6 +70,25 @@ class TestPartials(PyhaaTestCase):
         self.assertEqual(len(struct.partials['hello']), 4)
         self.assertEqual(len(struct.partials['lol']), 1)
 
+    def test_qualified_names(self):
+        template = self.senv.get_template_from_string(jl(
+            '`def hello(a):',
+            "  =''.join(x for x in a)",
+            '=self.hello("ab")',
+        ), template_name='pages/index.pha')
+        template_info = template._ph_template
+        hello = template_info.get_partial('hello')
+        self.assertEqual(hello.__name__, 'hello')
+        self.assertEqual(hello.__code__.co_name, 'pages/index.pha:hello')
+        self.assertEqual(hello.__qualname__, 'pages/index.pha:hello')
+        self.assertEqual(template_info.partial_names[hello.__code__], 'hello')
+        body = template_info.get_partial('__body__')
+        self.assertEqual(body.__code__.co_name, 'pages/index.pha:__body__')
+        if hasattr(hello.__code__, 'co_qualname'):
+            genexpr, = (const for const in hello.__code__.co_consts if isinstance(const, CodeType))
+            self.assertEqual(genexpr.co_qualname, 'pages/index.pha:hello.<locals>.<genexpr>')
+        self.assertEqual(html_render_to_string(template), 'ab')
+
     def test_optional_colon(self):
         # Should pass, we're declaring empty partial
         self.senv.parse_string(jl(
@@ -117,3 +138,51 @@ class TestPartials(PyhaaTestCase):
         )
 
 
+    def test_runtime_inlining(self):
+        loader = FilesystemLoader(paths='./tests/files/partials', input_encoding = 'utf-8')
+        environment = PyhaaEnvironment(loader = loader, optimization_level = 2)
+
+        template = environment.get_template('page.pha')
+        self.assertIsNot(template._ph_template, environment.get_template_info('page.pha'))
+        self.assertIs(template._ph_template, environment.get_template('page.pha')._ph_template)
+        self.assertEqual(
+            html_render_to_string(template),
+            '<html><head><title>Subpage - Web page</title></head><body><h1>Hello</h1></body></html>',
+        )
+        self.assertEqual(
+            html_render_to_string(environment.get_template('base.pha')),
+            '<html><head><title>Web page</title></head><body></body></html>',
+        )
+
+
+    def test_specialization_reuse(self):
+        loader = FilesystemLoader(paths='./tests/files/partials', input_encoding = 'utf-8')
+        environment = PyhaaEnvironment(loader = loader, optimization_level = 2)
+        parsed = list()
+
+        def hook(stage, path, duration, **details):
+            if stage == 'parse':
+                parsed.append(path)
+        environment.add_compile_hook(hook)
+
+        template = environment.get_template('page.pha')
+        page_info = environment.get_template_info('page.pha')
+        base_info = environment.get_template_info('base.pha')
+        specializations = environment.specializations[page_info]
+        self.assertEqual(
+            list(specializations),
+            [(('base.pha', loader.get_token('base.pha', base_info)),)],
+        )
+
+        # Changed parent gets specialized again, unchanged templates
+        # aren't parsed again
+        self.touch_future('./tests/files/partials/base.pha')
+        del parsed[:]
+        reloaded = environment.get_template('page.pha')
+        self.assertIsNot(reloaded._ph_template, template._ph_template)
+        self.assertEqual(parsed, ['base.pha', 'base.pha'])
+        self.assertEqual(len(specializations), 1)
+        self.assertEqual(
+            html_render_to_string(reloaded),
+            '<html><head><title>Subpage - Web page</title></head><body><h1>Hello</h1></body></html>',
+        )
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+'''
+Testing source maps and render profiler
+'''
+
+# Pyhaa - Templating system for Python 3
+# Copyright (c) 2011 Tomasz Kowalczyk
+# Contact e-mail: code@fluxid.pl
+#
+# This library is free software: you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation, either version 3 of the License, or (at your option) any
+# later version.
+# 
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Lesser General Public License for more
+# details.
+# 
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library in the file COPYING.LESSER. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import gc
+import io
+import json
+import linecache
+import traceback
+
+from pyhaa import (
+    html_render_to_string,
+    PyhaaEnvironment,
+)
+from pyhaa.profiler import RenderProfiler
+
+from .helpers import jl, PyhaaTestCase
+
+TEMPLATE = jl(
+    '`def item(i):',
+    '  %li =i',
+    '%ul',
+    '  - for i in range(3):',
+    '    =self.item(i)',
+    '- n = 100',
+    '%p ="x" * n',
+)
+
+class TestProfiler(PyhaaTestCase):
+    def test_parser_lines(self):
+        struct = self.senv.parse_string(TEMPLATE)
+        self.assertEqual(struct.partials['item'].lineno, 1)
+        ul, statement, p = struct.tree
+        self.assertEqual(ul.lineno, 3)
+        self.assertEqual(ul.children[0].lineno, 4)
+        self.assertEqual(statement.lineno, 6)
+        self.assertEqual(p.lineno, 7)
+
+    def test_source_map(self):
+        struct = self.senv.parse_string(TEMPLATE)
+        code = self.senv.codegen_structure(struct)
+        template_info = self.senv.template_info_from_bytecode(compile(code, '<string>', 'exec'))
+        lines = code.decode('utf-8').split('\n')
+        expression_line = next(
+            idx for idx, line in enumerate(lines, 1)
+            if '"x" * n' in line
+        )
+        self.assertEqual(template_info.template_lineno(expression_line), 7)
+        self.assertIsNone(template_info.template_lineno(1))
+
+    def test_traceback_lines(self):
+        source = jl(
+            '%ul',
+            '  - for i in range(3):',
+            '    %li =10 // (2 - i)',
+        )
+        template = self.senv.get_template_from_string(source)
+        try:
+            html_render_to_string(template)
+        except ZeroDivisionError as exc:
+            frame = traceback.extract_tb(exc.__traceback__)[-1]
+        else:
+            self.fail('No exception raised')
+        self.assertEqual(frame.lineno, 3)
+        self.assertEqual(frame.line, '%li =10 // (2 - i)')
+        self.assertTrue(frame.filename.startswith('<pyhaa-template-'))
+
+        environment = PyhaaEnvironment(remap_lines=False)
+        template = environment.get_template_from_string(source)
+        try:
+            html_render_to_string(template)
+        except ZeroDivisionError as exc:
+            frame = traceback.extract_tb(exc.__traceback__)[-1]
+        self.assertTrue(frame.filename.startswith('<pyhaa-generated-'))
+        self.assertIn('10 // (2 - i)', frame.line)
+
+    def test_source_lifetime(self):
+        template = self.senv.get_template_from_string(jl(
+            '%p Source lifetime',
+        ))
+        filename = template._ph_template.partials['__body__'].__code__.co_filename
+        self.assertIn(filename, linecache.cache)
+        # Source is forgotten together with template
+        del template
+        gc.collect()
+        self.assertNotIn(filename, linecache.cache)
+
+    def test_source_failed_code(self):
+        environment = PyhaaEnvironment(remap_lines=False)
+        before = set(linecache.cache)
+        # Code failing to compile isn't registered
+        with self.assertRaises(SyntaxError):
+            environment.compile_code('def (:\n'.encode('utf-8'), '<string>')
+        self.assertEqual(set(linecache.cache), before)
+        # Neither is code failing to run
+        bytecode = environment.compile_code('raise ValueError()\n'.encode('utf-8'), '<string>')
+        self.assertIn(bytecode.co_filename, linecache.cache)
+        with self.assertRaises(ValueError):
+            environment.template_info_from_bytecode(bytecode)
+        self.assertNotIn(bytecode.co_filename, linecache.cache)
+
+    def test_profiler(self):
+        template = self.senv.get_template_from_string(TEMPLATE, template_path='list.pha')
+        with RenderProfiler() as profiler:
+            rendered = html_render_to_string(template)
+
+        lines = dict(
+            ((partial, lineno), stats)
+            for (_, partial, lineno), stats in profiler.lines.items()
+        )
+        # Tag is on the same line as expression
+        self.assertEqual(lines['__body__', 7].output_bytes, len('<p></p>') + 100)
+        self.assertEqual(
+            sum(stats.output_bytes for stats in profiler.lines.values()),
+            len(rendered.encode('utf-8')),
+        )
+        self.assertIn(('item', 2), lines)
+
+        folded = profiler.folded_stacks()
+        self.assertTrue(any(
+            line.startswith('list.pha:__body__;list.pha:item;list.pha:2 ')
+            for line in folded
+        ))
+
+        fp = io.StringIO()
+        profiler.write_chrome_trace(fp)
+        trace = json.loads(fp.getvalue())
+        self.assertEqual(
+            set(event['name'] for event in trace['traceEvents']),
+            set(('list.pha:__body__', 'list.pha:item')),
+        )
+        self.assertIn('list.pha:2', profiler.report())
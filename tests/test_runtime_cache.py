@@ -30,8 +30,13 @@ from pyhaa import (
     PyhaaEnvironment,
 )
 from pyhaa.runtime.cache import (
+    estimate_code_size,
     FilesystemBytecodeCache,
+    GreedyDualSizeCache,
     LFUCache,
+    LRUCache,
+    SLRUCache,
+    TinyLFUCache,
 )
 from pyhaa.runtime.loaders import FilesystemLoader
 
@@ -66,24 +71,161 @@ class TestCache(PyhaaTestCase):
         self.assertEqual(cache.get('f'), None)
         # g was added after cleanup
         self.assertEqual(cache.get('g'), 'g!')
-        # e had more (two) uses than f but got removed too
-        self.assertEqual(cache.get('e'), None)
-        # a and d still on top...
-        self.assertEqual(cache.get('d'), 'd!')
+        # d was used most, but long ago - e was stored with aged priority
+        # and used as many times since then, so d got removed
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.get('e'), 'e!')
         self.assertEqual(cache.get('a'), 'a!')
 
         # Duh, we shouldn't touch internals...
-        self.assertEqual(cache.offset, 3)
+        self.assertEqual(cache.offset, 4)
         self.assertEqual(cache.cachedict['a'].priority, 5)
-        self.assertEqual(cache.cachedict['d'].priority, 4)
+        self.assertEqual(cache.cachedict['e'].priority, 5)
+        self.assertEqual(cache.cachedict['g'].priority, 5)
         cache.reduce_offset()
         self.assertEqual(cache.offset, 0)
-        self.assertEqual(cache.cachedict['a'].priority, 2)
-        self.assertEqual(cache.cachedict['d'].priority, 1)
+        self.assertEqual(cache.cachedict['a'].priority, 1)
+        self.assertEqual(cache.cachedict['e'].priority, 1)
 
         cache.clear()
         self.assertEqual(cache.get('a'), None)
 
+    def test_lru_cache(self):
+        cache = LRUCache(2)
+        cache.store('a', 'a!')
+        cache.store('b', 'b!')
+        self.assertEqual(cache.get('a'), 'a!')
+        cache.store('c', 'c!')
+        # b was used least recently
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.peek('a'), 'a!')
+        self.assertEqual(cache.get('c'), 'c!')
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['admissions'], 3)
+        self.assertEqual(stats['size'], 2)
+        cache.remove('a')
+        self.assertNotIn('a', cache)
+        self.assertRaises(KeyError, cache.remove, 'a')
+
+    def test_slru_cache(self):
+        cache = SLRUCache(4, protected_ratio=0.5)
+        cache.store('a', 'a!')
+        cache.store('b', 'b!')
+        # Used twice - promoted to protected segment
+        self.assertEqual(cache.get('a'), 'a!')
+        self.assertEqual(cache.get('b'), 'b!')
+        # One time scan doesn't push out protected entries
+        for key in 'cdefg':
+            cache.store(key, key + '!')
+        self.assertEqual(cache.peek('a'), 'a!')
+        self.assertEqual(cache.peek('b'), 'b!')
+        self.assertEqual(cache.peek('c'), None)
+        self.assertEqual(len(cache), 4)
+        self.assertEqual(cache.evictions, 3)
+
+    def test_tinylfu_cache(self):
+        cache = TinyLFUCache(10)
+        for key in range(9):
+            cache.store(key, key)
+        for _ in range(3):
+            for key in range(9):
+                self.assertEqual(cache.get(key), key)
+        # Scan of keys never seen before is not admitted
+        for key in range(100, 130):
+            cache.get(key)
+            cache.store(key, key)
+        for key in range(9):
+            self.assertEqual(cache.peek(key), key)
+        self.assertGreater(cache.rejections, 0)
+        self.assertLessEqual(len(cache), 10)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_tiny_lfu_counters(self):
+        cache = TinyLFUCache(10)
+        for key in range(10):
+            cache.store(key, key)
+        self.assertEqual(cache.admissions, 10)
+        # Updates of entries in main and window aren't admissions
+        cache.store(0, 'zero')
+        cache.store(9, 'nine')
+        self.assertEqual(cache.admissions, 10)
+        self.assertEqual(cache.peek(0), 'zero')
+        # Rejected candidate isn't counted as eviction
+        cache.store(100, 100)
+        self.assertEqual(cache.admissions, 11)
+        self.assertEqual(cache.rejections, 1)
+        self.assertEqual(cache.evictions, 0)
+        self.assertNotIn(9, cache)
+        # Popular candidate evicts victim from main
+        for _ in range(3):
+            cache.get(100)
+        cache.store(101, 101)
+        self.assertEqual(cache.admissions, 12)
+        self.assertEqual(cache.rejections, 1)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.peek(100), 100)
+        self.assertEqual(len(cache), 10)
+
+    def test_greedy_dual_size_cache(self):
+        cache = GreedyDualSizeCache(100)
+        cache.store('small', 'small!', size=10, cost=1.0)
+        cache.store('large', 'large!', size=60, cost=1.0)
+        cache.store('medium', 'medium!', size=30, cost=1.0)
+        self.assertEqual(cache.total_bytes, 100)
+        # Large and cheap one goes first
+        cache.store('other', 'other!', size=20, cost=1.0)
+        self.assertEqual(cache.peek('large'), None)
+        self.assertEqual(cache.peek('small'), 'small!')
+        self.assertEqual(cache.total_bytes, 60)
+        # Expensive entry survives though it's large
+        cache.store('expensive', 'expensive!', size=40, cost=100.0)
+        cache.store('next', 'next!', size=40, cost=1.0)
+        self.assertEqual(cache.peek('expensive'), 'expensive!')
+        self.assertLessEqual(cache.total_bytes, 100)
+        # Entry larger than whole cache is not stored at all
+        cache.store('huge', 'huge!', size=1000)
+        self.assertNotIn('huge', cache)
+        self.assertEqual(cache.rejections, 1)
+        cache.remove('expensive')
+        self.assertEqual(cache.total_bytes, sum(element.size for element in cache.cachedict.values()))
+
+    def test_greedy_dual_size_heap_bounded(self):
+        cache = GreedyDualSizeCache(1000)
+        for key in range(10):
+            cache.store(key, key, size=10)
+        for _ in range(1000):
+            for key in range(10):
+                self.assertEqual(cache.get(key), key)
+        self.assertLessEqual(len(cache.heap), 2 * len(cache) + 64)
+        self.assertEqual(cache.hits, 10000)
+
+    def test_estimate_code_size(self):
+        small = compile('x = 1', '<string>', 'exec')
+        large = compile('x = {!r}\ndef f():\n    return {!r}'.format('a' * 10000, 'b' * 10000), '<string>', 'exec')
+        self.assertGreater(estimate_code_size(large), estimate_code_size(small) + 20000)
+
+    def test_loader_template_cache(self):
+        cache = LRUCache(10)
+        loader = FilesystemLoader(paths='./tests/files/', input_encoding='utf-8', template_cache=cache)
+        environment = PyhaaEnvironment(loader=loader)
+        environment.get_template_info('basic.pha')
+        environment.get_template_info('basic.pha')
+        self.assertIs(loader.template_cache, cache)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.hits, 1)
+
+        cache = GreedyDualSizeCache(1024 * 1024)
+        loader = FilesystemLoader(paths='./tests/files/', input_encoding='utf-8', template_cache=cache)
+        environment = PyhaaEnvironment(loader=loader)
+        environment.get_template_info('basic.pha')
+        element = cache.cachedict['basic.pha']
+        self.assertGreater(element.size, 0)
+        self.assertGreater(element.cost, 0)
+
     def test_filesystem_bytecode_cache(self):
         reloaded = False
 
@@ -25,11 +25,16 @@ Testing template loading from files
 import os
 import os.path
 import tempfile
+import threading
+import time
+import unittest
 
 from pyhaa import (
     html_render_to_string,
     PyhaaEnvironment,
 )
+from pyhaa.runtime.cache import FilesystemBytecodeCache
+from pyhaa.runtime.inotify import inotify_available
 from pyhaa.runtime.loaders import FilesystemLoader
 
 from .helpers import PyhaaTestCase
@@ -154,3 +159,244 @@ class TestLoaders(PyhaaTestCase):
             os.rmdir(tmpdir)
 
 
+
+    def test_template_handle(self):
+        loader = FilesystemLoader(paths='./tests/files/inheritance', input_encoding='utf-8')
+        environment = PyhaaEnvironment(loader=loader)
+
+        handle = environment.get_template_handle('/comp_E.pha')
+        self.assertEqual(handle.path, 'comp_E.pha')
+        template = handle.get_template()
+        self.assertIs(handle.get_template(), template)
+        self.assertFalse(handle.is_stale())
+        self.assertEqual(html_render_to_string(template), 'E D C B A')
+
+        # Touching any template in chain makes handle stale
+        self.touch_future('./tests/files/inheritance/comp_A.pha')
+        self.assertTrue(handle.is_stale())
+        reloaded = handle.get_template()
+        self.assertIsNot(reloaded, template)
+        self.assertFalse(handle.is_stale())
+        self.assertEqual(html_render_to_string(reloaded), 'E D C B A')
+
+    def test_template_handle_checks(self):
+        checked = list()
+
+        class MyLoader(FilesystemLoader):
+            def is_expired(self, path, environment, token):
+                checked.append(path)
+                return super().is_expired(path, environment, token)
+
+        loader = MyLoader(paths='./tests/files/inheritance', input_encoding='utf-8', check_interval=3600)
+        environment = PyhaaEnvironment(loader=loader)
+        handle = environment.get_template_handle('comp_E.pha')
+        # Templates were checked while loading
+        self.assertFalse(handle.is_stale())
+        self.assertEqual(checked, [])
+
+        # Dropped templates are noticed without checking sources
+        loader.evict('comp_A.pha')
+        self.assertTrue(handle.is_stale())
+        self.assertEqual(checked, [])
+        template = handle.get_template()
+        self.assertFalse(handle.is_stale())
+        self.assertEqual(html_render_to_string(template), 'E D C B A')
+        self.assertEqual(checked, [])
+
+        # Pretend the interval has passed
+        loader.last_checks.clear()
+        self.assertFalse(handle.is_stale())
+        self.assertEqual(sorted(checked), ['comp_A.pha', 'comp_B.pha', 'comp_C.pha', 'comp_D.pha', 'comp_E.pha'])
+
+    def test_check_interval(self):
+        reloaded = False
+
+        class MyLoader(FilesystemLoader):
+            def get_bytecode(self, *args, **kwargs):
+                nonlocal reloaded
+                reloaded = True
+                return super().get_bytecode(*args, **kwargs)
+
+        loader = MyLoader(paths='./tests/files/', input_encoding='utf-8', check_interval=3600)
+        environment = PyhaaEnvironment(loader=loader)
+
+        self._load_and_render(environment, 'basic.pha')
+        self.assertTrue(reloaded)
+        reloaded = False
+        self.touch_future('./tests/files/basic.pha')
+        # Template was checked recently
+        self._load_and_render(environment, 'basic.pha')
+        self.assertFalse(reloaded)
+
+        # Pretend the interval has passed
+        loader.last_checks.clear()
+        loader.directory_snapshots.clear()
+        self.assertEqual(
+            self._load_and_render(environment, 'basic.pha'),
+            '<h1>ME GUSTA</h1>',
+        )
+        self.assertTrue(reloaded)
+
+    @unittest.skipUnless(inotify_available(), 'inotify not available')
+    def test_watch(self):
+        loader = FilesystemLoader(paths='./tests/files/', input_encoding='utf-8', watch=True)
+        environment = PyhaaEnvironment(loader=loader)
+        try:
+            self.assertTrue(loader.watching)
+            template_info = environment.get_template_info('basic.pha')
+            self.assertIs(environment.get_template_info('basic.pha'), template_info)
+
+            self.touch_future('./tests/files/basic.pha')
+            for _ in range(100):
+                if not loader.template_cache.peek('basic.pha'):
+                    break
+                time.sleep(0.01)
+            self.assertIsNone(loader.template_cache.peek('basic.pha'))
+            self.assertIsNot(environment.get_template_info('basic.pha'), template_info)
+        finally:
+            loader.stop_watching()
+        self.assertFalse(loader.watching)
+
+    def test_lookup_index(self):
+        paths = (
+            './tests/files/lookup_tests/secondary',
+            './tests/files/lookup_tests/main',
+        )
+        loader = FilesystemLoader(paths=paths, input_encoding='utf-8', lookup_ttl=3600, build_index=True)
+        self.assertEqual(
+            loader.lookup_filename('common/parts/first.pha'),
+            os.path.realpath('./tests/files/lookup_tests/secondary/common/parts/first.pha'),
+        )
+        self.assertEqual(
+            loader.lookup_filename('common/parts/second.pha'),
+            os.path.realpath('./tests/files/lookup_tests/main/common/parts/second.pha'),
+        )
+        self.assertEqual(loader.check_overlapping_paths(), [])
+
+        # Missing templates are remembered too
+        self.assertIsNone(loader.lookup_filename('missing.pha'))
+        self.assertIn('missing.pha', loader.lookup_cache)
+
+        environment = PyhaaEnvironment(loader=loader)
+        rendered = self._load_and_render(environment, 'second.pha', 'common/parts/')
+        self.assertEqual(rendered, 'second not secondary!')
+
+    def test_overlapping_paths(self):
+        loader = FilesystemLoader(paths=('./tests/files', './tests/files/lookup_tests'))
+        self.assertEqual(len(loader.check_overlapping_paths()), 1)
+
+    def test_single_flight(self):
+        compiled = list()
+        running = list()
+        concurrency = list()
+        lock = threading.Lock()
+
+        class SlowLoader(FilesystemLoader):
+            def get_bytecode(self, path, environment):
+                with lock:
+                    compiled.append(path)
+                    running.append(path)
+                    concurrency.append(len(running))
+                time.sleep(0.05)
+                try:
+                    return super().get_bytecode(path, environment)
+                finally:
+                    with lock:
+                        running.remove(path)
+
+        loader = SlowLoader(paths='./tests/files/', input_encoding='utf-8')
+        environment = PyhaaEnvironment(loader=loader, max_concurrent_compilations=1)
+        paths = ['basic.pha'] * 4 + ['inheritance/basic_A.pha'] * 4
+        results = dict()
+        def load(idx, path):
+            results[idx] = environment.get_template_info(path)
+        threads = [
+            threading.Thread(target=load, args=(idx, path))
+            for idx, path in enumerate(paths)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(compiled), sorted(set(paths)))
+        self.assertEqual(max(concurrency), 1)
+        self.assertEqual(len(set(results[idx] for idx in range(4))), 1)
+        self.assertEqual(len(set(results[idx] for idx in range(4, 8))), 1)
+
+    def test_single_flight_recheck(self):
+        loader = FilesystemLoader(paths='./tests/files/', input_encoding='utf-8')
+        environment = PyhaaEnvironment(loader=loader)
+        template_info = environment.get_template_info('basic.pha')
+
+        # Other thread finished loading between cache lookup and taking
+        # the lock - its result is used instead of loading again
+        loader.template_cache.get = lambda key: None
+        def get_bytecode(path, environment):
+            self.fail('Template loaded again')
+        loader.get_bytecode = get_bytecode
+        self.assertIs(environment.get_template_info('basic.pha'), template_info)
+        self.assertFalse(loader.loading)
+
+    def test_load_stage_reads_source(self):
+        readers = list()
+        class MyLoader(FilesystemLoader):
+            def get_source_code(self, path, environment):
+                result = super().get_source_code(path, environment)
+                readers.append(result[0])
+                return result
+
+        closed = list()
+        def hook(stage, template_path, duration, **details):
+            if stage == 'load':
+                closed.append(readers[-1].closed)
+
+        environment = PyhaaEnvironment(loader=MyLoader(paths='./tests/files/', input_encoding='utf-8'))
+        environment.add_compile_hook(hook)
+        environment.get_template_info('basic.pha')
+        # Source is read whole before load stage is reported
+        self.assertEqual(closed, [True])
+
+    def test_compile_hooks(self):
+        events = list()
+        def hook(stage, template_path, duration, **details):
+            events.append((stage, template_path, details))
+            self.assertGreaterEqual(duration, 0)
+
+        tmpdir = tempfile.mkdtemp(dir='.')
+        try:
+            bytecode_cache = FilesystemBytecodeCache(storage_directory=tmpdir)
+            loader = FilesystemLoader(paths='./tests/files/', input_encoding='utf-8', bytecode_cache=bytecode_cache)
+            environment = PyhaaEnvironment(loader=loader)
+            environment.add_compile_hook(hook)
+            environment.get_template_info('basic.pha')
+            self.assertEqual(
+                [stage for stage, _, _ in events],
+                ['bytecode_cache', 'load', 'parse', 'optimize', 'codegen', 'compile', 'exec'],
+            )
+            self.assertTrue(all(path == 'basic.pha' for _, path, _ in events))
+            self.assertEqual(events[0][2], dict(hit=False))
+            details = events[4][2]
+            self.assertGreater(details['nodes'], 0)
+            self.assertGreater(details['code_size'], 0)
+
+            del events[:]
+            loader.template_cache.clear()
+            environment.get_template_info('basic.pha')
+            self.assertEqual(
+                events,
+                [
+                    ('bytecode_cache', 'basic.pha', dict(hit=True)),
+                    ('exec', 'basic.pha', dict()),
+                ],
+            )
+
+            del events[:]
+            environment.remove_compile_hook(hook)
+            loader.template_cache.clear()
+            environment.get_template_info('basic.pha')
+            self.assertEqual(events, [])
+        finally:
+            for filename in os.listdir(tmpdir):
+                os.remove(os.path.join(tmpdir, filename))
+            os.rmdir(tmpdir)